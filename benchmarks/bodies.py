@@ -0,0 +1,126 @@
+"""
+Micro-benchmarks of building Kies requests, comparing the request body templates of KiesConstants
+with serializing nested dicts with dicttoxml for each request (as SamFetch did before).
+Bodies of both are compared for several values (including the ones that need escaping),
+so the benchmark fails if they are not byte-identical.
+
+    python -m benchmarks.bodies
+    python -m benchmarks.bodies --number 20000
+"""
+
+import argparse
+import time
+from typing import Any, Callable
+import dicttoxml
+from samfetch.kies import KiesConstants, KiesRequest
+from samfetch.session import Session
+from benchmarks.fake_kies import FILENAME, FIRMWARE, MODEL, MODEL_PATH, REGION, new_nonce
+
+# Values that are compared in both ways, besides the real ones.
+SAMPLES = [
+    (FIRMWARE, REGION, MODEL, "abcdefghijklmnop"),
+    ("A&B/<C>/\"D\"/'E'", "T{0}R", "SM-{}", "&amp;"),
+    ("", "TUR", "SM-N920C", "ü{x}"),
+    (None, 5, True, "x"),
+]
+
+
+def legacy_binary_info(firmware_version, region, model, logic_check) -> bytes:
+    return dicttoxml.dicttoxml({
+        "FUSMsg": {
+            "FUSHdr": {"ProtoVer": "1.0"},
+            "FUSBody": {
+                "Put": {
+                    "ACCESS_MODE": {"Data": "2"},
+                    "BINARY_NATURE": {"Data": "1"},
+                    "CLIENT_PRODUCT": {"Data": "Smart Switch"},
+                    "DEVICE_FW_VERSION": {"Data": firmware_version},
+                    "DEVICE_LOCAL_CODE": {"Data": region},
+                    "DEVICE_MODEL_NAME": {"Data": model},
+                    "LOGIC_CHECK": {"Data": logic_check}
+                }
+            }
+        }
+    }, attr_type = False, root = False)
+
+
+def legacy_binary_file(filename, logic_check) -> bytes:
+    return dicttoxml.dicttoxml({
+        "FUSMsg": {
+            "FUSHdr": {"ProtoVer": "1.0"},
+            "FUSBody": {
+                "Put": {
+                    "BINARY_FILE_NAME": {"Data": filename},
+                    "LOGIC_CHECK": {"Data": logic_check}
+                }
+            }
+        }
+    }, attr_type = False, root = False)
+
+
+def legacy_headers(nonce = None, signature = None) -> dict:
+    return {
+        "Authorization": f'FUS nonce="{nonce or ""}", signature="{signature or ""}", nc="", type="", realm="", newauth="1"',
+        "User-Agent": "Kies2.0_FUS"
+    }
+
+
+def check() -> None:
+    for sample in SAMPLES:
+        if legacy_binary_info(*sample) != KiesConstants.BINARY_INFO(*sample):
+            raise Exception(f"BINARY_INFO is different for {sample}.")
+        if legacy_binary_file(*sample[2:]) != KiesConstants.BINARY_FILE(*sample[2:]):
+            raise Exception(f"BINARY_FILE is different for {sample[2:]}.")
+        if legacy_headers(*sample[2:]) != KiesConstants.HEADERS(*sample[2:]):
+            raise Exception(f"HEADERS is different for {sample[2:]}.")
+
+
+def measure(function : Callable[[], Any], number : int) -> float:
+    """
+    Measures the time of calling the function once, in microseconds.
+    """
+    started = time.perf_counter()
+    for _ in range(number):
+        function()
+    return (time.perf_counter() - started) / number * 1000000
+
+
+def benchmark(number : int) -> None:
+    check()
+    session = Session(new_nonce(), "session")
+    logic_check = session.logic_check(FIRMWARE)
+    path = MODEL_PATH + FILENAME
+    cases = [
+        ("BINARY_INFO", lambda: legacy_binary_info(FIRMWARE, REGION, MODEL, logic_check),
+            lambda: KiesConstants.BINARY_INFO(FIRMWARE, REGION, MODEL, logic_check)),
+        ("BINARY_FILE", lambda: legacy_binary_file(FILENAME, logic_check),
+            lambda: KiesConstants.BINARY_FILE(FILENAME, logic_check)),
+        ("HEADERS", lambda: legacy_headers("nonce", "signature"),
+            lambda: KiesConstants.HEADERS("nonce", "signature")),
+    ]
+    print(f"{'request':<28} {'before':>10} {'after':>10} {'saved':>10}   (us per call)")
+    for name, before, after in cases:
+        before, after = measure(before, number), measure(after, number)
+        print(f"{name:<28} {before:>10.1f} {after:>10.1f} {before - after:>10.1f}")
+    # Whole requests of the details and download paths, with the bodies created in both ways.
+    requests = [
+        ("get_binary (details)", "BINARY_INFO", legacy_binary_info,
+            lambda: KiesRequest.get_binary(region = REGION, model = MODEL, firmware = FIRMWARE, session = session)),
+        ("get_download (download)", "BINARY_FILE", legacy_binary_file,
+            lambda: KiesRequest.get_download(path = path, session = session))
+    ]
+    for name, constant, legacy, function in requests:
+        current = getattr(KiesConstants, constant)
+        setattr(KiesConstants, constant, staticmethod(legacy))
+        try:
+            before = measure(function, number)
+        finally:
+            setattr(KiesConstants, constant, current)
+        after = measure(function, number)
+        print(f"{name:<28} {before:>10.1f} {after:>10.1f} {before - after:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Measures the speed of building Kies requests.")
+    parser.add_argument("--number", type = int, default = 5000, help = "Number of times to build each request.")
+    benchmark(parser.parse_args().number)
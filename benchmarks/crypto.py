@@ -0,0 +1,42 @@
+"""
+Micro-benchmarks of decryption, for choosing SAMFETCH_CHUNK_SIZE. Measures raw AES-ECB speed
+in a single thread, and start_decryptor speed with several downloads at the same time, for each chunk size.
+
+    python -m benchmarks.crypto
+    python -m benchmarks.crypto --streams 1 8 32 --threads 4
+"""
+
+import argparse
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from samfetch.crypto import BufferPool
+from samfetch.tuning import CHUNK_SIZES, measure_cipher, measure_pipeline, stream_memory
+
+MB = 1024 * 1024
+
+
+async def benchmark(args : argparse.Namespace) -> None:
+    executor = ThreadPoolExecutor(max_workers = args.threads)
+    print(f"{'chunk size':>12} {'memory':>9} {'aes-ecb':>10} " + " ".join(f"{f'{x} streams':>12}" for x in args.streams) + "   (MB/s)")
+    for chunk_size in args.chunk_sizes:
+        row = [measure_cipher(chunk_size, args.size)]
+        for streams in args.streams:
+            pool = None if args.no_pool else BufferPool(chunk_size, streams * (args.depth + 2))
+            row.append(await measure_pipeline(
+                chunk_size, streams = streams, size = args.size, 
+                executor = executor, queue_size = args.depth, pool = pool
+            ))
+        print(f"{chunk_size:>12} {stream_memory(chunk_size, args.depth) / MB:>7.1f}MB " + " ".join(f"{x / MB:>12.1f}" for x in row))
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Measures decryption speed for each chunk size.")
+    parser.add_argument("--chunk-sizes", type = int, nargs = "*", default = CHUNK_SIZES)
+    parser.add_argument("--streams", type = int, nargs = "*", default = [1, 4, 16], help = "Number of downloads at the same time.")
+    parser.add_argument("--threads", type = int, default = min(4, os.cpu_count() or 1), help = "Number of decrypt threads.")
+    parser.add_argument("--depth", type = int, default = 1, help = "Same as SAMFETCH_PIPELINE_DEPTH.")
+    parser.add_argument("--size", type = int, default = 32 * MB, help = "Bytes to decrypt for each download.")
+    parser.add_argument("--no-pool", action = "store_true", help = "Don't use a buffer pool.")
+    asyncio.run(benchmark(parser.parse_args()))
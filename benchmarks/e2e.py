@@ -0,0 +1,209 @@
+"""
+End-to-end benchmarks of SamFetch routes, against a local stand-in for Kies servers.
+Starts benchmarks.fake_kies and SamFetch (with benchmarks.serve) as separate processes,
+sends requests to each route with concurrent clients, and reports requests per second,
+p50/p99 latency and streaming speed. SAMFETCH_* environment variables are passed to SamFetch.
+
+Results are compared with the stored baselines, and the exit code is 1 if a result is
+worse than its baseline more than the tolerance. Use --save to store the results as baselines.
+Baselines are stored relative to the REFERENCE scenario of the same run, so they can be compared 
+on other machines, which are faster or slower as a whole.
+
+    python -m benchmarks.e2e
+    python -m benchmarks.e2e --only download_decrypt --concurrency 8 --save
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import httpx
+from Crypto.Cipher import AES
+from samfetch.crypto import Crypto
+from benchmarks.fake_kies import FILENAME, FIRMWARE, MODEL, MODEL_PATH, REGION
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+# Scenario that is always run, and that the results are divided by before comparing them with the baselines.
+REFERENCE = "list"
+
+# Metrics where a bigger value is better, others are better when smaller.
+HIGHER_IS_BETTER = ["requests_per_second", "megabytes_per_second"]
+
+
+def build_scenarios(key : str, size : int) -> Dict[str, Callable[[int], Tuple[str, str, Any, Dict[str, str]]]]:
+    """
+    Creates the requests of each scenario, as (method, path, json body, headers) for the n-th request.
+    """
+    download = f"/file{MODEL_PATH}{FILENAME}"
+    middle = size // 2
+    return {
+        "list": lambda n: ("GET", f"/{REGION}/{MODEL}/list", None, {}),
+        "list_uncached": lambda n: ("GET", f"/{REGION}/SM-B{n:06d}/list", None, {}),
+        "details": lambda n: ("GET", f"/{REGION}/{MODEL}/{FIRMWARE}", None, {}),
+        "batch_list": lambda n: ("POST", "/batch/list", [{"region": REGION, "model": f"SM-C{i:03d}"} for i in range(50)], {}),
+        "scan": lambda n: ("GET", f"/scan/{MODEL}", None, {}),
+        "download": lambda n: ("GET", download, None, {}),
+        "download_decrypt": lambda n: ("GET", download + "?decrypt=" + key, None, {}),
+        "download_range": lambda n: ("GET", download + "?decrypt=" + key, None, {"Range": f"bytes={middle}-{middle + 1048575}"})
+    }
+
+
+async def run_scenario(
+    client : httpx.AsyncClient,
+    make_request : Callable[[int], Tuple[str, str, Any, Dict[str, str]]],
+    requests : int,
+    concurrency : int,
+    expected : Optional[str] = None
+) -> Dict[str, float]:
+    latencies : List[float] = []
+    received = 0
+    counter = iter(range(requests))
+
+    async def worker():
+        nonlocal received
+        for n in counter:
+            method, path, body, headers = make_request(n)
+            started = time.perf_counter()
+            digest = hashlib.sha256()
+            async with client.stream(method, path, json = body, headers = headers) as response:
+                if response.status_code >= 400:
+                    raise Exception(f"{method} {path} has failed with {response.status_code}.")
+                async for chunk in response.aiter_raw():
+                    received += len(chunk)
+                    digest.update(chunk)
+            latencies.append(time.perf_counter() - started)
+            # Make sure that the content is correct, not just fast.
+            if (expected is not None) and (digest.hexdigest() != expected):
+                raise Exception(f"{method} {path} has returned a different content.")
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "megabytes_per_second": received / elapsed / 1024 / 1024
+    }
+
+
+def relative(results : Dict[str, Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """
+    Divides the metrics of each scenario by the same metrics of the REFERENCE scenario.
+    """
+    reference = results[REFERENCE]
+    return {
+        scenario: {metric: round(value / reference[metric], 4) for metric, value in metrics.items() if reference[metric]}
+        for scenario, metrics in results.items() if scenario != REFERENCE
+    }
+
+
+def compare(results : Dict[str, Dict[str, float]], baselines : Dict[str, Dict[str, float]], tolerance : float) -> bool:
+    """
+    Prints the change of each result from its baseline (both relative to the REFERENCE scenario),
+    and returns False if any of them is a regression.
+    """
+    passed = True
+    for scenario, metrics in relative(results).items():
+        for metric, value in metrics.items():
+            baseline = baselines.get(scenario, {}).get(metric, None)
+            if not baseline:
+                continue
+            change = (value - baseline) / baseline
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            # Latencies below a millisecond are mostly noise.
+            regression = (worse > tolerance) and not ((metric not in HIGHER_IS_BETTER) and (results[scenario][metric] < 1))
+            passed = passed and not regression
+            print(f"{scenario:<20} {metric:<22} {baseline:>10} -> {value:>10} ({change:+.1%}){'  REGRESSION' if regression else ''}")
+    return passed
+
+
+async def wait_until_ready(url : str, timeout : float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+
+async def benchmark(args : argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    upstream = f"http://127.0.0.1:{args.upstream_port}"
+    server = f"http://127.0.0.1:{args.port}"
+    processes = [
+        subprocess.Popen([sys.executable, "-m", "benchmarks.fake_kies", "--port", str(args.upstream_port), "--size", str(args.size)])
+    ]
+    try:
+        # SamFetch authorizes sessions on start, so Kies must be up before it.
+        await wait_until_ready(upstream + "/stats")
+        processes.append(subprocess.Popen([sys.executable, "-m", "benchmarks.serve", "--port", str(args.port), "--upstream", upstream]))
+        await wait_until_ready(server + "/")
+        async with httpx.AsyncClient(
+            base_url = server, timeout = None,
+            limits = httpx.Limits(max_connections = None, max_keepalive_connections = None)
+        ) as client:
+            key = (await client.get(f"/{REGION}/{MODEL}/{FIRMWARE}")).json()["decrypt_key"]
+            scenarios = build_scenarios(key, args.size)
+            plain = random.Random(1).randbytes(args.size)
+            middle = args.size // 2
+            expected = {
+                "download": AES.new(bytes.fromhex(key), AES.MODE_ECB).encrypt(Crypto.pad(plain)),
+                "download_decrypt": plain,
+                "download_range": plain[middle:middle + 1048576]
+            }
+            # Warm up the server once, so the reference is not measured on a cold start.
+            await run_scenario(client, scenarios[REFERENCE], args.requests, args.concurrency)
+            results = {}
+            for name, make_request in scenarios.items():
+                if args.only and (name not in args.only) and (name != REFERENCE):
+                    continue
+                downloads = name.startswith("download")
+                results[name] = await run_scenario(
+                    client, make_request,
+                    args.downloads if downloads else args.requests,
+                    args.concurrency, hashlib.sha256(expected[name]).hexdigest() if name in expected else None
+                )
+                print(f"{name:<20} " + "  ".join(f"{k}={v:.2f}" for k, v in results[name].items()), flush = True)
+            return results
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Runs end-to-end benchmarks against a local stand-in for Kies servers.")
+    parser.add_argument("--port", type = int, default = 9200)
+    parser.add_argument("--upstream-port", type = int, default = 9100)
+    parser.add_argument("--size", type = int, default = 32 * 1024 * 1024, help = "Size of the firmware in bytes.")
+    parser.add_argument("--requests", type = int, default = 500, help = "Number of requests for each API scenario.")
+    parser.add_argument("--downloads", type = int, default = 16, help = "Number of requests for each download scenario.")
+    parser.add_argument("--concurrency", type = int, default = 8)
+    parser.add_argument("--only", nargs = "*", help = "Names of the scenarios to run.")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "Allowed change from the baselines, 0.2 is 20%%.")
+    parser.add_argument("--save", action = "store_true", help = "Saves the results as baselines.")
+    args = parser.parse_args()
+    results = asyncio.run(benchmark(args))
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES, "r") as file:
+            baselines = json.load(file)
+    if args.save:
+        with open(BASELINES, "w") as file:
+            json.dump({**baselines, **relative(results)}, file, indent = 4)
+            file.write("\n")
+    elif baselines:
+        sys.exit(0 if compare(results, baselines, args.tolerance) else 1)
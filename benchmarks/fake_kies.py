@@ -0,0 +1,132 @@
+"""
+A local stand-in for Kies servers, which serves a synthetic firmware, so SamFetch can be 
+benchmarked without connecting to Samsung. Nonces are encrypted like Kies does, and the firmware 
+is encrypted with AES-ECB with the key that SamFetch derives from the binary details.
+
+    python -m benchmarks.fake_kies --port 9100 --size 67108864
+"""
+
+__all__ = [
+    "FIRMWARE",
+    "MODEL",
+    "REGION",
+    "FILENAME",
+    "MODEL_PATH",
+    "create_app"
+]
+
+import argparse
+import base64
+import hashlib
+import random
+import string
+from sanic import Sanic
+from sanic.request import Request
+from sanic.response import empty, json, text
+from Crypto.Cipher import AES
+from samfetch.crypto import Crypto
+from samfetch.session import Session
+
+REGION = "TUR"
+MODEL = "SM-N920C"
+FIRMWARE = "N920CXXU5CSH1/N920COXM5CSH1/N920CXXU5CSH1/N920CXXU5CSH1"
+ALTERNATE = ["N920CXXU5CSG1/N920COXM5CSG1/N920CXXU5CSG1/N920CXXU5CSG1", "N920CXXU5CSF1/N920COXM5CSF1/N920CXXU5CSF1"]
+LOGIC_VALUE = "abcdefghijklmnop0123456789ABCDEF"
+FILENAME = "SM-N920C_1_20220819152351_1eub6wdeqb_fac.zip.enc4"
+MODEL_PATH = "/neofus/9/"
+
+
+def new_nonce() -> str:
+    nonce = "".join(random.choice(string.ascii_letters + string.digits) for _ in range(16))
+    return base64.b64encode(Crypto.aes_encrypt(nonce.encode(), Crypto.KEY_1.encode())).decode()
+
+
+def fus_message(values : dict, status : int = 200) -> str:
+    put = "".join(f"<{k}><Data>{v}</Data></{k}>" for k, v in values.items())
+    return "<FUSMsg><FUSHdr><ProtoVer>1.0</ProtoVer></FUSHdr><FUSBody>" + \
+        f"<Results><Status>{status}</Status></Results><Put>{put}</Put></FUSBody></FUSMsg>"
+
+
+def create_app(size : int, seed : int = 1, chunk_size : int = 65536) -> Sanic:
+    """
+    Creates the server with a firmware of given size (before encrypting), which is 
+    generated from the seed, so the decrypted downloads can be compared.
+    """
+    app = Sanic("FakeKies")
+    plain = random.Random(seed).randbytes(size)
+    key = hashlib.md5(Session.custom_logic_check(FIRMWARE, LOGIC_VALUE).encode()).digest()
+    blob = AES.new(key, AES.MODE_ECB).encrypt(Crypto.pad(plain))
+    app.ctx.plain = plain
+    app.ctx.stats = {}
+
+    def count(name : str):
+        app.ctx.stats[name] = app.ctx.stats.get(name, 0) + 1
+
+    @app.post("/NF_DownloadGenerateNonce.do")
+    async def nonce(request : Request):
+        count("nonce")
+        response = empty(status = 200, headers = {"NONCE": new_nonce()})
+        response.cookies["JSESSIONID"] = "".join(random.choice(string.hexdigits) for _ in range(32))
+        return response
+
+    @app.post("/NF_DownloadBinaryInform.do")
+    async def binary_inform(request : Request):
+        count("binary_inform")
+        if FIRMWARE not in request.body.decode():
+            return text(fus_message({}, 408), headers = {"NONCE": new_nonce()})
+        return text(fus_message({
+            "BINARY_NAME": FILENAME, "MODEL_PATH": MODEL_PATH, "BINARY_BYTE_SIZE": len(blob),
+            "DEVICE_MODEL_DISPLAYNAME": "Galaxy Note5", "CURRENT_OS_VERSION": "Nougat(Android 7.0)",
+            "LAST_MODIFIED": "20190117144207", "DEVICE_PLATFORM": "Android", "BINARY_CRC": "1234567890",
+            "LATEST_FW_VERSION": FIRMWARE, "LOGIC_VALUE_FACTORY": LOGIC_VALUE, "DESCRIPTION": "https://doc.samsungmobile.com"
+        }), headers = {"NONCE": new_nonce()})
+
+    @app.post("/NF_DownloadBinaryInitForMass.do")
+    async def binary_init(request : Request):
+        count("binary_init")
+        return text(fus_message({}), headers = {"NONCE": new_nonce()})
+
+    @app.get("/NF_DownloadBinaryForMass.do")
+    async def binary_download(request : Request):
+        count("binary_download")
+        start, end, status, headers = 0, len(blob) - 1, 200, {}
+        if "Range" in request.headers:
+            first, last = request.headers["Range"].removeprefix("bytes=").split("-")
+            start, end, status = int(first or 0), min(int(last) if last else len(blob) - 1, len(blob) - 1), 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(blob)}"
+        headers["Content-Length"] = str(end - start + 1)
+        response = await request.respond(status = status, headers = headers, content_type = "application/octet-stream")
+        view = memoryview(blob)
+        for position in range(start, end + 1, chunk_size):
+            await response.send(view[position:min(position + chunk_size, end + 1)])
+        await response.eof()
+
+    @app.get("/firmware/<region:str>/<model:str>/version.xml")
+    async def version(request : Request, region : str, model : str):
+        count("version_xml")
+        if model.startswith("BAD"):
+            return text("", status = 403)
+        etag = '"' + hashlib.md5(f"{region}/{model}".encode()).hexdigest() + '"'
+        if request.headers.get("If-None-Match", None) == etag:
+            return empty(status = 304, headers = {"ETag": etag})
+        upgrades = "".join(f"<value rcount='1' fwsize='1'>{x}</value>" for x in ALTERNATE)
+        return text(
+            f"<versioninfo><url>http://fota-cloud-dn.ospserver.net/firmware/</url><firmware><model>{model}</model><cc>{region}</cc>" + \
+            f"<version><latest o='9'>{FIRMWARE}</latest><upgrade>{upgrades}</upgrade></version></firmware></versioninfo>",
+            headers = {"ETag": etag}, content_type = "text/xml"
+        )
+
+    @app.get("/stats")
+    async def stats(request : Request):
+        return json(app.ctx.stats)
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Runs a local stand-in for Kies servers.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 9100)
+    parser.add_argument("--size", type = int, default = 64 * 1024 * 1024, help = "Size of the firmware in bytes.")
+    args = parser.parse_args()
+    create_app(args.size).run(host = args.host, port = args.port, access_log = False)
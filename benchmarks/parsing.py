@@ -0,0 +1,105 @@
+"""
+Micro-benchmarks of parsing Kies responses, comparing the ElementTree parser of KiesData and
+KiesFirmwareList with converting the whole document with xmltodict (as SamFetch did before).
+Results of both are compared too, so the benchmark fails if they read different values.
+
+    python -m benchmarks.parsing
+    python -m benchmarks.parsing --upgrades 10 100 1000 --number 2000
+"""
+
+import argparse
+import time
+from typing import Any, Callable, Dict, List, Optional
+import xmltodict
+from samfetch.kies import KiesData, KiesFirmwareList, KiesUtils
+from benchmarks.fake_kies import ALTERNATE, FIRMWARE, LOGIC_VALUE, MODEL, REGION, fus_message
+
+BINARY_INFORM = fus_message({
+    "BINARY_NAME": "SM-N920C_1_20220819152351_1eub6wdeqb_fac.zip.enc4",
+    "BINARY_BYTE_SIZE": 67108864,
+    "DEVICE_MODEL_DISPLAYNAME": "Galaxy Note5",
+    "MODEL_PATH": "/neofus/9/",
+    "CURRENT_OS_VERSION": "Nougat(Android 7.0)",
+    "LAST_MODIFIED": 20190117144207,
+    "LATEST_FW_VERSION": FIRMWARE,
+    "LOGIC_VALUE_FACTORY": LOGIC_VALUE,
+    "DESCRIPTION": "http://doc.samsungmobile.com/SM-N920C/TUR/doc.html",
+    "DEVICE_PLATFORM": "Android",
+    "BINARY_CRC": 123456789,
+    # Real responses have many more fields than SamFetch uses.
+    **{f"UNUSED_FIELD_{i}": "x" * 20 for i in range(60)}
+})
+
+
+def version_xml(upgrades : int) -> str:
+    values = "".join(
+        f"<value rcount='1' fwsize='1'>{ALTERNATE[i % len(ALTERNATE)]}</value>" for i in range(upgrades)
+    )
+    return "<?xml version='1.0' encoding='UTF-8'?>" + \
+        f"<versioninfo><url>http://fota-cloud-dn.ospserver.net/firmware/</url><firmware><model>{MODEL}</model><cc>{REGION}</cc>" + \
+        f"<version><latest o='9'>{FIRMWARE}</latest><upgrade>{values}</upgrade></version></firmware></versioninfo>"
+
+
+def legacy_firmware_list(xml : str) -> Dict[str, Any]:
+    # Same lookups that KiesFirmwareList made on the xmltodict output.
+    versions = xmltodict.parse(xml, dict_constructor = dict)["versioninfo"]["firmware"]["version"]
+    latest = versions["latest"]
+    upgrade = versions["upgrade"]["value"]
+    upgrade = [] if upgrade is None else (upgrade if isinstance(upgrade, list) else [upgrade])
+    return {
+        "latest": KiesUtils.parse_firmware(latest if isinstance(latest, str) else latest["#text"]),
+        "alternate": [KiesUtils.parse_firmware(x["#text"]) for x in upgrade if x["#text"].count("/") > 1]
+    }
+
+
+def firmware_list(xml : str) -> Dict[str, Any]:
+    firmwares = KiesFirmwareList.from_xml(xml)
+    return {"latest": firmwares.latest, "alternate": firmwares.alternate}
+
+
+def legacy_binary_inform(xml : str) -> Dict[str, Any]:
+    body = xmltodict.parse(xml, dict_constructor = dict)["FUSMsg"]["FUSBody"]
+    put = {k: v.get("Data", v) if isinstance(v, dict) else v for k, v in body["Put"].items()}
+    return {"status": int(body["Results"]["Status"]), **{k: put[k] for k in FIELDS}}
+
+
+def binary_inform(xml : str) -> Dict[str, Any]:
+    kies = KiesData.from_xml(xml)
+    return {"status": kies.status_code, **{k: kies.body[k] for k in FIELDS}}
+
+
+# Fields that are read from binary details.
+FIELDS = [
+    "BINARY_NAME", "BINARY_BYTE_SIZE", "DEVICE_MODEL_DISPLAYNAME", "MODEL_PATH", "CURRENT_OS_VERSION",
+    "LAST_MODIFIED", "LATEST_FW_VERSION", "LOGIC_VALUE_FACTORY", "DESCRIPTION", "DEVICE_PLATFORM", "BINARY_CRC"
+]
+
+
+def measure(function : Callable[[str], Any], xml : str, number : int) -> float:
+    """
+    Measures the time of parsing the document once, in microseconds.
+    """
+    started = time.perf_counter()
+    for _ in range(number):
+        function(xml)
+    return (time.perf_counter() - started) / number * 1000000
+
+
+def benchmark(upgrades : List[int], number : int) -> None:
+    cases = [("binary_inform", BINARY_INFORM, legacy_binary_inform, binary_inform)] + [
+        (f"version_xml ({x} upgrades)", version_xml(x), legacy_firmware_list, firmware_list) for x in upgrades
+    ]
+    print(f"{'document':<28} {'size':>9} {'xmltodict':>11} {'elementtree':>12} {'speedup':>8}   (us per parse)")
+    for name, xml, legacy, current in cases:
+        if legacy(xml) != current(xml):
+            raise Exception(f"Parsers have read different values from {name}.")
+        before, after = measure(legacy, xml, number), measure(current, xml, number)
+        print(f"{name:<28} {len(xml):>9} {before:>11.1f} {after:>12.1f} {before / after:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Measures the speed of parsing Kies responses.")
+    parser.add_argument("--upgrades", type = int, nargs = "*", default = [1, 20, 200], help = "Number of alternate versions in version.xml.")
+    parser.add_argument("--number", type = int, default = 1000, help = "Number of times to parse each document.")
+    args = parser.parse_args()
+    benchmark(args.upgrades, args.number)
@@ -0,0 +1,30 @@
+"""
+Runs SamFetch with Kies URLs pointed to another server, such as benchmarks.fake_kies.
+
+    python -m benchmarks.serve --port 9200 --upstream http://127.0.0.1:9100
+"""
+
+import argparse
+from samfetch.kies import KiesConstants
+
+
+def point_to(upstream : str) -> None:
+    """
+    Replaces the Kies URLs with the same endpoints on the given server.
+    """
+    KiesConstants.GET_FIRMWARE_URL = upstream + "/firmware/{0}/{1}/version.xml"
+    KiesConstants.NONCE_URL = upstream + "/NF_DownloadGenerateNonce.do"
+    KiesConstants.BINARY_INFO_URL = upstream + "/NF_DownloadBinaryInform.do"
+    KiesConstants.BINARY_FILE_URL = upstream + "/NF_DownloadBinaryInitForMass.do"
+    KiesConstants.BINARY_DOWNLOAD_URL = upstream + "/NF_DownloadBinaryForMass.do"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Runs SamFetch against another Kies server.")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = 9200)
+    parser.add_argument("--upstream", default = "http://127.0.0.1:9100")
+    args = parser.parse_args()
+    point_to(args.upstream)
+    from main import app
+    app.run(host = args.host, port = args.port, access_log = False)
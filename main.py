@@ -1,8 +1,23 @@
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from sanic import Sanic, Request, HTTPResponse
+from sanic.log import logger
 from sanic.response import redirect, text, empty
 from httpx import HTTPError, NetworkError
-from web import bp, SamfetchError, make_error
+from web import bp, admin_bp, batch_bp, metrics_bp, watch_bp, warmup_bp, SamfetchError, make_error, CODECS
+from web import Watcher, load_watchlist, Warmup, load_entries, save_entries, top_entries
+from samfetch.client import KiesClient
+from samfetch.limiter import LimiterGroup, UpstreamUnavailable
+from samfetch.pool import SessionPool
+from samfetch.cache import TTLCache
+from samfetch.blobs import BlobCache
+from samfetch.store import MetadataStore
+from samfetch.history import FirmwareHistory
+from samfetch.fanout import FanoutHub
+from samfetch.crypto import BufferPool
+from samfetch.tuning import calibrate_chunk_size
+from samfetch.budget import MemoryBudget
 
 def get_env_int(name : str, default) -> int:
     if name not in os.environ:
@@ -23,6 +38,70 @@ app = Sanic("SamFetch")
 app.config.SAMFETCH_HIDE_TEXT = get_env_bool("SAMFETCH_HIDE_TEXT", False)
 app.config.SAMFETCH_ALLOW_ORIGIN = os.environ.get("SAMFETCH_ALLOW_ORIGIN", None) or "*"
 app.config.SAMFETCH_CHUNK_SIZE = get_env_int("SAMFETCH_CHUNK_SIZE", 1485760)
+app.config.SAMFETCH_HTTP2 = get_env_bool("SAMFETCH_HTTP2", True)
+app.config.SAMFETCH_MAX_CONNECTIONS = get_env_int("SAMFETCH_MAX_CONNECTIONS", 100)
+app.config.SAMFETCH_MAX_KEEPALIVE = get_env_int("SAMFETCH_MAX_KEEPALIVE", 20)
+app.config.SAMFETCH_KEEPALIVE_EXPIRY = get_env_int("SAMFETCH_KEEPALIVE_EXPIRY", 30)
+app.config.SAMFETCH_CONNECT_TIMEOUT = get_env_int("SAMFETCH_CONNECT_TIMEOUT", 5)
+app.config.SAMFETCH_READ_TIMEOUT = get_env_int("SAMFETCH_READ_TIMEOUT", 5)
+app.config.SAMFETCH_POOL_TIMEOUT = get_env_int("SAMFETCH_POOL_TIMEOUT", 10)
+app.config.SAMFETCH_MAX_DOWNLOAD_CONNECTIONS = get_env_int("SAMFETCH_MAX_DOWNLOAD_CONNECTIONS", 0)
+app.config.SAMFETCH_UPSTREAM_LIMIT = get_env_int("SAMFETCH_UPSTREAM_LIMIT", 64)
+app.config.SAMFETCH_UPSTREAM_INITIAL_LIMIT = get_env_int("SAMFETCH_UPSTREAM_INITIAL_LIMIT", 8)
+app.config.SAMFETCH_UPSTREAM_QUEUE = get_env_int("SAMFETCH_UPSTREAM_QUEUE", 100)
+app.config.SAMFETCH_UPSTREAM_QUEUE_TIMEOUT = get_env_int("SAMFETCH_UPSTREAM_QUEUE_TIMEOUT", 5)
+app.config.SAMFETCH_BREAKER_FAILURES = get_env_int("SAMFETCH_BREAKER_FAILURES", 5)
+app.config.SAMFETCH_BREAKER_COOLDOWN = get_env_int("SAMFETCH_BREAKER_COOLDOWN", 10)
+app.config.SAMFETCH_RETRIES = get_env_int("SAMFETCH_RETRIES", 2)
+app.config.SAMFETCH_RETRY_BACKOFF = get_env_int("SAMFETCH_RETRY_BACKOFF", 100)
+app.config.SAMFETCH_HEDGE_PERCENTILE = get_env_int("SAMFETCH_HEDGE_PERCENTILE", 95)
+app.config.SAMFETCH_HEDGE_BUDGET = get_env_int("SAMFETCH_HEDGE_BUDGET", 10)
+app.config.SAMFETCH_SESSION_POOL_SIZE = get_env_int("SAMFETCH_SESSION_POOL_SIZE", 4)
+app.config.SAMFETCH_SESSION_MAX_AGE = get_env_int("SAMFETCH_SESSION_MAX_AGE", 300)
+app.config.SAMFETCH_LIST_CACHE_SIZE = get_env_int("SAMFETCH_LIST_CACHE_SIZE", 1024)
+app.config.SAMFETCH_LIST_CACHE_TTL = get_env_int("SAMFETCH_LIST_CACHE_TTL", 300)
+app.config.SAMFETCH_LIST_CACHE_NEGATIVE_TTL = get_env_int("SAMFETCH_LIST_CACHE_NEGATIVE_TTL", 60)
+app.config.SAMFETCH_DETAILS_CACHE_SIZE = get_env_int("SAMFETCH_DETAILS_CACHE_SIZE", 4096)
+app.config.SAMFETCH_DETAILS_CACHE_TTL = get_env_int("SAMFETCH_DETAILS_CACHE_TTL", 21600)
+app.config.SAMFETCH_DETAILS_CACHE_NEGATIVE_TTL = get_env_int("SAMFETCH_DETAILS_CACHE_NEGATIVE_TTL", 300)
+app.config.SAMFETCH_SIZE_CACHE_SIZE = get_env_int("SAMFETCH_SIZE_CACHE_SIZE", 4096)
+app.config.SAMFETCH_STORE_PATH = os.environ.get("SAMFETCH_STORE_PATH", None)
+app.config.SAMFETCH_STORE_RETENTION = get_env_int("SAMFETCH_STORE_RETENTION", 86400)
+app.config.SAMFETCH_WATCHLIST = os.environ.get("SAMFETCH_WATCHLIST", None)
+app.config.SAMFETCH_WATCH_INTERVAL = get_env_int("SAMFETCH_WATCH_INTERVAL", 3600)
+app.config.SAMFETCH_WATCH_JITTER = get_env_int("SAMFETCH_WATCH_JITTER", 10)
+app.config.SAMFETCH_WATCH_CONCURRENCY = get_env_int("SAMFETCH_WATCH_CONCURRENCY", 4)
+app.config.SAMFETCH_HISTORY_PATH = os.environ.get("SAMFETCH_HISTORY_PATH", None)
+app.config.SAMFETCH_WARMUP_LIST = os.environ.get("SAMFETCH_WARMUP_LIST", None)
+app.config.SAMFETCH_WARMUP_STATE = os.environ.get("SAMFETCH_WARMUP_STATE", None)
+app.config.SAMFETCH_WARMUP_TOP = get_env_int("SAMFETCH_WARMUP_TOP", 100)
+app.config.SAMFETCH_WARMUP_CONCURRENCY = get_env_int("SAMFETCH_WARMUP_CONCURRENCY", 8)
+app.config.SAMFETCH_WARMUP_READY = get_env_int("SAMFETCH_WARMUP_READY", 90)
+app.config.SAMFETCH_WARMUP_TIMEOUT = get_env_int("SAMFETCH_WARMUP_TIMEOUT", 60)
+app.config.SAMFETCH_WARMUP_FAIL_OPEN = get_env_bool("SAMFETCH_WARMUP_FAIL_OPEN", False)
+app.config.SAMFETCH_BLOB_CACHE_DIR = os.environ.get("SAMFETCH_BLOB_CACHE_DIR", None)
+app.config.SAMFETCH_BLOB_CACHE_SIZE = get_env_int("SAMFETCH_BLOB_CACHE_SIZE", 10737418240)
+app.config.SAMFETCH_DECRYPT_THREADS = get_env_int("SAMFETCH_DECRYPT_THREADS", min(4, os.cpu_count() or 1))
+app.config.SAMFETCH_PIPELINE_DEPTH = get_env_int("SAMFETCH_PIPELINE_DEPTH", 1)
+app.config.SAMFETCH_SEGMENTS = get_env_int("SAMFETCH_SEGMENTS", 1)
+app.config.SAMFETCH_SEGMENT_SIZE = get_env_int("SAMFETCH_SEGMENT_SIZE", 8388608)
+app.config.SAMFETCH_MAX_HOST_CONNECTIONS = get_env_int("SAMFETCH_MAX_HOST_CONNECTIONS", 16)
+app.config.SAMFETCH_RESUME_RETRIES = get_env_int("SAMFETCH_RESUME_RETRIES", 3)
+app.config.SAMFETCH_RESUME_BACKOFF = get_env_int("SAMFETCH_RESUME_BACKOFF", 500)
+app.config.SAMFETCH_CALIBRATE = get_env_bool("SAMFETCH_CALIBRATE", False)
+app.config.SAMFETCH_STREAM_MEMORY = get_env_int("SAMFETCH_STREAM_MEMORY", 16777216)
+app.config.SAMFETCH_MEMORY_BUDGET = get_env_int("SAMFETCH_MEMORY_BUDGET", 536870912)
+app.config.SAMFETCH_MIN_CHUNK_SIZE = get_env_int("SAMFETCH_MIN_CHUNK_SIZE", 65536)
+app.config.SAMFETCH_BUDGET_TIMEOUT = get_env_int("SAMFETCH_BUDGET_TIMEOUT", 30)
+app.config.SAMFETCH_BUDGET_QUEUE = get_env_int("SAMFETCH_BUDGET_QUEUE", 100)
+app.config.SAMFETCH_BUFFER_POOL = get_env_int("SAMFETCH_BUFFER_POOL", 16)
+app.config.SAMFETCH_FANOUT_BUFFER = get_env_int("SAMFETCH_FANOUT_BUFFER", 8388608)
+app.config.SAMFETCH_BATCH_CONCURRENCY = get_env_int("SAMFETCH_BATCH_CONCURRENCY", 16)
+app.config.SAMFETCH_BATCH_MAX_ITEMS = get_env_int("SAMFETCH_BATCH_MAX_ITEMS", 500)
+app.config.SAMFETCH_SCAN_CONCURRENCY = get_env_int("SAMFETCH_SCAN_CONCURRENCY", 32)
+app.config.SAMFETCH_SCAN_MAX_REGIONS = get_env_int("SAMFETCH_SCAN_MAX_REGIONS", 250)
+app.config.SAMFETCH_METRICS = get_env_bool("SAMFETCH_METRICS", False)
+app.config.SAMFETCH_ADMIN_TOKEN = os.environ.get("SAMFETCH_ADMIN_TOKEN", None)
 app.config.FALLBACK_ERROR_FORMAT = "json"
 
 
@@ -51,6 +130,206 @@ NOTICE = """
     """
 
 
+@app.listener("before_server_start")
+async def create_client(app : Sanic, loop):
+    # Concurrent requests to each Kies endpoint are limited, and the limit follows how fast the endpoint responds.
+    app.ctx.limiters = None if app.config.SAMFETCH_UPSTREAM_LIMIT <= 0 else LimiterGroup(
+        initial = app.config.SAMFETCH_UPSTREAM_INITIAL_LIMIT,
+        max_limit = app.config.SAMFETCH_UPSTREAM_LIMIT,
+        max_queue = app.config.SAMFETCH_UPSTREAM_QUEUE,
+        timeout = app.config.SAMFETCH_UPSTREAM_QUEUE_TIMEOUT,
+        max_failures = max(app.config.SAMFETCH_BREAKER_FAILURES, 1),
+        cooldown = app.config.SAMFETCH_BREAKER_COOLDOWN
+    )
+    # A single client is shared between all handlers, so connections
+    # to Kies servers are kept alive instead of being created for each request.
+    app.ctx.client = KiesClient(
+        max_connections = app.config.SAMFETCH_MAX_CONNECTIONS,
+        max_keepalive_connections = app.config.SAMFETCH_MAX_KEEPALIVE,
+        keepalive_expiry = app.config.SAMFETCH_KEEPALIVE_EXPIRY,
+        connect_timeout = app.config.SAMFETCH_CONNECT_TIMEOUT,
+        read_timeout = app.config.SAMFETCH_READ_TIMEOUT,
+        pool_timeout = app.config.SAMFETCH_POOL_TIMEOUT,
+        max_download_connections = app.config.SAMFETCH_MAX_DOWNLOAD_CONNECTIONS,
+        http2 = app.config.SAMFETCH_HTTP2,
+        max_host_connections = app.config.SAMFETCH_MAX_HOST_CONNECTIONS,
+        limiters = app.ctx.limiters,
+        retries = app.config.SAMFETCH_RETRIES,
+        retry_backoff = app.config.SAMFETCH_RETRY_BACKOFF / 1000,
+        hedge_percentile = min(app.config.SAMFETCH_HEDGE_PERCENTILE, 100),
+        hedge_budget = app.config.SAMFETCH_HEDGE_BUDGET / 100
+    )
+    # Regions of all scans share the same limit, which is at most half of the queue of the limiter,
+    # so scans that run at the same time don't fill the queue and fail the other requests.
+    scan_limit = max(app.config.SAMFETCH_SCAN_CONCURRENCY, 1)
+    if app.ctx.limiters is not None:
+        scan_limit = min(scan_limit, max(app.config.SAMFETCH_UPSTREAM_QUEUE // 2, 1))
+    app.ctx.scan_limit = asyncio.Semaphore(scan_limit)
+    # Authenticated Kies sessions are kept warm, so requests don't need to get a new nonce.
+    app.ctx.sessions = SessionPool(
+        client = app.ctx.client,
+        size = app.config.SAMFETCH_SESSION_POOL_SIZE,
+        max_age = app.config.SAMFETCH_SESSION_MAX_AGE
+    )
+    # Cached metadata is also saved to the disk if a path has been set, 
+    # so it is shared between workers and kept between restarts.
+    app.ctx.store = None if not app.config.SAMFETCH_STORE_PATH else MetadataStore(
+        path = app.config.SAMFETCH_STORE_PATH,
+        retention = app.config.SAMFETCH_STORE_RETENTION
+    )
+    # Parsed firmware lists, keyed by region and model.
+    app.ctx.firmware_lists = TTLCache(
+        maxsize = app.config.SAMFETCH_LIST_CACHE_SIZE,
+        ttl = app.config.SAMFETCH_LIST_CACHE_TTL,
+        negative_ttl = app.config.SAMFETCH_LIST_CACHE_NEGATIVE_TTL,
+        store = app.ctx.store,
+        namespace = "firmware_lists",
+        codec = CODECS["firmware_lists"]
+    )
+    # Binary details, keyed by region, model and firmware.
+    app.ctx.binary_details = TTLCache(
+        maxsize = app.config.SAMFETCH_DETAILS_CACHE_SIZE,
+        ttl = app.config.SAMFETCH_DETAILS_CACHE_TTL,
+        negative_ttl = app.config.SAMFETCH_DETAILS_CACHE_NEGATIVE_TTL,
+        store = app.ctx.store,
+        namespace = "binary_details",
+        codec = CODECS["binary_details"]
+    )
+    # Decrypted firmware sizes, keyed by file path and decryption key.
+    # Files never change, so entries are only removed when the cache is full.
+    app.ctx.decrypted_sizes = TTLCache(
+        maxsize = app.config.SAMFETCH_SIZE_CACHE_SIZE,
+        ttl = float("inf"),
+        store = app.ctx.store,
+        namespace = "decrypted_sizes"
+    )
+    # Firmware history of the watched devices, only if there is a watchlist or a history file to serve.
+    app.ctx.history = None if not (app.config.SAMFETCH_WATCHLIST or app.config.SAMFETCH_HISTORY_PATH) else \
+        FirmwareHistory(path = app.config.SAMFETCH_HISTORY_PATH or ":memory:")
+    app.ctx.watcher = None
+    # Downloaded firmware files, only if a directory has been set.
+    app.ctx.blobs = None if not app.config.SAMFETCH_BLOB_CACHE_DIR else BlobCache(
+        root = app.config.SAMFETCH_BLOB_CACHE_DIR,
+        max_bytes = app.config.SAMFETCH_BLOB_CACHE_SIZE
+    )
+
+
+@app.listener("before_server_start")
+async def create_decryptor(app : Sanic, loop):
+    # Firmware chunks are decrypted in these threads, so the event loop can serve other requests meanwhile.
+    app.ctx.decryptor = ThreadPoolExecutor(
+        max_workers = max(app.config.SAMFETCH_DECRYPT_THREADS, 1),
+        thread_name_prefix = "samfetch-decrypt"
+    )
+    # Pick the chunk size that decrypts fastest on this host, within the memory limit of a download.
+    if app.config.SAMFETCH_CALIBRATE:
+        app.config.SAMFETCH_CHUNK_SIZE, results = await calibrate_chunk_size(
+            budget = app.config.SAMFETCH_STREAM_MEMORY,
+            executor = app.ctx.decryptor,
+            queue_size = app.config.SAMFETCH_PIPELINE_DEPTH,
+            streams = max(app.config.SAMFETCH_DECRYPT_THREADS, 1)
+        )
+        logger.info(
+            f"Chunk size has been calibrated to {app.config.SAMFETCH_CHUNK_SIZE} bytes " + \
+            f"({results[app.config.SAMFETCH_CHUNK_SIZE] / 1048576:.1f} MB/s)."
+        )
+    # Buffers that chunks are decrypted in, shared between downloads.
+    app.ctx.buffers = None if app.config.SAMFETCH_BUFFER_POOL <= 0 else BufferPool(
+        size = app.config.SAMFETCH_CHUNK_SIZE,
+        count = app.config.SAMFETCH_BUFFER_POOL
+    )
+    # Memory shared by all downloads, chunks of a download can't be bigger than its own memory limit.
+    app.ctx.budget = None if app.config.SAMFETCH_MEMORY_BUDGET <= 0 else MemoryBudget(
+        limit = app.config.SAMFETCH_MEMORY_BUDGET,
+        min_chunk_size = app.config.SAMFETCH_MIN_CHUNK_SIZE,
+        max_chunk_size = app.config.SAMFETCH_STREAM_MEMORY // (2 * app.config.SAMFETCH_PIPELINE_DEPTH + 3),
+        queue_size = app.config.SAMFETCH_PIPELINE_DEPTH,
+        timeout = app.config.SAMFETCH_BUDGET_TIMEOUT,
+        max_waiting = app.config.SAMFETCH_BUDGET_QUEUE
+    )
+    # Full downloads of the same file that are being streamed, so concurrent downloads can share them.
+    app.ctx.fanout = None if app.config.SAMFETCH_FANOUT_BUFFER <= 0 else FanoutHub(
+        capacity = app.config.SAMFETCH_FANOUT_BUFFER
+    )
+
+
+@app.listener("before_server_start")
+async def load_warmup(app : Sanic, loop):
+    # Entries to load into the caches on start, from the configured list and the most used ones of the previous run.
+    entries = []
+    if app.config.SAMFETCH_WARMUP_LIST:
+        entries.extend(load_entries(app.config.SAMFETCH_WARMUP_LIST))
+    if app.config.SAMFETCH_WARMUP_STATE and os.path.isfile(app.config.SAMFETCH_WARMUP_STATE):
+        entries.extend(load_entries(app.config.SAMFETCH_WARMUP_STATE))
+    entries = list(dict.fromkeys(entries))
+    app.ctx.warmup = None if not entries else Warmup(
+        app = app,
+        entries = entries,
+        concurrency = app.config.SAMFETCH_WARMUP_CONCURRENCY,
+        share = min(app.config.SAMFETCH_WARMUP_READY, 100) / 100,
+        timeout = app.config.SAMFETCH_WARMUP_TIMEOUT,
+        fail_open = app.config.SAMFETCH_WARMUP_FAIL_OPEN
+    )
+
+
+@app.listener("after_server_start")
+async def fill_sessions(app : Sanic, loop):
+    app.ctx.sessions.fill()
+
+
+@app.listener("after_server_start")
+async def start_warmup(app : Sanic, loop):
+    if app.ctx.warmup is not None:
+        logger.info(f"Warming up the caches with {len(app.ctx.warmup.entries)} entries.")
+        app.ctx.warmup.start()
+
+
+@app.listener("before_server_stop")
+async def save_warmup(app : Sanic, loop):
+    if app.ctx.warmup is not None:
+        await app.ctx.warmup.stop()
+    # Remember the most used entries, so the next run warms them up.
+    if app.config.SAMFETCH_WARMUP_STATE and (app.config.SAMFETCH_WARMUP_TOP > 0):
+        entries = top_entries(app, app.config.SAMFETCH_WARMUP_TOP)
+        if entries:
+            save_entries(app.config.SAMFETCH_WARMUP_STATE, entries)
+
+
+@app.listener("after_server_start")
+async def start_watcher(app : Sanic, loop):
+    if not app.config.SAMFETCH_WATCHLIST:
+        return
+    watcher = Watcher(
+        app = app,
+        devices = load_watchlist(app.config.SAMFETCH_WATCHLIST),
+        interval = max(app.config.SAMFETCH_WATCH_INTERVAL, 1),
+        jitter = min(app.config.SAMFETCH_WATCH_JITTER, 100) / 100,
+        concurrency = app.config.SAMFETCH_WATCH_CONCURRENCY,
+        # Workers share the history file, so only one of them polls the devices.
+        lock_file = None if not app.config.SAMFETCH_HISTORY_PATH else app.config.SAMFETCH_HISTORY_PATH + ".lock"
+    )
+    if watcher.start():
+        app.ctx.watcher = watcher
+        logger.info(f"Watching {len(watcher.devices)} devices in every {watcher.interval} seconds.")
+
+
+@app.listener("before_server_stop")
+async def stop_watcher(app : Sanic, loop):
+    if app.ctx.watcher is not None:
+        await app.ctx.watcher.stop()
+
+
+@app.listener("after_server_stop")
+async def close_client(app : Sanic, loop):
+    await app.ctx.sessions.close()
+    await app.ctx.client.aclose()
+    app.ctx.decryptor.shutdown(wait = False)
+    if app.ctx.store is not None:
+        app.ctx.store.close()
+    if app.ctx.history is not None:
+        app.ctx.history.close()
+
+
 @app.middleware("response")
 async def set_cors(request : Request, response : HTTPResponse):
     response.headers["Access-Control-Allow-Origin"] = request.app.config.SAMFETCH_ALLOW_ORIGIN
@@ -59,9 +338,13 @@ async def set_cors(request : Request, response : HTTPResponse):
     response.headers["Access-Control-Allow-Headers"] = "*"
 
 
+# Metadata calls have already been retried by the client when they get here.
 @app.exception(HTTPError)
 async def http_error(request : Request, exception : HTTPError):
-    if isinstance(exception, NetworkError):
+    # Kies endpoint is unhealthy or too busy, so the request hasn't been sent.
+    if isinstance(exception, UpstreamUnavailable):
+        raise make_error(SamfetchError.KIES_SERVER_OUTER_ERROR, 503)
+    elif isinstance(exception, NetworkError):
         raise make_error(SamfetchError.NETWORK_ERROR, 500)
     else:
         raise make_error(SamfetchError.GENERIC_HTTP_ERROR, 500)
@@ -77,5 +360,10 @@ async def home(request : Request):
 async def github(request : Request):
     return redirect("https://github.com/ysfchn/SamFetch")
 
-# Register blueprint.
+# Register blueprints.
 app.blueprint(bp)
+app.blueprint(admin_bp)
+app.blueprint(batch_bp)
+app.blueprint(metrics_bp)
+app.blueprint(watch_bp)
+app.blueprint(warmup_bp)
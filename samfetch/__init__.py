@@ -6,10 +6,17 @@ __all__ = [
     "KiesConstants",
     "KiesRequest",
     "KiesUtils",
-    "KiesFirmwareList"
-    "Session"
+    "KiesFirmwareList",
+    "Session",
+    "KiesClient",
+    "SessionPool",
+    "CacheEntry",
+    "TTLCache"
 ]
 
 from samfetch.crypto import start_decryptor, Crypto
 from samfetch.kies import KiesDict, KiesData, KiesConstants, KiesFirmwareList, KiesRequest, KiesUtils
-from samfetch.session import Session
\ No newline at end of file
+from samfetch.session import Session
+from samfetch.client import KiesClient
+from samfetch.pool import SessionPool
+from samfetch.cache import CacheEntry, TTLCache
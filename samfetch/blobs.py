@@ -0,0 +1,193 @@
+__all__ = [
+    "BlobCache",
+    "BlobWriter"
+]
+
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+
+class BlobWriter:
+    """
+    Writes a firmware file to a temporary file, and moves it to the cache once it is complete.
+    """
+
+    def __init__(self, cache : "BlobCache", key : str, size : int) -> None:
+        self.cache = cache
+        self.key = key
+        self.size = size
+        self.written = 0
+        self.file = cache.file(key)
+        # Each writer has its own temporary file, as workers may be downloading the same file at once.
+        handle, self.temp = tempfile.mkstemp(
+            suffix = ".part", prefix = os.path.basename(self.file) + ".", dir = os.path.dirname(self.file)
+        )
+        self._handle = os.fdopen(handle, "wb")
+
+    async def write(self, data : bytes) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self._handle.write, data)
+        self.written += len(data)
+
+    async def commit(self) -> None:
+        if self.written != self.size:
+            self.abort()
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self._flush)
+        # Renaming is atomic, so other requests never see a half-written file.
+        os.replace(self.temp, self.file)
+        self.cache._committed(self)
+
+    def _flush(self) -> None:
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+        self._handle.close()
+
+    def abort(self) -> None:
+        if not self._handle.closed:
+            self._handle.close()
+        if os.path.exists(self.temp):
+            os.remove(self.temp)
+        self.cache._aborted(self)
+
+
+class BlobCache:
+    """
+    Stores downloaded (encrypted) firmware files in the disk, so following downloads of the same file
+    can be served without connecting to Kies servers. Least recently used files are removed when
+    the cache exceeds its size limit.
+
+    Temporary files are removed on start only if they haven't been written for "STALE_AGE" seconds,
+    as they may belong to another worker that is still downloading.
+
+    Workers share the directory, so files that are not known by this worker are looked up in the disk,
+    and the index is rebuilt from the directory before removing files, so the size limit is for all workers.
+    """
+
+    STALE_AGE = 3600
+
+    def __init__(self, root : str, max_bytes : int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._files : "OrderedDict[str, int]" = OrderedDict()
+        self._writing = {}
+        # Bytes of the temporary files of other workers.
+        self._foreign = 0
+        os.makedirs(self.root, exist_ok = True)
+        self._scan(clean = True)
+
+    def _scan(self, clean : bool = False) -> None:
+        """
+        Rebuilds the index from the files in the directory, ordered by last access.
+        If "clean" is set, removes the temporary files of the downloads that have been interrupted by a previous run.
+        """
+        entries, foreign = [], 0
+        own = set(w.temp for w in self._writing.values())
+        for name in os.listdir(self.root):
+            file = os.path.join(self.root, name)
+            # Files may be removed by other workers meanwhile.
+            try:
+                stat = os.stat(file)
+                if name.endswith(".part"):
+                    if clean and (time.time() - stat.st_mtime > self.STALE_AGE):
+                        os.remove(file)
+                    elif file not in own:
+                        foreign += stat.st_size
+                elif name.endswith(".blob"):
+                    entries.append((stat.st_mtime, file, stat.st_size))
+            except OSError:
+                pass
+        self._files = OrderedDict((file, size) for _, file, size in sorted(entries))
+        self._foreign = foreign
+
+    @property
+    def used(self) -> int:
+        return sum(self._files.values()) + sum(w.size for w in self._writing.values()) + self._foreign
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def file(self, key : str) -> str:
+        return os.path.join(self.root, hashlib.sha256(key.encode()).hexdigest() + ".blob")
+
+    def get(self, key : str) -> Optional[str]:
+        """
+        Gets the path of the cached file, or None if it is not cached.
+        """
+        file = self.file(key)
+        try:
+            # File may have been written by another worker, or removed by it.
+            size = os.stat(file).st_size
+        except OSError:
+            self._files.pop(file, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._files[file] = size
+        self._files.move_to_end(file)
+        # Keep the access time in the file, so the order is same after a restart, and for other workers.
+        os.utime(file)
+        return file
+
+    def writer(self, key : str, size : int) -> Optional[BlobWriter]:
+        """
+        Creates a writer for the file if it is not cached or being written, and there is enough space for it.
+        """
+        file = self.file(key)
+        if (file in self._files) or (file in self._writing) or (size > self.max_bytes) or os.path.exists(file):
+            return None
+        # Other workers may have added or removed files, so see what is in the directory first.
+        self._scan()
+        # Remove least recently used files until there is enough space.
+        # Files that are being read are not affected, as they are already opened.
+        while self._files and (self.used + size > self.max_bytes):
+            old, _ = self._files.popitem(last = False)
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        if self.used + size > self.max_bytes:
+            return None
+        try:
+            writer = BlobWriter(self, key, size)
+        except OSError:
+            return None
+        self._writing[file] = writer
+        return writer
+
+    async def tee(self, key : str, size : int, iterator : AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Yields the chunks from the iterator while writing them to the cache.
+        """
+        writer = self.writer(key, size)
+        try:
+            async for chunk in iterator:
+                if writer:
+                    # Failing to cache the file shouldn't fail the download.
+                    try:
+                        await writer.write(chunk)
+                    except OSError:
+                        writer.abort()
+                        writer = None
+                yield chunk
+            if writer:
+                try:
+                    await writer.commit()
+                except OSError:
+                    writer.abort()
+        finally:
+            if writer and (writer.file in self._writing):
+                writer.abort()
+
+    def _committed(self, writer : BlobWriter) -> None:
+        self._writing.pop(writer.file, None)
+        self._files[writer.file] = writer.size
+
+    def _aborted(self, writer : BlobWriter) -> None:
+        self._writing.pop(writer.file, None)
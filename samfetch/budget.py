@@ -0,0 +1,199 @@
+__all__ = [
+    "MemoryBudget",
+    "Reservation",
+    "BudgetExceeded"
+]
+
+import asyncio
+from typing import Callable, Optional, Set
+from samfetch.tuning import stream_memory
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised when a download couldn't get memory from the budget in time, or too many downloads are waiting.
+    """
+
+
+class Reservation:
+    """
+    Memory that a download has reserved from the budget. Chunk size of the download is changed
+    depending on how fast the client reads, and the reserved memory follows the chunk size.
+    Buffers with a fixed size, such as segments, have a chunk size of 0 and only reserve the "extra" memory.
+    """
+
+    def __init__(self, budget : "MemoryBudget", chunk_size : int, preferred : int, extra : int) -> None:
+        self.budget = budget
+        self.chunk_size = chunk_size
+        # Chunks are grown up to the preferred size, as bigger chunks don't make streaming faster.
+        self.preferred = preferred
+        # Memory that doesn't depend on the chunk size, such as segments.
+        self.extra = extra
+        self.size = self.memory(chunk_size)
+        self.released = False
+        # Smoothed speed of the client, in bytes per second.
+        self._speed : Optional[float] = None
+
+    def memory(self, chunk_size : int) -> int:
+        return (0 if not chunk_size else stream_memory(chunk_size, self.budget.queue_size)) + self.extra
+
+    def sent(self, size : int, seconds : float) -> None:
+        """
+        Records the time spent for sending a chunk to the client, and resizes the chunks if needed.
+        Chunks are made smaller when the client needs more than DRAIN_TARGET seconds for a chunk,
+        so slow clients don't hold big buffers, and bigger (up to the preferred size) when it is much faster 
+        and there is free memory.
+        Chunks are also made smaller while other downloads are waiting for memory.
+        """
+        speed = size / max(seconds, 1e-6)
+        self._speed = speed if self._speed is None else (self._speed * 0.8 + speed * 0.2)
+        drain = self.chunk_size / self._speed
+        # Give memory back to the downloads that are waiting for it.
+        if self.budget.waiting and (self.chunk_size > self.budget.min_chunk_size):
+            self.resize(self.budget.align(self.chunk_size // 2))
+        elif (drain > self.budget.DRAIN_TARGET) and (self.chunk_size > self.budget.min_chunk_size):
+            self.resize(self.budget.align(self.chunk_size // 2))
+        elif (drain < self.budget.DRAIN_TARGET / 4) and (self.chunk_size < self.preferred):
+            self.resize(min(self.budget.align(self.chunk_size * 2), self.preferred))
+
+    def resize(self, chunk_size : int) -> bool:
+        if self.released:
+            return False
+        if self.budget._resize(self, self.memory(chunk_size)):
+            self.chunk_size = chunk_size
+            # Next measurements shouldn't be compared with the previous chunk size.
+            self._speed = None
+            return True
+        return False
+
+    def detach(self, size : int) -> "Reservation":
+        """
+        Moves "size" bytes of the extra memory to a new reservation without waiting, so it can be
+        given to a buffer that may live longer than the download, such as segments or a shared stream.
+        """
+        size = min(size, self.extra)
+        self.extra -= size
+        self.size -= size
+        reservation = Reservation(self.budget, 0, 0, size)
+        self.budget.reservations.add(reservation)
+        return reservation
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.budget._release(self)
+
+
+class MemoryBudget:
+    """
+    Limits the total memory that downloads can hold for streaming. Downloads reserve memory before
+    they start, and wait for other downloads to end if there is not enough, or fail if they have waited
+    for "timeout" seconds or "max_waiting" downloads are already waiting.
+    """
+
+    # Seconds that a client should need at most for reading a chunk.
+    DRAIN_TARGET = 0.25
+
+    def __init__(
+        self,
+        limit : int,
+        min_chunk_size : int = 65536,
+        max_chunk_size : int = 8388608,
+        queue_size : int = 1,
+        timeout : float = 30,
+        max_waiting : int = 100
+    ) -> None:
+        self.limit = limit
+        # Chunk sizes must contain whole blocks, so they can be decrypted on their own.
+        self.min_chunk_size = max(min_chunk_size - (min_chunk_size % 16), 16)
+        self.max_chunk_size = max(max_chunk_size - (max_chunk_size % 16), self.min_chunk_size)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.max_waiting = max_waiting
+        self.used = 0
+        self.reservations : Set[Reservation] = set()
+        self.waiting = 0
+        self.refused = 0
+        self._changed = asyncio.Condition()
+
+    def align(self, chunk_size : int) -> int:
+        """
+        Limits the chunk size to the minimum and maximum chunk sizes, 
+        and makes it contain whole blocks, so chunks can be decrypted on their own.
+        """
+        return max(min(chunk_size - (chunk_size % 16), self.max_chunk_size), self.min_chunk_size)
+
+    @property
+    def free(self) -> int:
+        return self.limit - self.used
+
+    @property
+    def streams(self) -> int:
+        return len([x for x in self.reservations if x.chunk_size])
+
+    @property
+    def buffered(self) -> int:
+        # Memory reserved for the fixed size buffers, such as shared streams and segments.
+        return sum(x.extra for x in self.reservations if not x.chunk_size)
+
+    def _fitting(self, chunk_size : int, extra : int) -> Optional[int]:
+        # Halve the preferred chunk size until it fits in the half of the free memory, so there is room
+        # for the next downloads too, unless only the smallest chunk size fits.
+        chunk_size = self.align(chunk_size)
+        while (chunk_size > self.min_chunk_size) and (stream_memory(chunk_size, self.queue_size) + extra > self.free / 2):
+            chunk_size = self.align(chunk_size // 2)
+        return chunk_size if stream_memory(chunk_size, self.queue_size) + extra <= self.free else None
+
+    async def acquire(self, chunk_size : int, extra : int = 0) -> Reservation:
+        """
+        Reserves memory for a download, preferably for the given chunk size. Chunk size of the download
+        starts smaller if the free memory is not enough, and never grows bigger than the given one.
+        All memory of a download ("extra" for its buffers) is reserved at once, so downloads never hold 
+        a reservation while waiting for another one.
+        """
+        await self._wait(lambda: self._fitting(chunk_size, extra) is not None)
+        reservation = Reservation(self, self._fitting(chunk_size, extra), self.align(chunk_size), extra)
+        self.used += reservation.size
+        self.reservations.add(reservation)
+        return reservation
+
+    async def _wait(self, fits : Callable[[], bool]) -> None:
+        # Let the downloads that are already waiting go first.
+        if fits() and (not self.waiting):
+            return
+        if self.waiting >= self.max_waiting:
+            self.refused += 1
+            raise BudgetExceeded()
+        self.waiting += 1
+        try:
+            async with self._changed:
+                await asyncio.wait_for(self._changed.wait_for(fits), timeout = self.timeout)
+        except asyncio.TimeoutError:
+            self.refused += 1
+            raise BudgetExceeded()
+        finally:
+            self.waiting -= 1
+
+    def _resize(self, reservation : Reservation, size : int) -> bool:
+        change = size - reservation.size
+        # Don't grow while other downloads are waiting for memory.
+        if (change > 0) and ((change > self.free) or self.waiting):
+            return False
+        self.used += change
+        reservation.size = size
+        if change < 0:
+            self._notify()
+        return True
+
+    def _release(self, reservation : Reservation) -> None:
+        self.used -= reservation.size
+        self.reservations.discard(reservation)
+        self._notify()
+
+    def _notify(self) -> None:
+        if self.waiting:
+            asyncio.create_task(self._wake())
+
+    async def _wake(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
@@ -0,0 +1,217 @@
+__all__ = [
+    "CacheEntry",
+    "TTLCache"
+]
+
+import asyncio
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, Optional, Tuple
+from samfetch.store import MetadataStore
+
+# Converts values to basic types for storing them, and back. Both are called with the value and whether if it is negative.
+Codec = Tuple[Callable[[Any, bool], Any], Callable[[Any, bool], Any]]
+
+
+class CacheEntry:
+    """
+    A value stored in TTLCache with its expiry time and HTTP validators.
+    """
+
+    __slots__ = ("value", "expires", "negative", "etag", "last_modified")
+
+    def __init__(
+        self,
+        value : Any,
+        expires : float,
+        negative : bool = False,
+        etag : Optional[str] = None,
+        last_modified : Optional[str] = None
+    ) -> None:
+        self.value = value
+        self.expires = expires
+        self.negative = negative
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires
+
+    @property
+    def ttl(self) -> float:
+        return max(self.expires - time.monotonic(), 0)
+
+
+class TTLCache:
+    """
+    An in-memory cache that expires entries after a time and evicts the least recently used
+    entries when it is full. Expired entries are kept until they are evicted, so they can
+    be revalidated with conditional requests.
+
+    If a store has given, entries are also saved to it, and entries that are not in the memory
+    are looked up in the store before loading them, so they are shared between worker processes
+    and kept between restarts. Values are converted with the codec when saving and reading them.
+    """
+
+    def __init__(
+        self,
+        maxsize : int = 1024,
+        ttl : float = 300,
+        negative_ttl : float = 60,
+        store : Optional[MetadataStore] = None,
+        namespace : str = "",
+        codec : Optional[Codec] = None
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.store = store
+        self.namespace = namespace
+        self.encode, self.decode = codec or (lambda value, negative: value, lambda data, negative: data)
+        self.hits = 0
+        self.misses = 0
+        # Lookups that haven't been found in the memory, but in the store.
+        self.store_hits = 0
+        self._entries : "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self._pending : Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key : Hashable) -> bool:
+        return self.get(key) is not None
+
+    def items(self) -> Iterator[Tuple[Hashable, CacheEntry]]:
+        return iter(list(self._entries.items()))
+
+    def peek(self, key : Hashable) -> Optional[CacheEntry]:
+        """
+        Gets the entry even if it has been expired.
+        """
+        return self._entries.get(key, None)
+
+    def get(self, key : Hashable) -> Optional[CacheEntry]:
+        """
+        Gets the entry if it is not expired yet.
+        """
+        entry = self._entries.get(key, None)
+        if (entry is None) or (not entry.fresh):
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def set(
+        self,
+        key : Hashable,
+        value : Any,
+        negative : bool = False,
+        ttl : Optional[float] = None,
+        etag : Optional[str] = None,
+        last_modified : Optional[str] = None
+    ) -> CacheEntry:
+        if ttl is None:
+            ttl = self.negative_ttl if negative else self.ttl
+        entry = CacheEntry(value, time.monotonic() + ttl, negative, etag, last_modified)
+        if self.maxsize <= 0:
+            return entry
+        self._insert(key, entry)
+        if self.store is not None:
+            self._save(key, entry, ttl)
+        return entry
+
+    def _insert(self, key : Hashable, entry : CacheEntry) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last = False)
+
+    def _save(self, key : Hashable, entry : CacheEntry, ttl : float) -> None:
+        save = partial(
+            self.store.set, self.namespace, key, self.encode(entry.value, entry.negative), ttl, 
+            negative = entry.negative, etag = entry.etag, last_modified = entry.last_modified
+        )
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            save()
+            return
+        # Saving is best effort, the entry is still in the memory if it fails.
+        loop.run_in_executor(None, save).add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    async def delete(self, key : Hashable) -> bool:
+        """
+        Removes the entry from the memory and the store, and returns True if it has been found in any of them.
+        """
+        stored = 0
+        if self.store is not None:
+            stored = await asyncio.get_running_loop().run_in_executor(None, self.store.delete, self.namespace, [key])
+        return (self._entries.pop(key, None) is not None) or (stored > 0)
+
+    async def clear(self) -> int:
+        """
+        Removes all entries, and returns the number of them. If there is a store, it is the number of
+        entries removed from the store, as it also has the entries that other workers have saved.
+        """
+        purged = len(self._entries)
+        if self.store is not None:
+            purged = await asyncio.get_running_loop().run_in_executor(None, self.store.clear, self.namespace)
+        self._entries.clear()
+        return purged
+
+    async def fetch(
+        self,
+        key : Hashable,
+        loader : Callable[[Optional[CacheEntry]], Awaitable[CacheEntry]]
+    ) -> CacheEntry:
+        """
+        Gets the entry from the cache, or calls the loader with the expired entry (if any) to create a new one.
+        Concurrent calls for the same key waits for the same loader instead of calling it again.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        task = self._pending.get(key, None)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, loader))
+            self._pending[key] = task
+            task.add_done_callback(lambda t: self._loaded(key, t))
+        # Loader keeps running even if the request that started it is cancelled,
+        # so other requests waiting for the same key are not affected.
+        return await asyncio.shield(task)
+
+    async def _load(
+        self, 
+        key : Hashable, 
+        loader : Callable[[Optional[CacheEntry]], Awaitable[CacheEntry]]
+    ) -> CacheEntry:
+        stale = self.peek(key)
+        if (self.store is not None) and (self.maxsize > 0):
+            # Another worker or a previous run may have loaded it already.
+            stored = await asyncio.get_running_loop().run_in_executor(None, self.store.get, self.namespace, key)
+            if stored is not None:
+                try:
+                    entry = CacheEntry(
+                        self.decode(stored.data, stored.negative), time.monotonic() + stored.ttl, 
+                        stored.negative, stored.etag, stored.last_modified
+                    )
+                except (TypeError, ValueError, KeyError, IndexError):
+                    entry = None
+                if (entry is not None) and entry.fresh:
+                    self.store_hits += 1
+                    self._insert(key, entry)
+                    return entry
+                # Revalidate the stored entry if it is newer than the one in the memory.
+                if (entry is not None) and ((stale is None) or (stale.expires < entry.expires)):
+                    stale = entry
+        return await loader(stale)
+
+    def _loaded(self, key : Hashable, task : asyncio.Task) -> None:
+        if self._pending.get(key, None) is task:
+            del self._pending[key]
+        # Mark the exception as retrieved, in case nobody is waiting for it.
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,181 @@
+__all__ = [
+    "KiesClient"
+]
+
+import asyncio
+import random
+import time
+from typing import Dict, Optional
+import httpx
+from samfetch.hedge import HedgePolicy
+from samfetch.limiter import LimiterGroup
+from samfetch.metrics import HEDGED_REQUESTS, RETRIED_REQUESTS, UPSTREAM_LATENCY, upstream_call
+
+
+class KiesClient(httpx.AsyncClient):
+    """
+    A long-living HTTP client that is shared between all requests made to Kies servers,
+    so connections (and TLS handshakes) are pooled and kept alive between API calls.
+    Firmware downloads hold their connection for minutes, so they have a separate pool limited with
+    "max_download_connections", and metadata calls don't wait for a connection behind them.
+    A metadata call fails if it can't get a connection in "pool_timeout" seconds.
+
+    If limiters have given, concurrent requests to each Kies endpoint are limited with its own limiter.
+
+    Metadata calls can be sent again without side effects, so they are retried up to "retries" times
+    on network errors and timeouts, after waiting a random time up to "retry_backoff" seconds (doubled after
+    each attempt). If "hedge_percentile" is set, a second attempt is sent when the first one is slower than
+    that percentile of the recent calls, up to "hedge_budget" share of the calls, and the first response is used.
+    """
+
+    # Calls that are safe to send more than once, as named in UPSTREAM_CALLS.
+    IDEMPOTENT_CALLS = ("nonce", "version_xml", "binary_inform")
+
+    # Errors that a new attempt may not get.
+    RETRY_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+    def __init__(
+        self,
+        max_connections : int = 100,
+        max_keepalive_connections : int = 20,
+        keepalive_expiry : float = 30,
+        connect_timeout : float = 5,
+        read_timeout : float = 5,
+        pool_timeout : float = 10,
+        max_download_connections : int = 0,
+        http2 : bool = True,
+        max_host_connections : int = 0,
+        limiters : Optional[LimiterGroup] = None,
+        retries : int = 2,
+        retry_backoff : float = 0.1,
+        hedge_percentile : float = 0,
+        hedge_budget : float = 0.1
+    ) -> None:
+        timeout = httpx.Timeout(read_timeout, connect = connect_timeout, pool = pool_timeout)
+        super().__init__(
+            http2 = http2,
+            limits = httpx.Limits(
+                max_connections = max_connections or None,
+                max_keepalive_connections = max_keepalive_connections or None,
+                keepalive_expiry = keepalive_expiry
+            ),
+            timeout = timeout
+        )
+        self.downloads = httpx.AsyncClient(
+            http2 = http2,
+            limits = httpx.Limits(
+                max_connections = max_download_connections or None,
+                max_keepalive_connections = max_keepalive_connections or None,
+                keepalive_expiry = keepalive_expiry
+            ),
+            timeout = timeout
+        )
+        self.max_host_connections = max_host_connections
+        self.limiters = limiters
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedges : Dict[str, HedgePolicy] = {}
+        self._host_slots : Dict[str, asyncio.Semaphore] = {}
+
+    def host_slot(self, url : httpx.URL) -> asyncio.Semaphore:
+        """
+        Gets the semaphore that limits the parallel downloads from the host of the URL,
+        so segmented downloads don't open too many connections to the same server.
+        """
+        if url.host not in self._host_slots:
+            self._host_slots[url.host] = asyncio.Semaphore(self.max_host_connections or 2 ** 31)
+        return self._host_slots[url.host]
+
+    def hedge_policy(self, call : str) -> Optional[HedgePolicy]:
+        if self.hedge_percentile <= 0:
+            return None
+        if call not in self.hedges:
+            self.hedges[call] = HedgePolicy(percentile = self.hedge_percentile, budget = self.hedge_budget)
+        return self.hedges[call]
+
+    async def send(self, request : httpx.Request, **kwargs) -> httpx.Response:
+        # Requests in KiesRequest are built without a client, so they don't
+        # carry the client timeouts, add them here instead.
+        if "timeout" not in request.extensions:
+            request.extensions["timeout"] = self.timeout.as_dict()
+        call = upstream_call(request.url.path)
+        # Downloads are resumed by the stream itself instead.
+        if (call not in self.IDEMPOTENT_CALLS) or kwargs.get("stream", False):
+            return await self._send_once(request, call, **kwargs)
+        attempt = 0
+        while True:
+            try:
+                return await self._send_hedged(request, call, **kwargs)
+            except self.RETRY_ERRORS:
+                if attempt >= self.retries:
+                    raise
+            # Random wait, so retries of the requests that failed together are not sent together again.
+            await asyncio.sleep(random.uniform(0, self.retry_backoff * (2 ** attempt)))
+            attempt += 1
+            RETRIED_REQUESTS.labels(call).inc()
+
+    async def _send_hedged(self, request : httpx.Request, call : str, **kwargs) -> httpx.Response:
+        policy = self.hedge_policy(call)
+        delay = None if policy is None else policy.delay()
+        if delay is None:
+            return await self._send_once(request, call, **kwargs)
+        attempts = [asyncio.ensure_future(self._send_once(request, call, **kwargs))]
+        try:
+            done, _ = await asyncio.wait(attempts, timeout = delay)
+            if done or (not policy.spend()):
+                return await attempts[0]
+            # Request is sent again as a copy, so both attempts don't share the same object.
+            attempts.append(asyncio.ensure_future(self._send_once(httpx.Request(
+                request.method, request.url, headers = request.headers, 
+                content = request.content, extensions = dict(request.extensions)
+            ), call, **kwargs)))
+            HEDGED_REQUESTS.labels(call).inc()
+            pending, error = set(attempts), None
+            # Use the first successful response, an error only counts if both attempts have failed.
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in attempts:
+                # Errors of the attempts that haven't been used are not raised, so mark them as retrieved.
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                if not task.done():
+                    task.cancel()
+
+    async def _send_once(self, request : httpx.Request, call : str, **kwargs) -> httpx.Response:
+        limiter = None if self.limiters is None else self.limiters.get(call)
+        if limiter is not None:
+            await limiter.acquire()
+        # Streamed responses return when the headers have been received, 
+        # so this is the time to first byte for downloads.
+        started = time.perf_counter()
+        try:
+            if call == "download":
+                response = await self.downloads.send(request, **kwargs)
+            else:
+                response = await super().send(request, **kwargs)
+        except httpx.TransportError:
+            if limiter is not None:
+                limiter.release(time.perf_counter() - started, failed = True)
+            raise
+        except BaseException:
+            if limiter is not None:
+                limiter.release()
+            raise
+        elapsed = time.perf_counter() - started
+        if limiter is not None:
+            limiter.release(elapsed, failed = (response.status_code >= 500) or (response.status_code == 429))
+        UPSTREAM_LATENCY.labels(call).observe(elapsed)
+        if call in self.hedges:
+            self.hedges[call].observe(elapsed)
+        return response
+
+    async def aclose(self) -> None:
+        await self.downloads.aclose()
+        await super().aclose()
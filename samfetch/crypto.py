@@ -1,12 +1,23 @@
 __all__ = [
     "start_decryptor",
+    "decrypt_chunks",
+    "decrypt_timed",
+    "BufferPool",
     "Crypto"
 ]
 
+import asyncio
 import base64
-from typing import Any, AsyncIterator, Generator, Optional, Tuple
+import time
+from concurrent.futures import Executor
+from functools import partial
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Dict, Generator, List, Optional, Tuple
 from Crypto.Cipher import AES
 from sanic.response import BaseHTTPResponse
+from samfetch.metrics import ACTIVE_STREAMS, DECRYPTED_BYTES, DECRYPT_SECONDS, STREAMED_BYTES
+
+if TYPE_CHECKING:
+    from samfetch.budget import Reservation
 
 
 # has_next() function
@@ -24,25 +35,238 @@ async def has_next(it) -> Generator[Tuple[bool, Any], None, None]:
         yield False, prev
 
 
-async def start_decryptor(response : BaseHTTPResponse, iterator : AsyncIterator, key : Optional[bytes] = None, client : Optional[Any] = None):
-    if key:
-        cipher = AES.new(key, AES.MODE_ECB)
-        async for continues, chunk in has_next(iterator):
-            # Decrypt chunk
-            data = cipher.decrypt(chunk)
-            if continues:
-                await response.send(data)
+def decrypt_timed(cipher : Any, data : Any, output : Any = None) -> Optional[bytes]:
+    """
+    Decrypts the data and records the time spent for it. 
+    It is called in the executor, so the time doesn't include waiting for a free thread.
+    """
+    started = time.perf_counter()
+    result = cipher.decrypt(data, output = output)
+    DECRYPT_SECONDS.inc(time.perf_counter() - started)
+    DECRYPTED_BYTES.inc(len(data))
+    return result
+
+
+async def decrypt_chunks(iterator : AsyncIterator, key : bytes, executor : Optional[Executor] = None) -> AsyncIterator[bytes]:
+    """
+    Decrypts the chunks in the executor, and removes the padding from the last chunk.
+    """
+    loop = asyncio.get_running_loop()
+    cipher = AES.new(key, AES.MODE_ECB)
+    async for continues, chunk in has_next(iterator):
+        data = await loop.run_in_executor(executor, decrypt_timed, cipher, chunk)
+        yield data if continues else Crypto.unpad(data)
+
+
+class BufferPool:
+    """
+    Keeps buffers for decrypting chunks in place, so they are reused between chunks and downloads
+    instead of allocating new ones for each chunk. Buffers are created when the pool is empty,
+    and at most "count" idle buffers are kept. Buffers are "size" bytes unless another size is asked,
+    as downloads with a memory budget change their chunk size while streaming.
+    """
+
+    def __init__(self, size : int, count : int) -> None:
+        # Buffers must contain whole blocks, so they can be decrypted on their own.
+        self.size = max(size - (size % 16), 16)
+        self.count = count
+        self._free : Dict[int, List[bytearray]] = {}
+        self._idle = 0
+
+    @property
+    def idle(self) -> int:
+        return self._idle
+
+    def acquire(self, size : Optional[int] = None) -> bytearray:
+        free = self._free.get(size or self.size, None)
+        if free:
+            self._idle -= 1
+            return free.pop()
+        return bytearray(size or self.size)
+
+    def release(self, buffer : bytearray) -> None:
+        if (len(buffer) % 16 == 0) and (self._idle < self.count):
+            self._free.setdefault(len(buffer), []).append(buffer)
+            self._idle += 1
+
+
+async def fill_buffers(
+    iterator : AsyncIterator, 
+    pool : BufferPool, 
+    size : Optional[Callable[[], int]] = None
+) -> AsyncIterator[Tuple[bool, bytearray, int]]:
+    """
+    Copies the chunks to buffers from the pool, and yields each buffer when it is full, 
+    with whether if more buffers follow it and how many bytes it has. Bytes that don't fit 
+    are carried over to the next buffer, so buffers always start at a block boundary, 
+    whatever the size of the chunks are. If "size" has given, it is called to get the size of each new buffer.
+    """
+    buffer, used = pool.acquire(size and size()), 0
+    # Last full buffer is held back until it is known if it is the last one.
+    pending : Optional[Tuple[bytearray, int]] = None
+    try:
+        async for chunk in iterator:
+            view = memoryview(chunk)
+            while view:
+                count = min(len(view), len(buffer) - used)
+                buffer[used:used + count] = view[:count]
+                used += count
+                view = view[count:]
+                if used == len(buffer):
+                    if pending:
+                        yield (True, *pending)
+                    pending, buffer, used = (buffer, used), None, 0
+                    buffer = pool.acquire(size and size())
+        if used:
+            if pending:
+                yield (True, *pending)
+            pending, buffer = (buffer, used), None
+        if pending:
+            yield (False, *pending)
+    finally:
+        if buffer is not None:
+            pool.release(buffer)
+
+
+async def rechunk(iterator : AsyncIterator, size : Callable[[], int]) -> AsyncIterator[bytes]:
+    """
+    Joins or splits the chunks, so each of them (except the last one) has the size
+    returned from "size" at the time it has been created.
+    """
+    pieces, length = [], 0
+    async for piece in iterator:
+        while piece:
+            needed = size() - length
+            if len(piece) < needed:
+                pieces.append(piece)
+                length += len(piece)
+                break
+            # Only split the piece that completes the chunk, so each chunk is copied once when joining.
+            pieces.append(piece[:needed])
+            piece = piece[needed:]
+            yield b"".join(pieces)
+            pieces, length = [], 0
+    if pieces:
+        yield b"".join(pieces)
+
+
+def is_written(response : BaseHTTPResponse) -> bool:
+    """
+    Checks if all data sent to the response has been passed to the socket, 
+    so the buffers it came from can be reused.
+    """
+    transport = getattr(getattr(response.stream, "protocol", None), "transport", None)
+    return (transport is not None) and (transport.get_write_buffer_size() == 0)
+
+
+async def start_decryptor(
+    response : BaseHTTPResponse, 
+    iterator : AsyncIterator, 
+    key : Optional[bytes] = None,
+    executor : Optional[Executor] = None,
+    queue_size : int = 1,
+    skip : int = 0,
+    length : Optional[int] = None,
+    unpad : bool = True,
+    pool : Optional[BufferPool] = None,
+    plain : bool = False,
+    reservation : Optional["Reservation"] = None
+):
+    """
+    Streams the chunks to the response while decrypting them if a key has given.
+    Reading, decrypting and sending runs concurrently, connected with bounded queues,
+    so a slow client stops reading from upstream instead of filling the memory.
+    Decryption runs in the executor (pycryptodome releases the GIL), so the event loop is not blocked.
+
+    For partial downloads, first "skip" bytes are dropped and only "length" bytes are sent. 
+    Padding is removed from the last chunk only if "unpad" is True, as the iterator may not end with the last block.
+
+    If a buffer pool has given, chunks are copied to buffers from the pool and decrypted in place, 
+    then buffers are given back to the pool after they have been sent.
+
+    "plain" tells that the chunks have already been decrypted, which is only used for metrics.
+
+    If a memory budget reservation has given, chunks are resized to its chunk size, and the time 
+    spent for sending each chunk is reported to it, so it can change the chunk size for the next ones.
+    """
+    loop = asyncio.get_running_loop()
+    cipher = None if not key else AES.new(key, AES.MODE_ECB)
+    encrypted = asyncio.Queue(queue_size)
+    decrypted = asyncio.Queue(queue_size)
+    pool = None if not cipher else pool
+    chunk_size = None if reservation is None else (lambda: reservation.chunk_size)
+
+    # Each stage puts None to its queue when it is done, 
+    # or the exception if it has failed, so next stage can stop too.
+    async def read():
+        try:
+            if pool:
+                async for continues, buffer, used in fill_buffers(iterator, pool, chunk_size):
+                    await encrypted.put((continues, memoryview(buffer)[:used], buffer))
             else:
-                await response.send(Crypto.unpad(data))
-        if client:
-            await client.aclose()
-        await response.eof()
-    else:
-        async for i in iterator:
-            await response.send(i)
-        if client:
-            await client.aclose()
-        await response.eof()
+                async for continues, chunk in has_next(iterator if chunk_size is None else rechunk(iterator, chunk_size)):
+                    await encrypted.put((continues, chunk, None))
+            await encrypted.put(None)
+        except Exception as e:
+            await encrypted.put(e)
+
+    async def decrypt():
+        skip_left, length_left = skip, length
+        try:
+            while True:
+                item = await encrypted.get()
+                if (item is None) or isinstance(item, Exception):
+                    await decrypted.put(item)
+                    return
+                continues, chunk, buffer = item
+                if buffer is not None:
+                    await loop.run_in_executor(executor, partial(decrypt_timed, cipher, chunk, output = chunk))
+                elif cipher:
+                    chunk = await loop.run_in_executor(executor, decrypt_timed, cipher, chunk)
+                if cipher and (not continues) and unpad:
+                    chunk = Crypto.unpad(chunk)
+                # Trim the chunk to the requested range.
+                if skip_left:
+                    dropped = min(skip_left, len(chunk))
+                    chunk = chunk[dropped:]
+                    skip_left -= dropped
+                if length_left is not None:
+                    chunk = chunk[:length_left]
+                    length_left -= len(chunk)
+                if chunk:
+                    await decrypted.put((chunk, buffer))
+                elif buffer is not None:
+                    pool.release(buffer)
+                if length_left == 0:
+                    await decrypted.put(None)
+                    return
+        except Exception as e:
+            await decrypted.put(e)
+
+    sent = STREAMED_BYTES.labels("decrypted" if (cipher or plain) else "encrypted")
+    tasks = [asyncio.create_task(read()), asyncio.create_task(decrypt())]
+    ACTIVE_STREAMS.inc()
+    try:
+        while True:
+            data = await decrypted.get()
+            if data is None:
+                break
+            if isinstance(data, Exception):
+                raise data
+            chunk, buffer = data
+            started = time.perf_counter()
+            await response.send(chunk)
+            if reservation is not None:
+                reservation.sent(len(chunk), time.perf_counter() - started)
+            sent.inc(len(chunk))
+            # Transport may still refer to the buffer if it couldn't write everything at once.
+            if (buffer is not None) and is_written(response):
+                pool.release(buffer)
+    finally:
+        ACTIVE_STREAMS.dec()
+        for task in tasks:
+            task.cancel()
+    await response.eof()
 
 
 # Source:
@@ -60,6 +284,11 @@ class Crypto:
     def unpad(inp):
         return inp[:-inp[-1]]
 
+    # Checks if the data ends with a valid PKCS#7 padding, which is not the case when decrypted with a wrong key.
+    @staticmethod
+    def padded(inp, block_size = 16):
+        return (len(inp) > 0) and (1 <= inp[-1] <= block_size) and (inp[-inp[-1]:] == bytes([inp[-1]]) * inp[-1])
+
     @staticmethod
     def pad(inp):
         return inp + bytes([16 - (len(inp) % 16)]) * (16 - (len(inp) % 16))
@@ -0,0 +1,257 @@
+__all__ = [
+    "SharedStream",
+    "Subscription",
+    "FanoutHub"
+]
+
+import asyncio
+from collections import deque
+from concurrent.futures import Executor
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, Optional, Set, Tuple
+from samfetch.budget import Reservation
+from samfetch.crypto import decrypt_chunks
+from samfetch.stream import FirmwareStream
+
+
+class SharedStream:
+    """
+    Reads a whole firmware file once, and shares the (decrypted, if a key has given) chunks with
+    many downloads of the same file. Chunks are dropped as soon as all downloads have read them,
+    except the beginning of the file, which is kept until the buffer is full, so downloads that
+    start a bit later can still catch up from the beginning.
+
+    Reading from upstream follows the fastest download. When the buffer is full, chunks that
+    slow downloads haven't read yet are dropped, and these downloads continue with their own
+    upstream stream created with the "fallback" function.
+    If a reservation has given, it is the memory reserved for the buffer, and released with the source.
+    """
+
+    def __init__(
+        self,
+        source : FirmwareStream,
+        iterator : AsyncIterator[bytes],
+        capacity : int,
+        key : Optional[bytes] = None,
+        executor : Optional[Executor] = None,
+        fallback : Optional[Callable[[int], Awaitable[FirmwareStream]]] = None,
+        on_close : Optional[Callable[["SharedStream"], None]] = None,
+        reservation : Optional[Reservation] = None
+    ) -> None:
+        self.source = source
+        self.capacity = capacity
+        self.reservation = reservation
+        self.key = key
+        self.executor = executor
+        self.fallback = fallback
+        self.on_close = on_close
+        self.done = False
+        self.error : Optional[BaseException] = None
+        # Buffered chunks, and the offset of the first chunk in the file.
+        self._chunks : Deque[bytes] = deque()
+        self._offset = 0
+        self._buffered = 0
+        self._subscribers : Set["Subscription"] = set()
+        self._changed = asyncio.Condition()
+        self._closed = False
+        self._iterator = iterator if (not key) or source.decrypted else decrypt_chunks(iterator, key, executor)
+        self._task = asyncio.create_task(self._produce())
+
+    @property
+    def produced(self) -> int:
+        return self._offset + self._buffered
+
+    @property
+    def joinable(self) -> bool:
+        # New downloads can join only if the beginning of the file is still in the buffer.
+        return (self._offset == 0) and (self.error is None) and (not self._task.done())
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> "Subscription":
+        subscription = Subscription(self)
+        self._subscribers.add(subscription)
+        return subscription
+
+    async def unsubscribe(self, subscription : "Subscription") -> None:
+        self._subscribers.discard(subscription)
+        self._trim()
+        # Nobody is reading anymore, so stop downloading.
+        if not self._subscribers:
+            if self._task.done():
+                await self._close_source()
+            else:
+                self._task.cancel()
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _close_source(self) -> None:
+        # Source is kept open while there are downloads, as they may still read from it.
+        if not self._closed:
+            self._closed = True
+            await self.source.aclose()
+            if self.reservation is not None:
+                self.reservation.release()
+
+    def chunk_at(self, offset : int) -> Optional[bytes]:
+        position = self._offset
+        for chunk in self._chunks:
+            if position == offset:
+                return chunk
+            position += len(chunk)
+        return None
+
+    def _drop(self) -> None:
+        self._buffered -= len(self._chunks[0])
+        self._offset += len(self._chunks.popleft())
+
+    def _trim(self) -> None:
+        """
+        Drops the chunks that all downloads have read. Beginning of the file is kept while it fits
+        in the buffer, as new downloads can only join from there.
+        """
+        while self._chunks and self._subscribers:
+            if (self._offset == 0) and (self._buffered <= self.capacity):
+                return
+            if any(s.cursor < self._offset + len(self._chunks[0]) for s in self._subscribers):
+                return
+            self._drop()
+
+    def _evictable(self) -> bool:
+        if not self._chunks:
+            return False
+        first = self._offset + len(self._chunks[0])
+        # First chunk has been read by all downloads, or the fastest download is waiting for new chunks.
+        return all(s.cursor >= first for s in self._subscribers) or \
+            any(s.cursor == self.produced for s in self._subscribers)
+
+    async def _produce(self) -> None:
+        try:
+            async for chunk in self._iterator:
+                async with self._changed:
+                    while self._chunks and (self._buffered + len(chunk) > self.capacity):
+                        if self._evictable():
+                            self._drop()
+                        else:
+                            await self._changed.wait()
+                    self._chunks.append(chunk)
+                    self._buffered += len(chunk)
+                    self._trim()
+                    self._changed.notify_all()
+            self.done = True
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.on_close:
+                self.on_close(self)
+            async with self._changed:
+                self._changed.notify_all()
+            if hasattr(self._iterator, "aclose"):
+                await self._iterator.aclose()
+            if not self._subscribers:
+                await self._close_source()
+
+
+class Subscription(FirmwareStream):
+    """
+    A download that reads the chunks of a SharedStream from its own position.
+    """
+
+    def __init__(self, shared : SharedStream) -> None:
+        super().__init__(200, 0, shared.source.total - 1, shared.source.total)
+        self.shared = shared
+        self.cursor = 0
+        # Chunks are already decrypted by the shared stream.
+        self.decrypted = shared.key is not None
+        self._fallback : Optional[FirmwareStream] = None
+
+    async def _next(self) -> Tuple[Optional[bytes], bool]:
+        # Returns the next chunk, and whether if the download has fallen behind the buffer.
+        shared = self.shared
+        async with shared._changed:
+            while (self.cursor == shared.produced) and (not shared.done) and (shared.error is None):
+                await shared._changed.wait()
+            if self.cursor < shared._offset:
+                return None, True
+            chunk = shared.chunk_at(self.cursor)
+            if chunk is not None:
+                self.cursor += len(chunk)
+                shared._trim()
+                shared._changed.notify_all()
+                return chunk, False
+            if shared.error is not None:
+                raise shared.error
+            return None, False
+
+    async def iterate(self, chunk_size : int) -> AsyncIterator[bytes]:
+        while True:
+            chunk, behind = await self._next()
+            if behind:
+                break
+            if chunk is None:
+                return
+            yield chunk
+        # Continue with a separate upstream stream from the current position.
+        await self.shared.unsubscribe(self)
+        self._fallback = await self.shared.fallback(self.cursor)
+        iterator = self._fallback.iterate(chunk_size)
+        if self.shared.key and (not self._fallback.decrypted):
+            iterator = decrypt_chunks(iterator, self.shared.key, self.shared.executor)
+        async for chunk in iterator:
+            yield chunk
+
+    async def read(self, offset : int, length : int) -> bytes:
+        return await self.shared.source.read(offset, length)
+
+    async def aclose(self) -> None:
+        await self.shared.unsubscribe(self)
+        if self._fallback:
+            await self._fallback.aclose()
+
+
+class FanoutHub:
+    """
+    Keeps the shared streams that new downloads can join, keyed by file and decryption key.
+    """
+
+    def __init__(self, capacity : int) -> None:
+        self.capacity = capacity
+        self._streams : Dict[Hashable, SharedStream] = {}
+        self._opening : Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    async def subscribe(
+        self,
+        name : Hashable,
+        opener : Callable[[], Awaitable[Tuple[FirmwareStream, AsyncIterator[bytes]]]],
+        **kwargs
+    ) -> Subscription:
+        """
+        Joins the shared stream of the file if the beginning of it is still buffered, 
+        otherwise opens a new one with the "opener" function. Keyword arguments are only used 
+        for opening a new one, so a "reservation" for its buffer is not taken when joining.
+        """
+        # Downloads that come while the stream is being opened wait for it, instead of opening another one.
+        while name in self._opening:
+            await asyncio.shield(self._opening[name])
+        shared = self._streams.get(name, None)
+        if (shared is not None) and shared.joinable:
+            return shared.subscribe()
+        opening = self._opening[name] = asyncio.get_running_loop().create_future()
+        try:
+            source, iterator = await opener()
+            shared = SharedStream(source, iterator, self.capacity, on_close = self._closed(name), **kwargs)
+            self._streams[name] = shared
+            return shared.subscribe()
+        finally:
+            del self._opening[name]
+            opening.set_result(None)
+
+    def _closed(self, name : Hashable) -> Callable[[SharedStream], None]:
+        def on_close(shared : SharedStream):
+            if self._streams.get(name, None) is shared:
+                del self._streams[name]
+        return on_close
@@ -0,0 +1,55 @@
+__all__ = [
+    "HedgePolicy"
+]
+
+from collections import deque
+from typing import Deque, Optional
+
+
+class HedgePolicy:
+    """
+    Decides when a second attempt of a request should be sent, if the first one hasn't been answered yet.
+    The delay is the "percentile" of the latencies of the last "window" responses, so only the slowest
+    requests are hedged. Each request adds "budget" (0.1 is 10%) to the hedges that can be made,
+    so the extra requests can't go over that share of the requests, even if the endpoint gets slow.
+    """
+
+    def __init__(
+        self,
+        percentile : float = 95,
+        budget : float = 0.1,
+        window : int = 200,
+        min_samples : int = 20,
+        max_tokens : float = 10
+    ) -> None:
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+        self.hedged = 0
+        self._latencies : Deque[float] = deque(maxlen = window)
+
+    def observe(self, latency : float) -> None:
+        self._latencies.append(latency)
+
+    def delay(self) -> Optional[float]:
+        """
+        Gets the seconds to wait before hedging a new request, or None if it shouldn't be hedged,
+        as there are not enough latencies to know what is slow yet.
+        """
+        self.tokens = min(self.tokens + self.budget, self.max_tokens)
+        if len(self._latencies) < self.min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(int(len(latencies) * self.percentile / 100), len(latencies) - 1)]
+
+    def spend(self) -> bool:
+        """
+        Takes a hedge from the budget, returns False if the budget has run out.
+        """
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.hedged += 1
+        return True
@@ -0,0 +1,191 @@
+__all__ = [
+    "FirmwareHistory"
+]
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from samfetch.kies import KiesFirmwareList, KiesUtils
+
+
+class FirmwareHistory:
+    """
+    An index of the firmwares that have been seen for each device, and the changes between the lists,
+    kept in a SQLite database (in WAL mode, so it can be shared between worker processes).
+    It is updated from the polled firmware lists, and queried without making requests to Kies servers.
+
+    Changes are "added" when a firmware appears in the list, "removed" when it disappears,
+    and "latest" when it becomes the latest firmware of the device.
+    """
+
+    def __init__(self, path : str = ":memory:", timeout : float = 5) -> None:
+        self.path = path
+        if (path != ":memory:") and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout = timeout, isolation_level = None, check_same_thread = False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(
+                "CREATE TABLE IF NOT EXISTS devices (" + \
+                "region TEXT NOT NULL, model TEXT NOT NULL, latest TEXT, etag TEXT, last_modified TEXT, checked REAL, " + \
+                "PRIMARY KEY (region, model)) WITHOUT ROWID;" + \
+                "CREATE TABLE IF NOT EXISTS firmwares (" + \
+                "region TEXT NOT NULL, model TEXT NOT NULL, firmware TEXT NOT NULL, pda TEXT, " + \
+                "first_seen REAL NOT NULL, last_seen REAL NOT NULL, removed REAL, " + \
+                "PRIMARY KEY (region, model, firmware)) WITHOUT ROWID;" + \
+                "CREATE TABLE IF NOT EXISTS changes (" + \
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL NOT NULL, region TEXT NOT NULL, model TEXT NOT NULL, " + \
+                "firmware TEXT NOT NULL, kind TEXT NOT NULL);" + \
+                "CREATE INDEX IF NOT EXISTS changes_time ON changes (time);"
+            )
+
+    @staticmethod
+    def describe_pda(firmware : str) -> Optional[str]:
+        try:
+            return json.dumps(KiesUtils.read_firmware_dict(firmware))
+        except (ValueError, IndexError):
+            return None
+
+    def validators(self, region : str, model : str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Gets the ETag and Last-Modified of the last firmware list of the device, for making a conditional request.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT etag, last_modified FROM devices WHERE region = ? AND model = ?", (region, model)
+            ).fetchone()
+        return (None, None) if row is None else row
+
+    def checked(self, region : str, model : str, when : Optional[float] = None) -> None:
+        """
+        Records that the firmware list of the device hasn't been changed.
+        """
+        with self._lock:
+            self._connection.execute(
+                "UPDATE devices SET checked = ? WHERE region = ? AND model = ?",
+                (when or time.time(), region, model)
+            )
+
+    def update(
+        self,
+        region : str,
+        model : str,
+        firmwares : KiesFirmwareList,
+        etag : Optional[str] = None,
+        last_modified : Optional[str] = None,
+        when : Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Compares the firmware list with the previous one of the device,
+        saves the differences and returns them.
+        """
+        when = when or time.time()
+        latest = firmwares.latest if firmwares.exists else None
+        current = ([latest] + firmwares.alternate) if latest else []
+        changes = []
+        with self._lock:
+            db = self._connection
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                previous = db.execute("SELECT latest FROM devices WHERE region = ? AND model = ?", (region, model)).fetchone()
+                known = {
+                    firmware: removed for firmware, removed in db.execute(
+                        "SELECT firmware, removed FROM firmwares WHERE region = ? AND model = ?", (region, model)
+                    )
+                }
+                for firmware in current:
+                    if (firmware not in known) or (known[firmware] is not None):
+                        changes.append((firmware, "added"))
+                    if firmware not in known:
+                        db.execute(
+                            "INSERT INTO firmwares VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                            (region, model, firmware, self.describe_pda(firmware), when, when)
+                        )
+                    else:
+                        db.execute(
+                            "UPDATE firmwares SET last_seen = ?, removed = NULL WHERE region = ? AND model = ? AND firmware = ?",
+                            (when, region, model, firmware)
+                        )
+                for firmware in set(x for x, removed in known.items() if removed is None) - set(current):
+                    changes.append((firmware, "removed"))
+                    db.execute(
+                        "UPDATE firmwares SET removed = ? WHERE region = ? AND model = ? AND firmware = ?",
+                        (when, region, model, firmware)
+                    )
+                if latest and ((previous is None) or (previous[0] != latest)):
+                    changes.append((latest, "latest"))
+                db.execute(
+                    "INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?)",
+                    (region, model, latest, etag, last_modified, when)
+                )
+                db.executemany(
+                    "INSERT INTO changes (time, region, model, firmware, kind) VALUES (?, ?, ?, ?, ?)",
+                    [(when, region, model, firmware, kind) for firmware, kind in changes]
+                )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return [
+            {"time": when, "region": region, "model": model, "firmware": firmware, "kind": kind}
+            for firmware, kind in changes
+        ]
+
+    def history(self, region : str, model : str) -> Optional[Dict[str, Any]]:
+        """
+        Gets the firmwares that have been seen for the device, newest first, or None if the device is not known.
+        """
+        with self._lock:
+            device = self._connection.execute(
+                "SELECT latest, checked FROM devices WHERE region = ? AND model = ?", (region, model)
+            ).fetchone()
+            if device is None:
+                return None
+            rows = self._connection.execute(
+                "SELECT firmware, pda, first_seen, last_seen, removed FROM firmwares " + \
+                "WHERE region = ? AND model = ? ORDER BY first_seen DESC, firmware DESC", (region, model)
+            ).fetchall()
+        return {
+            "region": region,
+            "model": model,
+            "latest": device[0],
+            "checked": device[1],
+            "firmwares": [
+                {
+                    "firmware": firmware,
+                    "pda": None if pda is None else json.loads(pda),
+                    "first_seen": first_seen,
+                    "last_seen": last_seen,
+                    "removed": removed
+                } for firmware, pda, first_seen, last_seen, removed in rows
+            ]
+        }
+
+    def changes(self, after : int = 0, limit : int = 1000, since : float = 0) -> List[Dict[str, Any]]:
+        """
+        Gets the changes after the change with the given id (and after the given time, if any), oldest first.
+        Changes of the same poll share the same time, so the id of the last change should be used for the next page.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, time, region, model, firmware, kind FROM changes WHERE id > ? AND time > ? ORDER BY id LIMIT ?",
+                (after, since, limit)
+            ).fetchall()
+        return [
+            {"id": id, "time": when, "region": region, "model": model, "firmware": firmware, "kind": kind}
+            for id, when, region, model, firmware, kind in rows
+        ]
+
+    def devices(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._connection.execute("SELECT region, model, latest, checked FROM devices ORDER BY region, model").fetchall()
+        return [{"region": r, "model": m, "latest": l, "checked": c} for r, m, l, c in rows]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -8,26 +8,59 @@ __all__ = [
 ]
 
 from collections import UserDict
-from typing import List, Tuple, Dict, Any, Optional
-import dicttoxml
-import xmltodict
+from typing import List, Tuple, Dict, Any, Optional, Union
+from xml.etree import ElementTree
 import re
 import httpx
 import string
 from samfetch.session import Session
 
 
+def element_text(element : Optional[ElementTree.Element]) -> Optional[str]:
+    """
+    Gets the text of the element without surrounding whitespace, or None if it is empty or missing.
+    """
+    if element is None:
+        return None
+    return (element.text or "").strip() or None
+
+
+def field_values(element : Optional[ElementTree.Element]) -> Dict[str, Optional[str]]:
+    """
+    Reads the child elements of a FUSBody node as a dictionary. Values are read from 
+    the "Data" element of the field if there is one, otherwise from the text of the field.
+    """
+    if element is None:
+        return {}
+    output = {}
+    for field in element:
+        data = field.find("Data")
+        output[field.tag] = element_text(field if data is None else data)
+    return output
+
+
 class KiesFirmwareList:
     """
     Parses firmware list.
     """
-    def __init__(self, data : Dict) -> None:
-        self._data = data
-        self._versions = None if ("versioninfo" not in self._data) else self._data["versioninfo"]["firmware"]["version"]
+
+    __slots__ = ("_versions", )
+
+    def __init__(self, latest : Optional[str], upgrade : List[str], found : bool = True) -> None:
+        # Raw values of "latest" and "upgrade" fields, None if the version info couldn't be found.
+        self._versions : Optional[Tuple[Optional[str], Tuple[str, ...]]] = (latest, tuple(upgrade)) if found else None
 
     @classmethod
-    def from_xml(cls, xml : str) -> "KiesFirmwareList":
-        return cls(xmltodict.parse(xml, dict_constructor = dict))
+    def from_xml(cls, xml : Union[str, bytes]) -> "KiesFirmwareList":
+        # Only read the fields that are used, instead of converting the whole document.
+        root = ElementTree.fromstring(xml)
+        versions = root.find("firmware/version") if root.tag == "versioninfo" else None
+        if versions is None:
+            return cls(None, [], found = False)
+        return cls(
+            element_text(versions.find("latest")),
+            [x for x in map(element_text, versions.iterfind("upgrade/value")) if x]
+        )
 
     @property
     def exists(self) -> bool:
@@ -37,30 +70,17 @@ class KiesFirmwareList:
 
     @property
     def latest(self) -> Optional[str]:
-        # The are cases that "latest" key may return a dictionary or just a string in different regions and models.
-        # If the "latest" field is dictionary, get the inner text, otherwise get its value directly.
-        if "latest" not in self._versions:
+        # Text of the "latest" field, some regions and models have attributes on it and some don't.
+        if (self._versions == None) or (not self._versions[0]):
             return None
-        elif isinstance(self._versions["latest"], str):
-            return KiesUtils.parse_firmware(self._versions["latest"])
-        elif isinstance(self._versions["latest"], dict):
-            return KiesUtils.parse_firmware(self._versions["latest"]["#text"])
-        return None
+        return KiesUtils.parse_firmware(self._versions[0])
 
     @property
     def alternate(self) -> List[str]:
         # Some devices may contain alternate/older versions too, so include them with the response.
-        upgrade = self._versions["upgrade"]["value"]
-        # No alternate versions.
-        if upgrade == None:
+        if self._versions == None:
             return []
-        # Multiple alternate versions.
-        elif isinstance(upgrade, list):
-            return [KiesUtils.parse_firmware(x["#text"]) for x in upgrade if x["#text"].count("/") > 1]
-        # Single alternate version.
-        elif isinstance(upgrade, dict):
-            return [KiesUtils.parse_firmware(upgrade["#text"])] if upgrade["#text"].count("/") > 1 else []
-        return []
+        return [KiesUtils.parse_firmware(x) for x in self._versions[1] if x.count("/") > 1]
 
 
 class KiesDict(UserDict):
@@ -87,28 +107,78 @@ class KiesData:
     A class that holds Kies server responses.
     """
 
-    def __init__(self, data : Dict) -> None:
-        self._data = data
+    __slots__ = ("_body", "_results", "_session_id")
+
+    def __init__(self, body : Dict[str, Optional[str]], results : Dict[str, Optional[str]], session_id : Optional[str] = None) -> None:
+        self._body = KiesDict(body)
+        self._results = KiesDict(results)
+        self._session_id = session_id
 
     @classmethod
-    def from_xml(cls, xml : str) -> "KiesData":
-        return cls(xmltodict.parse(xml, dict_constructor = dict))
+    def from_xml(cls, xml : Union[str, bytes]) -> "KiesData":
+        # Only read the fields that are used, instead of converting the whole document.
+        root = ElementTree.fromstring(xml)
+        return cls(
+            body = field_values(root.find("FUSBody/Put")),
+            results = field_values(root.find("FUSBody/Results")),
+            session_id = element_text(root.find("FUSHdr/SessionID"))
+        )
 
     @property
     def body(self) -> "KiesDict":
-        return KiesDict(self._data["FUSMsg"]["FUSBody"].get("Put", {}))
+        return self._body
 
     @property
     def results(self) -> "KiesDict":
-        return KiesDict(self._data["FUSMsg"]["FUSBody"]["Results"])
+        return self._results
 
     @property
     def status_code(self) -> int:
-        return int(self._data["FUSMsg"]["FUSBody"]["Results"]["Status"])
+        return int(self._results["Status"])
 
     @property
-    def session_id(self) -> str:
-        return self._data["FUSMsg"]["FUSHdr"]["SessionID"]
+    def session_id(self) -> Optional[str]:
+        return self._session_id
+
+
+def escape_xml(value : Any) -> str:
+    """
+    Converts the value to XML text in the same way as dicttoxml.
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value).replace("&", "&amp;").replace('"', "&quot;").replace("'", "&apos;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def fus_template(fields : List[Tuple[str, Optional[str]]]) -> str:
+    """
+    Creates the template of a FUS request body with given "Put" fields, which is filled with str.format().
+    Fields with a None value are left as placeholders, in the given order.
+    """
+    put = "".join(
+        f"<{name}><Data>{'{}' if value is None else escape_xml(value).replace('{', '{{').replace('}', '}}')}</Data></{name}>"
+        for name, value in fields
+    )
+    return f"<FUSMsg><FUSHdr><ProtoVer>1.0</ProtoVer></FUSHdr><FUSBody><Put>{put}</Put></FUSBody></FUSMsg>"
+
+
+# Request bodies are created from these templates, instead of serializing a dictionary for each request.
+BINARY_INFO_TEMPLATE = fus_template([
+    ("ACCESS_MODE", "2"),
+    ("BINARY_NATURE", "1"),
+    ("CLIENT_PRODUCT", "Smart Switch"),
+    ("DEVICE_FW_VERSION", None),
+    ("DEVICE_LOCAL_CODE", None),
+    ("DEVICE_MODEL_NAME", None),
+    ("LOGIC_CHECK", None)
+])
+
+BINARY_FILE_TEMPLATE = fus_template([
+    ("BINARY_FILE_NAME", None),
+    ("LOGIC_CHECK", None)
+])
 
 
 class KiesConstants:
@@ -142,43 +212,18 @@ class KiesConstants:
             "User-Agent": "Kies2.0_FUS"
         }
 
-    COOKIES = lambda session_id = None: \
-        {
-            "JSESSIONID": session_id or ""
-        }
+    # Session cookie as a header, which is faster to send than a cookie jar.
+    COOKIE_HEADER = lambda session_id = None: "JSESSIONID=" + (session_id or "")
     
     # Creates data for sending to BINARY_INFO_URL
     BINARY_INFO = lambda firmware_version, region, model, logic_check: \
-        dicttoxml.dicttoxml({
-            "FUSMsg": {
-                "FUSHdr": {"ProtoVer": "1.0"}, 
-                "FUSBody": {
-                    "Put": {
-                        "ACCESS_MODE": {"Data": "2"},
-                        "BINARY_NATURE": {"Data": "1"},
-                        "CLIENT_PRODUCT": {"Data": "Smart Switch"},
-                        "DEVICE_FW_VERSION": {"Data": firmware_version},
-                        "DEVICE_LOCAL_CODE": {"Data": region},
-                        "DEVICE_MODEL_NAME": {"Data": model},
-                        "LOGIC_CHECK": {"Data": logic_check}
-                    }
-                }
-            }
-        }, attr_type = False, root = False)
+        BINARY_INFO_TEMPLATE.format(
+            escape_xml(firmware_version), escape_xml(region), escape_xml(model), escape_xml(logic_check)
+        ).encode()
 
     # Creates data for sending to BINARY_FILE_URL
     BINARY_FILE = lambda filename, logic_check: \
-        dicttoxml.dicttoxml({
-            "FUSMsg": {
-                "FUSHdr": {"ProtoVer": "1.0"}, 
-                "FUSBody": {
-                    "Put": {
-                        "BINARY_FILE_NAME": {"Data": filename},
-                        "LOGIC_CHECK": {"Data": logic_check}
-                    }
-                }
-            }
-        }, attr_type = False, root = False)
+        BINARY_FILE_TEMPLATE.format(escape_xml(filename), escape_xml(logic_check)).encode()
 
 
 class KiesRequest:
@@ -195,10 +240,17 @@ class KiesRequest:
         )
 
     @staticmethod
-    def list_firmware(region : str, model : str) -> httpx.Request:
+    def list_firmware(region : str, model : str, etag : str = None, last_modified : str = None) -> httpx.Request:
+        # Conditional request headers, so server can tell if the list has changed since the last time.
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
         return httpx.Request(
             "GET",
-            KiesConstants.GET_FIRMWARE_URL.format(region, model)
+            KiesConstants.GET_FIRMWARE_URL.format(region, model),
+            headers = headers
         )
 
     @staticmethod
@@ -207,8 +259,10 @@ class KiesRequest:
             "POST",
             KiesConstants.BINARY_INFO_URL,
             content = KiesConstants.BINARY_INFO(firmware, region, model, session.logic_check(firmware)),
-            headers = KiesConstants.HEADERS(session.encrypted_nonce, session.auth),
-            cookies = KiesConstants.COOKIES(session.session_id)
+            headers = {
+                **KiesConstants.HEADERS(session.encrypted_nonce, session.auth),
+                "Cookie": KiesConstants.COOKIE_HEADER(session.session_id)
+            }
         )
 
     @staticmethod
@@ -219,20 +273,22 @@ class KiesRequest:
             "POST",
             KiesConstants.BINARY_FILE_URL,
             content = KiesConstants.BINARY_FILE(filename, session.logic_check(filename.split(".")[0][-16:])),
-            headers = KiesConstants.HEADERS(session.encrypted_nonce, session.auth),
-            cookies = KiesConstants.COOKIES(session.session_id)
+            headers = {
+                **KiesConstants.HEADERS(session.encrypted_nonce, session.auth),
+                "Cookie": KiesConstants.COOKIE_HEADER(session.session_id)
+            }
         )
 
     @staticmethod
     def start_download(path : str, session : Session, custom_range : str = None) -> httpx.Request:
         headers = KiesConstants.HEADERS(session.encrypted_nonce, session.auth)
+        headers["Cookie"] = KiesConstants.COOKIE_HEADER(session.session_id)
         if custom_range:
             headers["Range"] = custom_range
         return httpx.Request(
             "GET",
             KiesConstants.BINARY_DOWNLOAD_URL + "?file=" + path,
-            headers = headers,
-            cookies = KiesConstants.COOKIES(session.session_id)
+            headers = headers
         )
 
 
@@ -252,14 +308,33 @@ class KiesUtils:
 
     # Parse range header.
     # Returns two sized tuples, first one is start and second one is end. (-1 if invalid)
+    # End is None if the range is open-ended.
     @staticmethod
-    def parse_range_header(header: str) -> Tuple[int, int]:
+    def parse_range_header(header: str) -> Tuple[int, Optional[int]]:
         # Remove "bytes=" prefix.
         ran = header.strip().removeprefix("bytes=").split("-", maxsplit = 1)
         # Get range.
-        if len(ran) != 2:
+        if (len(ran) != 2) or (not ran[0].strip().isdigit()) or (ran[1].strip() and not ran[1].strip().isdigit()):
             return -1, -1
-        return int(ran[0] or 0), int(ran[1] or 0)
+        start, end = int(ran[0]), (int(ran[1]) if ran[1].strip() else None)
+        if (end is not None) and (end < start):
+            return -1, -1
+        return start, end
+
+    # Parse Content-Range header.
+    # Returns three sized tuples; start, end and total size. (None if invalid)
+    @staticmethod
+    def parse_content_range(header: str) -> Optional[Tuple[int, int, int]]:
+        match = re.match(r"^bytes (\d+)-(\d+)/(\d+)$", header.strip())
+        if not match:
+            return None
+        return int(match[1]), int(match[2]), int(match[3])
+
+    # Expands a range to AES block boundaries, so it can be decrypted independently
+    # as firmwares are encrypted with AES-ECB.
+    @staticmethod
+    def align_range(start : int, end : Optional[int], block_size : int = 16) -> Tuple[int, Optional[int]]:
+        return start - (start % block_size), (None if end is None else end - (end % block_size) + block_size - 1)
 
     # Joins strings together that includes slashes.
     @staticmethod
@@ -0,0 +1,192 @@
+__all__ = [
+    "UpstreamUnavailable",
+    "AdaptiveLimiter",
+    "LimiterGroup"
+]
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+import httpx
+
+
+class UpstreamUnavailable(httpx.TransportError):
+    """
+    Raised instead of sending a request when the circuit of the Kies endpoint is open,
+    or the request has waited too long for the limiter. It is a transport error,
+    so callers that retry or resume on network errors handle it in the same way.
+    """
+
+
+class AdaptiveLimiter:
+    """
+    Limits the concurrent requests to a Kies endpoint, and changes the limit from the latency and errors
+    of the responses (AIMD). While the latency stays under "tolerance" times the lowest seen latency,
+    the limit is increased by one for each "limit" responses, and it is multiplied with "backoff"
+    when the latency goes over it. Errors halve the limit.
+
+    Requests that go over the limit wait in a queue for "timeout" seconds at most. If "max_failures" requests fail
+    in a row, the circuit opens and requests fail at once for "cooldown" seconds. After that, a single request
+    is let through to test the endpoint, which closes the circuit if it succeeds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name : str,
+        initial : int = 8,
+        min_limit : int = 1,
+        max_limit : int = 64,
+        max_queue : int = 100,
+        timeout : float = 5,
+        tolerance : float = 2,
+        backoff : float = 0.9,
+        max_failures : int = 5,
+        cooldown : float = 10
+    ) -> None:
+        self.name = name
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.baseline : Optional[float] = None
+        self.failures = 0
+        self.circuit = self.CLOSED
+        self.opened = 0.0
+        self.rejected = 0
+        self.timed_out = 0
+        self._waiters : Deque[asyncio.Future] = deque()
+        self._probing = False
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def state(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "baseline": self.baseline,
+            "circuit": self.circuit,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out
+        }
+
+    def _reject(self, reason : str) -> UpstreamUnavailable:
+        self.rejected += 1
+        return UpstreamUnavailable(f"{self.name}: {reason}")
+
+    async def acquire(self) -> None:
+        """
+        Waits for a slot to send a request, or raises UpstreamUnavailable if the request can't be sent.
+        """
+        if self.circuit == self.OPEN:
+            if time.monotonic() - self.opened < self.cooldown:
+                raise self._reject("circuit is open")
+            self.circuit = self.HALF_OPEN
+        if self.circuit == self.HALF_OPEN:
+            # Only a single request tests the endpoint, others fail until it succeeds.
+            if self._probing:
+                raise self._reject("circuit is open")
+            self._probing = True
+            self.in_flight += 1
+            return
+        if (self.in_flight < int(self.limit)) and (not self._waiters):
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject("queue is full")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise self._reject("timed out in the queue")
+        except asyncio.CancelledError:
+            # The slot may have been given just before the request has been cancelled, so give it back.
+            if waiter.done() and (not waiter.cancelled()) and (waiter.exception() is None):
+                self.release()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, latency : Optional[float] = None, failed : bool = False) -> None:
+        """
+        Gives the slot back after the response (or the error) has been received. Latency is None
+        if the request has been cancelled, so it doesn't change the limit.
+        """
+        self.in_flight -= 1
+        if self.circuit == self.HALF_OPEN:
+            self._probing = False
+        if latency is not None:
+            if failed:
+                self._failed()
+            else:
+                self._succeeded(latency)
+        self._wake()
+
+    def _succeeded(self, latency : float) -> None:
+        self.failures = 0
+        self.circuit = self.CLOSED
+        # Lowest latency drifts up slowly, so it follows the endpoint if it gets slower permanently.
+        if (self.baseline is None) or (latency < self.baseline):
+            self.baseline = latency
+        else:
+            self.baseline += (latency - self.baseline) * 0.01
+        if latency > self.baseline * self.tolerance:
+            self.limit = max(self.limit * self.backoff, self.min_limit)
+        elif self.in_flight + 1 >= int(self.limit):
+            # Only grow when the limit is actually reached, otherwise it grows without being tested.
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def _failed(self) -> None:
+        self.failures += 1
+        self.limit = max(self.limit / 2, self.min_limit)
+        if (self.circuit == self.HALF_OPEN) or (self.failures >= self.max_failures):
+            self.circuit = self.OPEN
+            self.opened = time.monotonic()
+            # Requests in the queue would fail anyway, so let them fail now.
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_exception(self._reject("circuit is open"))
+
+    def _wake(self) -> None:
+        while self._waiters and (self.in_flight < int(self.limit)) and (self.circuit == self.CLOSED):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+class LimiterGroup:
+    """
+    Keeps a limiter for each Kies endpoint, which are created with the same options on their first use.
+    """
+
+    def __init__(self, **options) -> None:
+        self.options = options
+        self.limiters : Dict[str, AdaptiveLimiter] = {}
+
+    def get(self, name : str) -> AdaptiveLimiter:
+        limiter = self.limiters.get(name, None)
+        if limiter is None:
+            limiter = self.limiters[name] = AdaptiveLimiter(name, **self.options)
+        return limiter
+
+    def state(self) -> Dict[str, Dict[str, Any]]:
+        return {name: limiter.state() for name, limiter in self.limiters.items()}
@@ -0,0 +1,218 @@
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "REGISTRY",
+    "UPSTREAM_LATENCY",
+    "STREAMED_BYTES",
+    "DECRYPTED_BYTES",
+    "DECRYPT_SECONDS",
+    "ACTIVE_STREAMS",
+    "ERRORS",
+    "WATCH_POLLS",
+    "HEDGED_REQUESTS",
+    "RETRIED_REQUESTS",
+    "upstream_call",
+    "render"
+]
+
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class Metric:
+    """
+    A metric that is exposed in Prometheus text format, with an optional set of labels.
+    Values can be changed from any thread.
+    """
+
+    TYPE = "untyped"
+
+    def __init__(self, name : str, documentation : str, labels : Iterable[str] = (), registry : Optional[List["Metric"]] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children : Dict[Tuple[str, ...], "Metric"] = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.append(self)
+
+    def labels(self, *values : str) -> "Metric":
+        """
+        Gets the metric for given label values, which is created on the first use.
+        """
+        child = self._children.get(values, None)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._child())
+        return child
+
+    def _child(self) -> "Metric":
+        return type(self)(self.name, self.documentation)
+
+    def _samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        raise NotImplementedError
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        if not self.label_names:
+            return self._samples()
+        output = []
+        for values, child in list(self._children.items()):
+            labels = dict(zip(self.label_names, values))
+            output.extend((name, {**labels, **extra}, value) for name, extra, value in child._samples())
+        return output
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+
+    def inc(self, amount : float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def _samples(self):
+        return [(self.name, {}, self.value)]
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+
+    def inc(self, amount : float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount : float = 1) -> None:
+        self.inc(-amount)
+
+    def set(self, value : float) -> None:
+        self.value = value
+
+    def _samples(self):
+        return [(self.name, {}, self.value)]
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, *args, buckets : Iterable[float] = BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def _child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets = self.buckets)
+
+    def observe(self, value : float) -> None:
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def _samples(self):
+        output, total = [], 0
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            total += count
+            output.append((self.name + "_bucket", {"le": format_value(bound)}, total))
+        output.append((self.name + "_sum", {}, self.sum))
+        output.append((self.name + "_count", {}, total))
+        return output
+
+
+def format_value(value : float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render(metrics : Iterable[Metric]) -> str:
+    """
+    Creates the Prometheus text format of the metrics.
+    """
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+        for name, labels, value in metric.samples():
+            label_text = ",".join(
+                '{0}="{1}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                for k, v in labels.items()
+            )
+            lines.append(f"{name}{{{label_text}}} {format_value(value)}" if label_text else f"{name} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Metrics that are collected while serving requests.
+REGISTRY : List[Metric] = []
+
+UPSTREAM_LATENCY = Histogram(
+    "samfetch_upstream_request_seconds",
+    "Seconds until Kies servers respond, by call. For downloads, this is the time to first byte.",
+    ["call"], registry = REGISTRY
+)
+STREAMED_BYTES = Counter(
+    "samfetch_streamed_bytes_total",
+    "Bytes of firmware files sent to clients, by whether if they have been decrypted.",
+    ["kind"], registry = REGISTRY
+)
+DECRYPTED_BYTES = Counter(
+    "samfetch_decrypted_bytes_total",
+    "Bytes of firmware files decrypted.",
+    registry = REGISTRY
+)
+DECRYPT_SECONDS = Counter(
+    "samfetch_decrypt_seconds_total",
+    "Seconds spent for decrypting firmware files, decrypt throughput is the rate of decrypted bytes to this.",
+    registry = REGISTRY
+)
+ACTIVE_STREAMS = Gauge(
+    "samfetch_active_streams",
+    "Number of firmware files that are being sent to clients.",
+    registry = REGISTRY
+)
+ERRORS = Counter(
+    "samfetch_errors_total",
+    "Number of errors returned to clients, by error id.",
+    ["id"], registry = REGISTRY
+)
+HEDGED_REQUESTS = Counter(
+    "samfetch_upstream_hedged_total",
+    "Number of second attempts sent as the first attempt of the call was slow, by call.",
+    ["call"], registry = REGISTRY
+)
+RETRIED_REQUESTS = Counter(
+    "samfetch_upstream_retried_total",
+    "Number of attempts sent again after a network error or timeout, by call.",
+    ["call"], registry = REGISTRY
+)
+WATCH_POLLS = Counter(
+    "samfetch_watch_polls_total",
+    "Number of firmware lists polled for the watched devices, by result.",
+    ["result"], registry = REGISTRY
+)
+
+# Kies endpoints, and the names of the calls made to them.
+UPSTREAM_CALLS = {
+    "NF_DownloadGenerateNonce.do": "nonce",
+    "version.xml": "version_xml",
+    "NF_DownloadBinaryInform.do": "binary_inform",
+    "NF_DownloadBinaryInitForMass.do": "init_for_mass",
+    "NF_DownloadBinaryForMass.do": "download"
+}
+
+
+def upstream_call(path : str) -> str:
+    """
+    Gets the name of the Kies call from the path of the URL.
+    """
+    return UPSTREAM_CALLS.get(path.rsplit("/", 1)[-1], "other")
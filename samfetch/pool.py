@@ -0,0 +1,112 @@
+__all__ = [
+    "SessionPool"
+]
+
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+import httpx
+from samfetch.kies import KiesRequest
+from samfetch.session import Session
+
+
+class SessionPool:
+    """
+    Keeps authenticated Kies sessions warm, so requests don't need to wait for a new nonce.
+    A session is given to a single request at a time, and gets back to the pool when it is released.
+    """
+
+    # Response status codes that means the server doesn't accept the session anymore.
+    REJECT_STATUS = (401, 403)
+
+    def __init__(
+        self,
+        client : httpx.AsyncClient,
+        size : int = 4,
+        max_age : float = 300
+    ) -> None:
+        self.client = client
+        self.size = size
+        self.max_age = max_age
+        self._idle : Deque[Session] = deque()
+        self._refill : Optional[asyncio.Task] = None
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    async def create(self) -> Session:
+        """
+        Creates a new session by requesting a nonce from Kies servers.
+        """
+        nonce = await self.client.send(KiesRequest.get_nonce())
+        return Session.from_response(nonce)
+
+    async def acquire(self) -> Tuple[Session, bool]:
+        """
+        Gets a session from the pool, or creates a new one if there are no idle sessions.
+        Second value is True if the session was taken from the pool.
+        """
+        while self._idle:
+            session = self._idle.popleft()
+            if session.age < self.max_age:
+                return session, True
+        # Pool has run out of sessions, refill it for the next requests.
+        self.fill()
+        return await self.create(), False
+
+    async def send(self, build : Callable[[Session], httpx.Request], **kwargs) -> Tuple[Session, httpx.Response]:
+        """
+        Sends a request that is built with a session from the pool. If the server rejects a pooled session, 
+        the request is sent once more with a new session. Session is not released, so it can be 
+        used for the following requests, call release() when done.
+        """
+        session, pooled = await self.acquire()
+        try:
+            response = await self.client.send(build(session), **kwargs)
+        except BaseException:
+            # Session is kept, if the server has rejected it, that is found out on its next use.
+            self.release(session)
+            raise
+        if pooled and (response.status_code in self.REJECT_STATUS):
+            await response.aclose()
+            session = await self.create()
+            try:
+                response = await self.client.send(build(session), **kwargs)
+            except BaseException:
+                self.release(session)
+                raise
+        return session, response
+
+    def release(self, session : Session, response : Optional[httpx.Response] = None) -> bool:
+        """
+        Gives the session back to the pool after updating it from the last response.
+        Returns False if the server has rejected the session, so it has been thrown away.
+        """
+        if response is not None:
+            if response.status_code in self.REJECT_STATUS:
+                self.fill()
+                return False
+            session.refresh_session(response)
+        if (len(self._idle) < self.size) and (session.age < self.max_age):
+            self._idle.append(session)
+        return True
+
+    def fill(self) -> None:
+        """
+        Creates new sessions in the background until the pool is full.
+        """
+        if (self._refill is None or self._refill.done()) and (len(self._idle) < self.size):
+            self._refill = asyncio.create_task(self._fill())
+
+    async def _fill(self) -> None:
+        missing = self.size - len(self._idle)
+        results = await asyncio.gather(*[self.create() for _ in range(missing)], return_exceptions = True)
+        for session in results:
+            if isinstance(session, Session):
+                self.release(session)
+
+    async def close(self) -> None:
+        if self._refill and not self._refill.done():
+            self._refill.cancel()
+        self._idle.clear()
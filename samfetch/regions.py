@@ -0,0 +1,23 @@
+__all__ = [
+    "REGIONS"
+]
+
+# CSC (Consumer Software Customization) codes that are known to be used by Samsung,
+# so a model can be searched in all regions without knowing where it is sold.
+REGIONS = [
+    "ACR", "AFG", "AFR", "ARO", "ATO", "ATT", "AUT", "AZC", "BGL", "BMC", "BNG", "BRI", "BST", "BTC", 
+    "BTU", "BVO", "CAC", "CAM", "CAU", "CCT", "CEL", "CHA", "CHC", "CHE", "CHL", "CHM", "CHN", "CHO", 
+    "CHT", "CHU", "CHX", "COB", "COL", "COM", "COO", "COS", "CPW", "CRC", "CRO", "CTI", "CTU", "CYO", 
+    "CYV", "DBT", "DCO", "DKR", "DNL", "DOR", "DTM", "ECT", "EGY", "EON", "ERO", "ETL", "EUR", "FTM", 
+    "GBL", "GLB", "GTO", "ILO", "INS", "INU", "ITV", "KOO", "KSA", "KTC", "LPM", "LRA", "LUC", "LUX", 
+    "MAT", "MAX", "MBC", "MEO", "MID", "MM1", "MOB", "MOT", "MTL", "MWD", "MXO", "NEE", "NPL", "NZC", 
+    "O2U", "OMN", "ONE", "OPS", "ORA", "ORO", "ORX", "PAK", "PAN", "PBS", "PCL", "PCW", "PEO", "PET", 
+    "PGU", "PHE", "PHN", "PLS", "PRO", "PRT", "PSN", "PTR", "ROM", "SAM", "SEB", "SEE", "SEK", "SER", 
+    "SFR", "SIN", "SIO", "SKC", "SKT", "SKZ", "SLK", "SMA", "SPR", "SWC", "SWR", "TCE", "TDC", "TEB", 
+    "TEL", "TFG", "TFN", "TGU", "THL", "TIM", "TMB", "TMC", "TMK", "TMM", "TMN", "TMT", "TMZ", "TNL", 
+    "TNZ", "TOP", "TPA", "TPD", "TPH", "TPL", "TRG", "TSI", "TTR", "TTT", "TUN", "TUR", "TWO", "UFN", 
+    "UFU", "UNE", "UPO", "USC", "VAU", "VD2", "VDC", "VDF", "VDH", "VDI", "VDR", "VGR", "VIA", "VIP", 
+    "VMC", "VOD", "VVT", "VZW", "WTL", "XAA", "XAC", "XAG", "XAR", "XAS", "XEB", "XEC", "XEF", "XEH", 
+    "XEN", "XEO", "XEU", "XEZ", "XFA", "XFE", "XFM", "XFU", "XFV", "XID", "XME", "XNZ", "XSA", "XSE", 
+    "XSG", "XSK", "XSP", "XSS", "XTC", "XXV", "ZTA", "ZTM", "ZTO", "ZTR", "ZVV", "ZZT"
+]
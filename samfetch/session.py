@@ -3,6 +3,8 @@ __all__ = [
 ]
 
 import hashlib
+import time
+from typing import Optional, Tuple
 from samfetch.crypto import Crypto
 from httpx import Response
 
@@ -18,6 +20,9 @@ class Session:
     ) -> None:
         self.session_id = session_id
         self.encrypted_nonce = encrypted_nonce
+        self.created = time.monotonic()
+        # Nonce and auth only change when the session is refreshed, so they are kept for the current encrypted nonce.
+        self._derived : Tuple[Optional[str], Optional[str], Optional[str]] = (None, None, None)
         if not self.encrypted_nonce:
             raise Exception(
                 "Something went wrong with authorization. " + \
@@ -25,13 +30,26 @@ class Session:
                 "you can try creating an issue on the repository."
             )
 
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
     @property
     def nonce(self) -> str:
-        return Crypto.decrypt_nonce(self.encrypted_nonce)
+        encrypted, nonce, auth = self._derived
+        if encrypted != self.encrypted_nonce:
+            nonce = Crypto.decrypt_nonce(self.encrypted_nonce)
+            self._derived = (self.encrypted_nonce, nonce, None)
+        return nonce
 
     @property
     def auth(self) -> str:
-        return Crypto.get_auth(self.nonce)
+        nonce = self.nonce
+        auth = self._derived[2]
+        if auth is None:
+            auth = Crypto.get_auth(nonce)
+            self._derived = (self.encrypted_nonce, nonce, auth)
+        return auth
 
     @classmethod
     def from_response(cls, response : Response) -> "Session":
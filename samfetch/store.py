@@ -0,0 +1,135 @@
+__all__ = [
+    "StoredEntry",
+    "MetadataStore"
+]
+
+import marshal
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Hashable, Iterable, Optional
+
+
+class StoredEntry:
+    """
+    An entry read from MetadataStore. Expiry time is a wall clock time, so it can be shared between processes.
+    """
+
+    __slots__ = ("data", "expires", "negative", "etag", "last_modified")
+
+    def __init__(
+        self,
+        data : Any,
+        expires : Optional[float],
+        negative : bool,
+        etag : Optional[str],
+        last_modified : Optional[str]
+    ) -> None:
+        self.data = data
+        self.expires = float("inf") if expires is None else expires
+        self.negative = negative
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def ttl(self) -> float:
+        return self.expires - time.time()
+
+
+class MetadataStore:
+    """
+    A persistent store for cached metadata, shared between the worker processes and kept between restarts.
+    It is a SQLite database in WAL mode, so processes can read while another one is writing.
+
+    Values are stored with marshal, so they must only contain basic types (such as str, int,
+    tuple, list and dict). Entries are kept after they have expired, so they can be revalidated,
+    until "retention" seconds have passed.
+    """
+
+    def __init__(self, path : str, retention : float = 86400, timeout : float = 5) -> None:
+        self.path = path
+        self.retention = retention
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+        # A single connection is used from the event loop and executor threads, one at a time.
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout = timeout, isolation_level = None, check_same_thread = False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # Commits are not synced to the disk one by one, losing the last ones on a power loss is fine for a cache.
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries (" + \
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, expires REAL, " + \
+                "negative INTEGER NOT NULL, etag TEXT, last_modified TEXT, " + \
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+        self.purge()
+
+    @staticmethod
+    def make_key(key : Hashable) -> str:
+        # Cache keys are tuples of strings, which may contain slashes (like firmware versions).
+        return "\x00".join(key) if isinstance(key, tuple) else str(key)
+
+    def get(self, namespace : str, key : Hashable) -> Optional[StoredEntry]:
+        """
+        Gets the entry even if it has been expired, or None if it is not found or can't be read.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data, expires, negative, etag, last_modified FROM entries WHERE namespace = ? AND key = ?",
+                (namespace, self.make_key(key))
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            data = marshal.loads(row[0])
+        except (EOFError, ValueError, TypeError):
+            return None
+        return StoredEntry(data, row[1], bool(row[2]), row[3], row[4])
+
+    def set(
+        self,
+        namespace : str,
+        key : Hashable,
+        data : Any,
+        ttl : float,
+        negative : bool = False,
+        etag : Optional[str] = None,
+        last_modified : Optional[str] = None
+    ) -> None:
+        expires = None if ttl == float("inf") else time.time() + ttl
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (namespace, self.make_key(key), marshal.dumps(data), expires, int(negative), etag, last_modified)
+            )
+
+    def delete(self, namespace : str, keys : Iterable[Hashable]) -> int:
+        with self._lock:
+            return self._connection.executemany(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                [(namespace, self.make_key(x)) for x in keys]
+            ).rowcount
+
+    def clear(self, namespace : str) -> int:
+        with self._lock:
+            return self._connection.execute("DELETE FROM entries WHERE namespace = ?", (namespace, )).rowcount
+
+    def count(self, namespace : str) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM entries WHERE namespace = ?", (namespace, )).fetchone()[0]
+
+    def purge(self) -> int:
+        """
+        Removes the entries that have expired more than "retention" seconds ago.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "DELETE FROM entries WHERE expires < ?", (time.time() - self.retention, )
+            ).rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
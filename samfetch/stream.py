@@ -0,0 +1,328 @@
+__all__ = [
+    "FirmwareStream",
+    "UpstreamStream",
+    "FileStream",
+    "SegmentedStream"
+]
+
+import asyncio
+import mmap
+from collections import deque
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Deque, Optional
+import httpx
+from Crypto.Cipher import AES
+from samfetch.crypto import Crypto, decrypt_timed
+from samfetch.kies import KiesConstants, KiesRequest, KiesUtils
+from samfetch.session import Session
+
+if TYPE_CHECKING:
+    from samfetch.budget import Reservation
+
+
+class FirmwareStream:
+    """
+    A stream of (encrypted) firmware bytes, between "start" and "end" (inclusive) of a file with "total" size.
+    """
+
+    # Whether if the chunks have already been decrypted.
+    decrypted = False
+
+    def __init__(self, status : int, start : int, end : int, total : int) -> None:
+        self.status = status
+        self.start = start
+        self.end = end
+        self.total = total
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start + 1
+
+    @property
+    def partial(self) -> bool:
+        return self.status == 206
+
+    @property
+    def content_range(self) -> str:
+        return f"bytes {self.start}-{self.end}/{self.total}"
+
+    def iterate(self, chunk_size : int) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+
+    async def read(self, offset : int, length : int) -> bytes:
+        """
+        Reads bytes from anywhere in the file, regardless of the streamed range.
+        """
+        raise NotImplementedError
+
+    async def aclose(self) -> None:
+        pass
+
+
+class UpstreamStream(FirmwareStream):
+    """
+    A firmware stream that is being downloaded from Kies servers.
+
+    If the connection drops or the stream ends early, the download is continued from the last 
+    block-aligned offset with a new request, up to "retries" times in a row, waiting more after 
+    each failed attempt. If the session is rejected, "authorize" is called to get a new one.
+    The session is owned by the stream until it is closed, then it is given to "release", if it has given.
+    """
+
+    def __init__(
+        self, 
+        client : httpx.AsyncClient, 
+        session : Session, 
+        path : str, 
+        response : httpx.Response,
+        retries : int = 0,
+        backoff : float = 0.5,
+        authorize : Optional[Callable[[], Awaitable[Session]]] = None,
+        release : Optional[Callable[..., Any]] = None
+    ) -> None:
+        self.client = client
+        self.session = session
+        self.path = path
+        self.response = response
+        self.retries = retries
+        self.backoff = backoff
+        self.authorize = authorize
+        self.release = release
+        self._renewing = asyncio.Lock()
+        # Server may ignore the range and send the whole file.
+        content_range = KiesUtils.parse_content_range(response.headers.get("Content-Range", "")) \
+            if response.status_code == 206 else None
+        if content_range:
+            super().__init__(206, *content_range)
+        else:
+            size = int(response.headers["Content-Length"])
+            super().__init__(200, 0, size - 1, size)
+
+    @staticmethod
+    def retryable(error : Exception) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500
+        return isinstance(error, httpx.TransportError)
+
+    async def retry(self, attempt : int, error : Exception) -> None:
+        """
+        Waits before the next attempt, or raises the error if it can't be retried.
+        """
+        if (attempt > self.retries) or (not self.retryable(error)):
+            raise error
+        await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+    async def request(self, start : int, end : int, stream : bool = False) -> httpx.Response:
+        """
+        Requests a range of the file, and gets a new session once if the current one has been rejected.
+        """
+        for attempt in range(2):
+            session = self.session
+            response = await self.client.send(
+                KiesRequest.start_download(path = self.path, session = session, custom_range = f"bytes={start}-{end}"),
+                stream = stream
+            )
+            session.refresh_session(response)
+            if (response.status_code not in [401, 403]) or (self.authorize is None) or attempt:
+                break
+            await response.aclose()
+            await self._renew(session, response)
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
+        return response
+
+    async def _renew(self, rejected : Session, response : httpx.Response) -> None:
+        # Segments may be rejected at the same time, so only the first one gets a new session, and others use it.
+        async with self._renewing:
+            if self.session is not rejected:
+                return
+            # If it fails, the stream keeps the rejected session and gives it back when it is closed.
+            self.session = await self.authorize()
+            # Rejected session is given to the pool with its response, so it is thrown away.
+            if self.release is not None:
+                self.release(rejected, response)
+
+    async def iterate(self, chunk_size : Optional[int]) -> AsyncIterator[bytes]:
+        # Chunks are yielded as they arrive if no chunk size has given.
+        # Offset of the next byte to send, and bytes to drop from the resumed stream to reach it.
+        position, skip, attempt = self.start, 0, 0
+        response = self.response
+        while True:
+            try:
+                if response is None:
+                    # Continue from the start of the block, as encrypted files are decrypted in blocks.
+                    aligned = position - (position % 16)
+                    response = self.response = await self.request(aligned, self.end, stream = True)
+                    skip = position - aligned
+                    if response.status_code != 206:
+                        raise httpx.RemoteProtocolError("Server has ignored the range while resuming the stream.")
+                async for chunk in response.aiter_raw(chunk_size = chunk_size):
+                    if skip:
+                        chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                        if not chunk:
+                            continue
+                    position += len(chunk)
+                    attempt = 0
+                    yield chunk
+                if position > self.end:
+                    return
+                raise httpx.RemoteProtocolError(f"Stream has ended at {position}, before {self.end + 1}.")
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                attempt += 1
+                await self.retry(attempt, e)
+                await self.response.aclose()
+                response = None
+
+    async def read(self, offset : int, length : int) -> bytes:
+        # Server may ignore the range and send the whole file, so never read more than the requested bytes.
+        response = await self.request(offset, offset + length - 1, stream = True)
+        try:
+            if (response.status_code != 206) or \
+                (KiesUtils.parse_content_range(response.headers.get("Content-Range", "")) != (offset, offset + length - 1, self.total)):
+                raise httpx.RemoteProtocolError(f"Server hasn't sent the requested range ({offset}-{offset + length - 1}).")
+            data = b""
+            async for chunk in response.aiter_raw():
+                data += chunk
+                if len(data) >= length:
+                    break
+            return data[:length]
+        finally:
+            await response.aclose()
+
+    async def aclose(self) -> None:
+        await self.response.aclose()
+        # Session may be used by other downloads from now on, so it is given only once.
+        if self.release is not None:
+            release, self.release = self.release, None
+            release(self.session)
+
+
+class FileStream(FirmwareStream):
+    """
+    A firmware stream that is read from a file in the disk.
+    """
+
+    def __init__(self, file : str, start : int = 0, end : Optional[int] = None, executor : Optional[Executor] = None) -> None:
+        self.executor = executor
+        self._file = open(file, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        total = len(self._map)
+        end = total - 1 if end is None else min(end, total - 1)
+        super().__init__(206 if (start, end) != (0, total - 1) else 200, start, end, total)
+
+    async def iterate(self, chunk_size : int) -> AsyncIterator[bytes]:
+        loop = asyncio.get_running_loop()
+        position = self.start
+        while position <= self.end:
+            size = min(chunk_size, self.end + 1 - position)
+            # Pages may not be in the memory yet, so don't block the event loop while reading.
+            yield await loop.run_in_executor(self.executor, self._map.__getitem__, slice(position, position + size))
+            position += size
+
+    async def read(self, offset : int, length : int) -> bytes:
+        return self._map[offset:offset + length]
+
+    async def aclose(self) -> None:
+        if not self._map.closed:
+            self._map.close()
+            self._file.close()
+
+
+class SegmentedStream(FirmwareStream):
+    """
+    A firmware stream that is downloaded from Kies servers in segments, with many connections at once.
+    The first segment is read from an already started stream, and the following segments are requested
+    with the same session. Segments are decrypted as soon as they arrive if a key has given, 
+    and yielded in order. If a reservation has given, it is the memory reserved for the segments,
+    and released when the stream is closed.
+    """
+
+    def __init__(
+        self,
+        first : UpstreamStream,
+        end : int,
+        segment_size : int,
+        segments : int,
+        key : Optional[bytes] = None,
+        executor : Optional[Executor] = None,
+        reservation : Optional["Reservation"] = None
+    ) -> None:
+        self.first = first
+        self.segment_size = segment_size
+        self.segments = segments
+        self.key = key
+        self.executor = executor
+        self.reservation = reservation
+        self.decrypted = key is not None
+        start, total = first.start, first.total
+        super().__init__(206 if (start, end) != (0, total - 1) else 200, start, end, total)
+
+    @property
+    def session(self) -> Session:
+        return self.first.session
+
+    async def _download(self, start : int, end : int) -> bytes:
+        # Read the first segment from the started stream, unless it has failed before.
+        if (start == self.first.start) and (not self.first.response.is_closed):
+            try:
+                return await self.first.response.aread()
+            finally:
+                await self.first.response.aclose()
+        client = self.first.client
+        async with client.host_slot(httpx.URL(KiesConstants.BINARY_DOWNLOAD_URL)):
+            return (await self.first.request(start, end)).content
+
+    async def _fetch(self, start : int, end : int) -> bytes:
+        attempt = 0
+        while True:
+            try:
+                data = await self._download(start, end)
+                if len(data) != end - start + 1:
+                    raise httpx.RemoteProtocolError(f"Expected {end - start + 1} bytes for the segment, got {len(data)}.")
+                break
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                # Download the segment again if it has failed.
+                attempt += 1
+                await self.first.retry(attempt, e)
+        if self.key:
+            data = await asyncio.get_running_loop().run_in_executor(
+                self.executor, decrypt_timed, AES.new(self.key, AES.MODE_ECB), data
+            )
+            # Padding only exists at the end of the file.
+            if end + 1 == self.total:
+                data = Crypto.unpad(data)
+        return data
+
+    async def iterate(self, chunk_size : int) -> AsyncIterator[bytes]:
+        offsets = iter(range(self.start, self.end + 1, self.segment_size))
+        tasks : Deque[asyncio.Task] = deque()
+
+        def schedule():
+            # Keep the given number of segments downloading at once.
+            while len(tasks) < self.segments:
+                start = next(offsets, None)
+                if start is None:
+                    return
+                tasks.append(asyncio.create_task(
+                    self._fetch(start, min(start + self.segment_size - 1, self.end))
+                ))
+
+        try:
+            schedule()
+            while tasks:
+                data = await tasks.popleft()
+                schedule()
+                for position in range(0, len(data), chunk_size):
+                    yield data[position:position + chunk_size]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def read(self, offset : int, length : int) -> bytes:
+        return await self.first.read(offset, length)
+
+    async def aclose(self) -> None:
+        await self.first.aclose()
+        if self.reservation is not None:
+            self.reservation.release()
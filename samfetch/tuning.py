@@ -0,0 +1,117 @@
+__all__ = [
+    "CHUNK_SIZES",
+    "stream_memory",
+    "measure_cipher",
+    "measure_pipeline",
+    "calibrate_chunk_size"
+]
+
+import asyncio
+import os
+import time
+from concurrent.futures import Executor
+from types import SimpleNamespace
+from typing import AsyncIterator, Dict, Iterable, Optional, Tuple
+from Crypto.Cipher import AES
+from samfetch.crypto import BufferPool, start_decryptor
+
+# Chunk sizes that are tried when calibrating, all of them contain whole blocks.
+CHUNK_SIZES = [65536, 131072, 262144, 524288, 1048576, 1485760, 2097152, 4194304, 8388608]
+
+KEY = bytes(range(16))
+
+
+class NullResponse:
+    """
+    A response that drops the data sent to it, so the decryption pipeline can be measured alone.
+    """
+
+    def __init__(self) -> None:
+        self.sent = 0
+        # Tells start_decryptor that the data has been written, so pooled buffers are reused.
+        self.stream = SimpleNamespace(protocol = SimpleNamespace(transport = SimpleNamespace(get_write_buffer_size = lambda: 0)))
+
+    async def send(self, data) -> None:
+        self.sent += len(data)
+
+    async def eof(self) -> None:
+        pass
+
+
+def stream_memory(chunk_size : int, queue_size : int = 1) -> int:
+    """
+    Gets the bytes that a download can hold at most while streaming, which are the chunks
+    waiting in the two queues of start_decryptor and the chunks that each of its three stages are working on.
+    """
+    return chunk_size * (2 * queue_size + 3)
+
+
+def measure_cipher(chunk_size : int, size : int = 67108864) -> float:
+    """
+    Measures the speed of decrypting with AES-ECB in the current thread, in bytes per second.
+    """
+    cipher = AES.new(KEY, AES.MODE_ECB)
+    data = bytearray(os.urandom(chunk_size))
+    count = max(size // chunk_size, 1)
+    started = time.perf_counter()
+    for _ in range(count):
+        cipher.decrypt(data, output = data)
+    return count * chunk_size / (time.perf_counter() - started)
+
+
+async def source(chunk : bytes, count : int) -> AsyncIterator[bytes]:
+    for _ in range(count):
+        yield chunk
+        # Let other streams run, like a network stream would.
+        await asyncio.sleep(0)
+
+
+async def measure_pipeline(
+    chunk_size : int,
+    streams : int = 1,
+    size : int = 33554432,
+    executor : Optional[Executor] = None,
+    queue_size : int = 1,
+    pool : Optional[BufferPool] = None
+) -> float:
+    """
+    Measures the total speed of decrypting "streams" downloads of "size" bytes at the same time
+    with start_decryptor, in bytes per second.
+    """
+    chunk = os.urandom(chunk_size)
+    count = max(size // chunk_size, 1)
+    responses = [NullResponse() for _ in range(streams)]
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        start_decryptor(
+            response = response, iterator = source(chunk, count), key = KEY,
+            executor = executor, queue_size = queue_size, unpad = False, pool = pool
+        ) for response in responses
+    ])
+    return sum(x.sent for x in responses) / (time.perf_counter() - started)
+
+
+async def calibrate_chunk_size(
+    budget : int,
+    executor : Optional[Executor] = None,
+    queue_size : int = 1,
+    streams : int = 1,
+    size : int = 16777216,
+    chunk_sizes : Iterable[int] = CHUNK_SIZES,
+    pooled : bool = True
+) -> Tuple[int, Dict[int, float]]:
+    """
+    Finds the chunk size that decrypts fastest on this host, without exceeding the memory "budget"
+    of a single download. Chunk sizes that are close to the fastest one (within 5%) are preferred
+    if they are smaller, as they use less memory. Returns the chosen size and the speed of each size.
+    """
+    candidates = [x for x in chunk_sizes if stream_memory(x, queue_size) <= budget] or [min(chunk_sizes)]
+    results = {}
+    for chunk_size in candidates:
+        pool = BufferPool(chunk_size, streams * (queue_size + 2)) if pooled else None
+        results[chunk_size] = await measure_pipeline(
+            chunk_size, streams = streams, size = max(size, chunk_size),
+            executor = executor, queue_size = queue_size, pool = pool
+        )
+    fastest = max(results.values())
+    return min(x for x, speed in results.items() if speed >= fastest * 0.95), results
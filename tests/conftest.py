@@ -0,0 +1,81 @@
+"""
+Starts benchmarks.fake_kies and SamFetch (with benchmarks.serve) as separate processes for the tests
+that need the whole server, as in benchmarks.e2e.
+"""
+
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+import httpx
+import pytest
+from benchmarks.fake_kies import FILENAME, FIRMWARE, MODEL, MODEL_PATH, REGION
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url : str, timeout : float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            httpx.get(url)
+            return
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+class Servers:
+    def __init__(self, url : str, upstream : str, size : int) -> None:
+        self.url = url
+        self.upstream = upstream
+        self.size = size
+        # Firmware that fake_kies generates with its default seed.
+        self.plain = random.Random(1).randbytes(size)
+        self.key = httpx.get(f"{url}/{REGION}/{MODEL}/{FIRMWARE}").json()["decrypt_key"]
+
+    @property
+    def download(self) -> str:
+        return f"{self.url}/file{MODEL_PATH}{FILENAME}?decrypt={self.key}"
+
+    def stats(self) -> Dict[str, int]:
+        return httpx.get(self.upstream + "/stats").json()
+
+
+@contextmanager
+def run_servers(size : int = 1048576, **env) -> Iterator[Servers]:
+    upstream, port = free_port(), free_port()
+    environ = {**os.environ, **{k : str(v) for k, v in env.items()}}
+    processes = [subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.fake_kies", "--port", str(upstream), "--size", str(size)],
+        cwd = ROOT, env = environ, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL
+    )]
+    try:
+        # SamFetch authorizes sessions on start, so Kies must be up before it.
+        wait_until_ready(f"http://127.0.0.1:{upstream}/stats")
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.serve", "--port", str(port), "--upstream", f"http://127.0.0.1:{upstream}"],
+            cwd = ROOT, env = environ, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL
+        ))
+        wait_until_ready(f"http://127.0.0.1:{port}/")
+        yield Servers(f"http://127.0.0.1:{port}", f"http://127.0.0.1:{upstream}", size)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+@pytest.fixture
+def servers():
+    return run_servers
@@ -0,0 +1,19 @@
+"""
+Checks that the batch endpoints report the same results and errors as the single lookups.
+"""
+
+import httpx
+from benchmarks.fake_kies import FIRMWARE, MODEL, REGION
+
+
+def test_batch_details_match_single_lookups(servers):
+    with servers() as s:
+        firmwares = [FIRMWARE, FIRMWARE.lower(), "N920C-XXU5CSH1/N920COXM5CSH1/N920CXXU5CSH1/N920CXXU5CSH1"]
+        batch = httpx.post(f"{s.url}/batch/details", json = [{"region": REGION, "model": MODEL, "firmware": x} for x in firmwares]).json()
+        for firmware, item in zip(firmwares, batch):
+            single = httpx.get(f"{s.url}/{REGION}/{MODEL}/{firmware}")
+            if single.status_code == 200:
+                assert item["result"] == single.json()
+            else:
+                assert item["error"] == single.json()
+                assert item["error"]["context"]["id"] == "firmware_not_found"
@@ -0,0 +1,51 @@
+"""
+Checks that the blob caches of several workers share the same directory and size limit.
+"""
+
+import asyncio
+import os
+import time
+from samfetch.blobs import BlobCache
+
+
+async def chunks(*values):
+    for value in values:
+        yield value
+
+
+def store(cache, key, data):
+    async def run():
+        return b"".join([x async for x in cache.tee(key, len(data), chunks(data))])
+    return asyncio.run(run())
+
+
+def test_shared_between_workers(tmp_path):
+    first, second = BlobCache(str(tmp_path), 100), BlobCache(str(tmp_path), 100)
+    assert store(first, "a", b"x" * 40) == b"x" * 40
+    # Blob written by another worker is a hit, and is not written again.
+    assert second.get("a") == first.file("a")
+    assert second.writer("a", 40) is None
+
+
+def test_size_limit_for_all_workers(tmp_path):
+    first, second = BlobCache(str(tmp_path), 100), BlobCache(str(tmp_path), 100)
+    store(first, "a", b"a" * 40)
+    os.utime(first.file("a"), (time.time() - 10, time.time() - 10))
+    store(second, "b", b"b" * 40)
+    store(first, "c", b"c" * 40)
+    # Least recently used blob of the other worker is removed, so the directory stays under the limit.
+    blobs = [x for x in os.listdir(tmp_path) if x.endswith(".blob")]
+    assert len(blobs) == 2
+    assert first.get("a") is None
+    assert second.get("b") and second.get("c")
+
+
+def test_stale_parts_are_removed(tmp_path):
+    stale, fresh = tmp_path / "stale.blob.1.part", tmp_path / "fresh.blob.2.part"
+    stale.write_bytes(b"x")
+    fresh.write_bytes(b"x" * 10)
+    os.utime(stale, (time.time() - BlobCache.STALE_AGE - 1, time.time() - BlobCache.STALE_AGE - 1))
+    cache = BlobCache(str(tmp_path), 100)
+    assert not stale.exists() and fresh.exists()
+    # Downloads of other workers count for the size limit.
+    assert cache.used == 10
@@ -0,0 +1,94 @@
+"""
+Checks that downloads resize their chunks to the speed of the clients and the free memory,
+and wait for (or are refused) memory when the budget is full.
+"""
+
+import asyncio
+from samfetch.budget import BudgetExceeded, MemoryBudget
+
+# With a queue size of 1, a download holds 5 chunks at most.
+STREAM = 5
+
+
+def test_chunk_size_follows_client_speed():
+    async def run():
+        budget = MemoryBudget(10000, min_chunk_size = 16, max_chunk_size = 256)
+        reservation = await budget.acquire(256)
+        assert (reservation.chunk_size, budget.used) == (256, 256 * STREAM)
+        # Slow clients get smaller chunks, so they don't hold big buffers.
+        reservation.sent(256, 1)
+        assert (reservation.chunk_size, budget.used) == (128, 128 * STREAM)
+        # Fast clients get bigger chunks again, up to the preferred size.
+        reservation.sent(128, 0.0001)
+        reservation.sent(256, 0.0001)
+        assert (reservation.chunk_size, budget.used) == (256, 256 * STREAM)
+        reservation.release()
+        assert (budget.used, reservation.resize(16)) == (0, False)
+
+    asyncio.run(run())
+
+
+def test_chunks_shrink_while_others_wait():
+    async def run():
+        budget = MemoryBudget(256 * STREAM * 2, min_chunk_size = 16, max_chunk_size = 256)
+        first = await budget.acquire(256)
+        second = asyncio.ensure_future(budget.acquire(256, extra = 256 * STREAM))
+        await asyncio.sleep(0.01)
+        assert (budget.waiting, second.done()) == (1, False)
+        # Even a fast download gives memory back while another one is waiting.
+        first.sent(256, 0.0001)
+        second = await asyncio.wait_for(second, 1)
+        assert (first.chunk_size, second.chunk_size, second.extra) == (128, 16, 256 * STREAM)
+        assert budget.used == (128 + 16) * STREAM + 256 * STREAM
+
+    asyncio.run(run())
+
+
+def test_waiting_times_out():
+    async def run():
+        budget = MemoryBudget(16 * STREAM, min_chunk_size = 16, timeout = 0.05)
+        first = await budget.acquire(16)
+        try:
+            await budget.acquire(16)
+            raise AssertionError("Memory has been reserved over the limit.")
+        except BudgetExceeded:
+            pass
+        assert (budget.refused, budget.waiting) == (1, 0)
+        # Memory that has been given back can be reserved again.
+        first.release()
+        await budget.acquire(16)
+
+    asyncio.run(run())
+
+
+def test_too_many_waiting_are_refused():
+    async def run():
+        budget = MemoryBudget(16 * STREAM, min_chunk_size = 16, max_waiting = 1)
+        first = await budget.acquire(16)
+        waiting = asyncio.ensure_future(budget.acquire(16))
+        await asyncio.sleep(0.01)
+        try:
+            await budget.acquire(16)
+            raise AssertionError("Download has waited over the limit of waiting downloads.")
+        except BudgetExceeded:
+            assert budget.refused == 1
+        first.release()
+        assert (await asyncio.wait_for(waiting, 1)).chunk_size == 16
+
+    asyncio.run(run())
+
+
+def test_detached_memory_is_released_separately():
+    async def run():
+        budget = MemoryBudget(1000, min_chunk_size = 16)
+        reservation = await budget.acquire(16, extra = 500)
+        assert budget.used == 16 * STREAM + 500
+        buffer = reservation.detach(300)
+        assert (reservation.extra, buffer.extra, budget.buffered, budget.streams) == (200, 300, 300, 1)
+        reservation.release()
+        assert budget.used == 300
+        buffer.release()
+        buffer.release()
+        assert (budget.used, budget.buffered) == (0, 0)
+
+    asyncio.run(run())
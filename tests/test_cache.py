@@ -0,0 +1,105 @@
+"""
+Checks the single-flight loading, expiry, revalidation and purging of the metadata caches.
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+import httpx
+from samfetch.cache import TTLCache
+from samfetch.store import MetadataStore
+from web.lookups import fetch_firmware_list
+
+VERSION_XML = "<versioninfo><url>x</url><firmware><model>SM-N920C</model><cc>TUR</cc><version>" + \
+    "<latest o='9'>N920CXXU5CSH1/N920COXM5CSH1/N920CXXU5CSH1/N920CXXU5CSH1</latest><upgrade></upgrade>" + \
+    "</version></firmware></versioninfo>"
+
+
+def test_concurrent_fetches_load_once():
+    async def run():
+        cache, calls = TTLCache(), []
+
+        async def load(stale):
+            calls.append(stale)
+            await asyncio.sleep(0.05)
+            return cache.set("key", "value")
+
+        entries = await asyncio.gather(*[cache.fetch("key", load) for _ in range(10)])
+        assert calls == [None]
+        assert all(x is entries[0] for x in entries)
+        assert (cache.misses, (await cache.fetch("key", load)).value, cache.hits) == (10, "value", 1)
+
+    asyncio.run(run())
+
+
+def test_cancelled_fetch_keeps_loading():
+    async def run():
+        cache = TTLCache()
+
+        async def load(stale):
+            await asyncio.sleep(0.05)
+            return cache.set("key", "value")
+
+        first = asyncio.ensure_future(cache.fetch("key", load))
+        second = asyncio.ensure_future(cache.fetch("key", load))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert (await second).value == "value"
+
+    asyncio.run(run())
+
+
+def test_negative_entries_expire_sooner():
+    cache = TTLCache(ttl = 60, negative_ttl = 0.05)
+    cache.set("missing", 404, negative = True)
+    cache.set("found", "value")
+    assert cache.get("missing").negative
+    time.sleep(0.1)
+    assert cache.get("missing") is None
+    # Expired entries are kept, so they can be revalidated.
+    assert cache.peek("missing").value == 404
+    assert cache.get("found").value == "value"
+
+
+def test_expired_list_is_revalidated():
+    class StubClient:
+        def __init__(self) -> None:
+            self.requests = []
+
+        async def send(self, request : httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            if request.headers.get("If-None-Match", None) == '"v1"':
+                return httpx.Response(304, headers = {"ETag": '"v1"'})
+            return httpx.Response(200, text = VERSION_XML, headers = {"ETag": '"v1"'})
+
+    async def run():
+        client = StubClient()
+        app = SimpleNamespace(ctx = SimpleNamespace(firmware_lists = TTLCache(ttl = 0.05), client = client))
+        first = await fetch_firmware_list(app, "TUR", "SM-N920C")
+        await asyncio.sleep(0.1)
+        second = await fetch_firmware_list(app, "TUR", "SM-N920C")
+        # Server has told that the list hasn't changed, so the parsed list is kept.
+        assert second is first
+        assert [x.headers.get("If-None-Match", None) for x in client.requests] == [None, '"v1"']
+        assert app.ctx.firmware_lists.get(("TUR", "SM-N920C")).etag == '"v1"'
+
+    asyncio.run(run())
+
+
+def test_delete_removes_stored_entries(tmp_path):
+    path = str(tmp_path / "store.db")
+    first = TTLCache(store = MetadataStore(path), namespace = "binary_details")
+    second = TTLCache(store = MetadataStore(path), namespace = "binary_details")
+    key = ("TUR", "SM-N920C", "N920CXXU5CSH1/N920COXM5CSH1/N920CXXU5CSH1/N920CXXU5CSH1")
+    first.set(key, "details")
+    first.set(("XAR", "SM-N920C", "N920CXXU5CSH1"), "details")
+
+    async def run():
+        # Entry saved by another worker is only in the store.
+        assert await second.delete(key)
+        assert not await second.delete(key)
+        assert first.store.get("binary_details", key) is None
+        assert await second.clear() == 1
+        assert await first.clear() == 0 and len(first) == 0
+
+    asyncio.run(run())
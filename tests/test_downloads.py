@@ -0,0 +1,32 @@
+"""
+Checks the downloads of the whole server, against benchmarks.fake_kies.
+"""
+
+import asyncio
+import httpx
+
+MB = 1048576
+
+
+async def fetch_ranges(url : str, ranges):
+    async with httpx.AsyncClient(timeout = 60) as client:
+        return await asyncio.gather(*[
+            client.get(url, headers = {"Range": f"bytes={start}-{end}"}) for start, end in ranges
+        ])
+
+
+def test_full_budget_serves_downloads_in_turn(servers):
+    # Budget fits only one download with its segments at a time. Downloads wait for each other 
+    # instead of holding a part of the budget while waiting for the rest, which makes all of them time out.
+    with servers(
+        size = 3 * MB, SAMFETCH_MEMORY_BUDGET = 2621440, SAMFETCH_SEGMENTS = 2, SAMFETCH_SEGMENT_SIZE = MB,
+        SAMFETCH_CHUNK_SIZE = 65536, SAMFETCH_FANOUT_BUFFER = 0, SAMFETCH_BUDGET_TIMEOUT = 20,
+        SAMFETCH_ADMIN_TOKEN = "token"
+    ) as server:
+        ranges = [(x * 100000, x * 100000 + 2 * MB) for x in range(6)]
+        responses = asyncio.run(fetch_ranges(server.download, ranges))
+        for (start, end), response in zip(ranges, responses):
+            assert response.status_code == 206
+            assert response.content == server.plain[start:end + 1]
+        budget = httpx.get(server.url + "/admin/budget", headers = {"Authorization": "Bearer token"}).json()
+        assert (budget["used"], budget["refused"]) == (0, 0)
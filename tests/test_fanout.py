@@ -0,0 +1,101 @@
+"""
+Checks that shared streams drop the chunks that have been read, and that slow downloads
+continue with their own stream when the buffer leaves them behind.
+"""
+
+import asyncio
+import random
+from types import SimpleNamespace
+from samfetch.fanout import FanoutHub
+from samfetch.stream import FirmwareStream
+
+CHUNK = 16
+DATA = random.Random(1).randbytes(CHUNK * 16)
+
+
+class MemoryStream(FirmwareStream):
+    """
+    Streams DATA from "start", and counts the times it has been read and closed.
+    """
+
+    def __init__(self, start : int = 0) -> None:
+        super().__init__(200 if start == 0 else 206, start, len(DATA) - 1, len(DATA))
+        self.iterated = 0
+        self.closed = 0
+
+    async def iterate(self, chunk_size : int):
+        self.iterated += 1
+        for position in range(self.start, self.end + 1, chunk_size):
+            await asyncio.sleep(0)
+            yield DATA[position:position + chunk_size]
+
+    async def read(self, offset : int, length : int) -> bytes:
+        return DATA[offset:offset + length]
+
+    async def aclose(self) -> None:
+        self.closed += 1
+
+
+def new_hub():
+    sources, released = [], []
+
+    async def opener():
+        sources.append(MemoryStream())
+        return sources[-1], sources[-1].iterate(CHUNK)
+
+    reservation = SimpleNamespace(release = lambda: released.append(True))
+    return FanoutHub(CHUNK * 4), opener, sources, released, reservation
+
+
+def test_read_chunks_are_dropped():
+    async def run():
+        hub, opener, sources, released, reservation = new_hub()
+        first = await hub.subscribe("file", opener, reservation = reservation)
+        second = await hub.subscribe("file", opener, reservation = reservation)
+        shared = first.shared
+        chunks = [first.iterate(CHUNK), second.iterate(CHUNK)]
+        received = [b"", b""]
+        for n in range(len(DATA) // CHUNK):
+            for i, iterator in enumerate(chunks):
+                received[i] += await iterator.__anext__()
+            assert shared._buffered <= hub.capacity
+            # Beginning of the file is kept only while it fits in the buffer.
+            if n == 8:
+                assert shared._offset > 0 and not shared.joinable
+                third = await hub.subscribe("file", opener)
+        assert received == [DATA, DATA]
+        assert len(sources) == 2 and sources[0].iterated == 1
+        for subscription in [first, second, third]:
+            await subscription.aclose()
+        await asyncio.sleep(0)
+        assert [x.closed for x in sources] == [1, 1]
+        # Reservation of the buffer is only taken by the stream that has been opened with it.
+        assert released == [True]
+
+    asyncio.run(run())
+
+
+def test_slow_download_falls_back():
+    async def run():
+        hub, opener, sources, released, reservation = new_hub()
+        fallbacks = []
+
+        async def fallback(offset):
+            fallbacks.append(MemoryStream(offset))
+            return fallbacks[-1]
+
+        fast = await hub.subscribe("file", opener, fallback = fallback)
+        slow = await hub.subscribe("file", opener)
+        slow_chunks = slow.iterate(CHUNK)
+        received = await slow_chunks.__anext__()
+        # Fast download doesn't wait for the slow one, chunks that the slow one hasn't read are dropped.
+        assert b"".join([x async for x in fast.iterate(CHUNK)]) == DATA
+        received += b"".join([x async for x in slow_chunks])
+        assert received == DATA
+        assert [x.start for x in fallbacks] == [CHUNK]
+        assert sources[0].iterated == 1
+        await fast.aclose()
+        await slow.aclose()
+        assert sources[0].closed == 1 and fallbacks[0].closed == 1
+
+    asyncio.run(run())
@@ -0,0 +1,107 @@
+"""
+Checks the delay and budget of hedged requests, and which calls to Kies servers are retried or hedged.
+"""
+
+import asyncio
+import time
+import httpx
+from samfetch.client import KiesClient
+from samfetch.hedge import HedgePolicy
+
+VERSION_XML = "http://kies/firmware/TUR/SM-N920C/version.xml"
+INIT_FOR_MASS = "http://kies/NF_DownloadBinaryInitForMass.do"
+
+
+def new_client(handler, **kwargs) -> KiesClient:
+    client = KiesClient(http2 = False, retry_backoff = 0, **kwargs)
+    client._transport = httpx.MockTransport(handler)
+    return client
+
+
+def test_delay_is_percentile_of_latencies():
+    policy = HedgePolicy(percentile = 90, min_samples = 10)
+    for latency in range(1, 10):
+        policy.observe(latency / 100)
+    # Not enough latencies to know what is slow yet.
+    assert policy.delay() is None
+    policy.observe(0.1)
+    assert policy.delay() == 0.1
+
+
+def test_hedges_are_limited_by_budget():
+    policy = HedgePolicy(budget = 0.25, max_tokens = 2)
+    # Each request adds a quarter of a hedge.
+    for _ in range(3):
+        policy.delay()
+    assert not policy.spend()
+    policy.delay()
+    assert policy.spend() and (not policy.spend())
+    for _ in range(100):
+        policy.delay()
+    assert policy.tokens == 2
+    assert policy.spend() and policy.spend() and (not policy.spend())
+    assert policy.hedged == 3
+
+
+def test_idempotent_calls_are_retried():
+    async def run():
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.path)
+            if len(calls) <= 2:
+                raise httpx.ConnectError("refused", request = request)
+            return httpx.Response(200)
+
+        async with new_client(handler, retries = 2) as client:
+            assert (await client.send(httpx.Request("GET", VERSION_XML))).status_code == 200
+            assert len(calls) == 3
+            # Calls that change the state of the session are only sent once.
+            calls.clear()
+            try:
+                await client.send(httpx.Request("POST", INIT_FOR_MASS))
+                raise AssertionError("Error has not been raised.")
+            except httpx.ConnectError:
+                assert len(calls) == 1
+
+    asyncio.run(run())
+
+
+def test_retries_give_up():
+    async def run():
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.path)
+            raise httpx.ReadTimeout("timed out", request = request)
+
+        async with new_client(handler, retries = 1) as client:
+            try:
+                await client.send(httpx.Request("GET", VERSION_XML))
+                raise AssertionError("Error has not been raised.")
+            except httpx.ReadTimeout:
+                assert len(calls) == 2
+
+    asyncio.run(run())
+
+
+def test_slow_call_is_hedged():
+    async def run():
+        calls = []
+
+        async def handler(request):
+            calls.append(request.url.path)
+            # First attempt is much slower than the recent calls.
+            await asyncio.sleep(1 if len(calls) == 1 else 0)
+            return httpx.Response(200, text = str(len(calls)))
+
+        async with new_client(handler, hedge_percentile = 50, hedge_budget = 1) as client:
+            policy = client.hedge_policy("version_xml")
+            for _ in range(policy.min_samples):
+                policy.observe(0.01)
+            started = time.monotonic()
+            response = await client.send(httpx.Request("GET", VERSION_XML))
+            assert (response.text, policy.hedged) == ("2", 1)
+            assert time.monotonic() - started < 0.5
+
+    asyncio.run(run())
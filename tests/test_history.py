@@ -0,0 +1,54 @@
+"""
+Checks the changes that the firmware history records between the polled lists, and paging through them.
+"""
+
+from samfetch.history import FirmwareHistory
+from samfetch.kies import KiesFirmwareList
+
+FIRMWARES = [
+    "N920CXXU5CSH1/N920COXM5CSH1/N920CXXU5CSH1/N920CXXU5CSH1",
+    "N920CXXU5CSG1/N920COXM5CSG1/N920CXXU5CSG1/N920CXXU5CSG1",
+    "N920CXXU5CSF1/N920COXM5CSF1/N920CXXU5CSF1/N920CXXU5CSF1"
+]
+
+
+def firmware_list(latest, *alternate) -> KiesFirmwareList:
+    upgrades = "".join(f"<value rcount='1' fwsize='1'>{x}</value>" for x in alternate)
+    return KiesFirmwareList.from_xml(
+        f"<versioninfo><url>x</url><firmware><model>SM-N920C</model><cc>TUR</cc><version>" + \
+        f"<latest o='9'>{latest}</latest><upgrade>{upgrades}</upgrade></version></firmware></versioninfo>"
+    )
+
+
+def test_changes_between_lists():
+    history = FirmwareHistory()
+    added = history.update("TUR", "SM-N920C", firmware_list(FIRMWARES[1], FIRMWARES[2]), when = 1)
+    assert [(x["firmware"], x["kind"]) for x in added] == [(FIRMWARES[1], "added"), (FIRMWARES[2], "added"), (FIRMWARES[1], "latest")]
+    changed = history.update("TUR", "SM-N920C", firmware_list(FIRMWARES[0], FIRMWARES[1]), when = 2)
+    assert sorted((x["firmware"], x["kind"]) for x in changed) == \
+        sorted([(FIRMWARES[0], "added"), (FIRMWARES[2], "removed"), (FIRMWARES[0], "latest")])
+    assert history.update("TUR", "SM-N920C", firmware_list(FIRMWARES[0], FIRMWARES[1]), when = 3) == []
+    device = history.history("TUR", "SM-N920C")
+    assert device["latest"] == FIRMWARES[0]
+    assert {x["firmware"]: x["removed"] for x in device["firmwares"]} == {FIRMWARES[0]: None, FIRMWARES[1]: None, FIRMWARES[2]: 2}
+    assert history.history("TUR", "SM-G960F") is None
+
+
+def test_changes_are_paged_by_id():
+    history = FirmwareHistory()
+    history.update("TUR", "SM-N920C", firmware_list(FIRMWARES[0], *FIRMWARES[1:]), when = 1)
+    history.update("XAR", "SM-N920C", firmware_list(FIRMWARES[0], *FIRMWARES[1:]), when = 2)
+    # Changes of a poll share the same time, so pages are continued from the id of the last change.
+    pages, after = [], 0
+    while True:
+        page = history.changes(after = after, limit = 3)
+        if not page:
+            break
+        pages.append(page)
+        after = page[-1]["id"]
+    changes = [x for page in pages for x in page]
+    assert [len(x) for x in pages] == [3, 3, 2]
+    assert [x["id"] for x in changes] == sorted(set(x["id"] for x in changes))
+    assert [x["time"] for x in changes] == [1] * 4 + [2] * 4
+    assert [x["region"] for x in history.changes(since = 1)] == ["XAR"] * 4
+    assert history.changes(after = changes[-1]["id"]) == []
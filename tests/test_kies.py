@@ -0,0 +1,42 @@
+"""
+Checks that the request bodies built from the templates of KiesConstants are byte-identical 
+to the bodies that dicttoxml created before, including the values that need escaping,
+and that the headers are the ones that Kies clients send.
+
+    pip install -r requirements-dev.txt
+    python -m pytest
+"""
+
+import pytest
+
+pytest.importorskip("dicttoxml")
+
+from samfetch.kies import KiesConstants
+from benchmarks.bodies import SAMPLES, legacy_binary_file, legacy_binary_info
+
+# Values that are escaped by dicttoxml, one by one and together.
+ESCAPED = ["&", "<", ">", "\"", "'", "&amp;", "<Data>x</Data>", "a & b < c > d \"e\" 'f'", "{0}{}{x}", "ü\n\t"]
+
+
+@pytest.mark.parametrize("sample", SAMPLES + [(x, x, x, x) for x in ESCAPED])
+def test_binary_info(sample):
+    assert KiesConstants.BINARY_INFO(*sample) == legacy_binary_info(*sample)
+
+
+@pytest.mark.parametrize("sample", [x[2:] for x in SAMPLES] + [(x, x) for x in ESCAPED])
+def test_binary_file(sample):
+    assert KiesConstants.BINARY_FILE(*sample) == legacy_binary_file(*sample)
+
+
+@pytest.mark.parametrize("sample, authorization", [
+    (("nonce", "signature"), 'FUS nonce="nonce", signature="signature", nc="", type="", realm="", newauth="1"'),
+    (("nonce", None), 'FUS nonce="nonce", signature="", nc="", type="", realm="", newauth="1"'),
+    ((None, None), 'FUS nonce="", signature="", nc="", type="", realm="", newauth="1"')
+])
+def test_headers(sample, authorization):
+    assert KiesConstants.HEADERS(*sample) == {"Authorization": authorization, "User-Agent": "Kies2.0_FUS"}
+
+
+def test_cookie_header():
+    assert KiesConstants.COOKIE_HEADER("S1") == "JSESSIONID=S1"
+    assert KiesConstants.COOKIE_HEADER() == "JSESSIONID="
@@ -0,0 +1,102 @@
+"""
+Checks how the limit of a Kies endpoint follows the latency and errors, the queue of the requests
+over the limit, and the transitions of the circuit breaker.
+"""
+
+import asyncio
+import time
+from samfetch.limiter import AdaptiveLimiter, UpstreamUnavailable
+
+
+async def rejected(limiter : AdaptiveLimiter) -> bool:
+    try:
+        await limiter.acquire()
+    except UpstreamUnavailable:
+        return True
+    limiter.release()
+    return False
+
+
+def test_limit_follows_latency_and_errors():
+    async def run():
+        limiter = AdaptiveLimiter("test", initial = 4, max_limit = 8)
+        for _ in range(4):
+            await limiter.acquire()
+        # Limit grows only when it has been reached, by one for each "limit" responses.
+        limiter.release(0.01)
+        assert limiter.limit == 4.25
+        limiter.release(0.01)
+        assert limiter.limit == 4.25
+        # Latency over the tolerance backs off, and errors halve the limit.
+        limiter.release(0.05)
+        assert limiter.limit == 4.25 * 0.9
+        limiter.release(0.01, failed = True)
+        assert (limiter.limit, limiter.in_flight, limiter.failures) == (4.25 * 0.9 / 2, 0, 1)
+        # Cancelled requests don't change the limit.
+        await limiter.acquire()
+        limiter.release()
+        assert limiter.limit == 4.25 * 0.9 / 2
+
+    asyncio.run(run())
+
+
+def test_requests_over_limit_wait_in_queue():
+    async def run():
+        limiter = AdaptiveLimiter("test", initial = 1, max_limit = 1, max_queue = 1, timeout = 0.05)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.queued == 1
+        assert await rejected(limiter)
+        limiter.release(0.01)
+        await waiting
+        assert (limiter.in_flight, limiter.queued) == (1, 0)
+        # Requests that wait too long fail.
+        assert await rejected(limiter)
+        assert (limiter.timed_out, limiter.rejected, limiter.queued) == (1, 2, 0)
+
+    asyncio.run(run())
+
+
+def test_circuit_opens_and_closes():
+    async def run():
+        limiter = AdaptiveLimiter("test", initial = 1, max_failures = 2, cooldown = 0.05)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release(0.01, failed = True)
+        await waiting
+        limiter.release(0.01, failed = True)
+        assert limiter.circuit == AdaptiveLimiter.OPEN
+        assert await rejected(limiter)
+        # After the cooldown, only a single request tests the endpoint.
+        await asyncio.sleep(0.06)
+        await limiter.acquire()
+        assert limiter.circuit == AdaptiveLimiter.HALF_OPEN
+        assert await rejected(limiter)
+        limiter.release(0.01, failed = True)
+        assert limiter.circuit == AdaptiveLimiter.OPEN
+        await asyncio.sleep(0.06)
+        await limiter.acquire()
+        limiter.release(0.01)
+        assert (limiter.circuit, limiter.failures) == (AdaptiveLimiter.CLOSED, 0)
+        assert not await rejected(limiter)
+
+    asyncio.run(run())
+
+
+def test_open_circuit_fails_queued_requests():
+    async def run():
+        limiter = AdaptiveLimiter("test", initial = 1, max_failures = 1, cooldown = 10)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        started = time.monotonic()
+        limiter.release(0.01, failed = True)
+        try:
+            await waiting
+            raise AssertionError("Queued request has been sent while the circuit is open.")
+        except UpstreamUnavailable:
+            assert time.monotonic() - started < 1
+
+    asyncio.run(run())
@@ -0,0 +1,27 @@
+"""
+Checks the regions of the multi-region scan, and that scans at the same time fit in the upstream queue.
+"""
+
+import asyncio
+import httpx
+from benchmarks.fake_kies import MODEL
+
+
+def test_invalid_regions_are_rejected(servers):
+    with servers(SAMFETCH_SCAN_MAX_REGIONS = 3) as s:
+        assert httpx.get(f"{s.url}/scan/{MODEL}?regions=TUR,X!Z").status_code == 400
+        assert httpx.get(f"{s.url}/scan/{MODEL}?regions=TUR,XAR,BTU,DBT").status_code == 400
+        lines = httpx.get(f"{s.url}/scan/{MODEL}?regions=tur,XAR,TUR").text.splitlines()
+        assert len(lines) == 2
+
+
+def test_scans_fit_in_upstream_queue(servers):
+    async def run(url):
+        async with httpx.AsyncClient(base_url = url, timeout = None) as client:
+            responses = await asyncio.gather(*[client.get(f"/scan/SM-X{n:03d}") for n in range(4)])
+            return [x for response in responses for x in response.text.splitlines()]
+
+    # Without a shared limit, 4 scans of all regions would send hundreds of requests at once.
+    with servers(SAMFETCH_UPSTREAM_INITIAL_LIMIT = 4, SAMFETCH_UPSTREAM_QUEUE = 16) as s:
+        lines = asyncio.run(run(s.url))
+        assert lines and not [x for x in lines if '"error"' in x]
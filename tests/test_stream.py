@@ -0,0 +1,179 @@
+"""
+Checks the sessions and resuming of the upstream firmware streams, and the order,
+decryption and retries of the segmented streams.
+"""
+
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+import httpx
+from Crypto.Cipher import AES
+from samfetch.crypto import Crypto
+from samfetch.session import Session
+from samfetch.stream import SegmentedStream, UpstreamStream
+from benchmarks.fake_kies import new_nonce
+
+SIZE = 1024
+
+
+class StubClient:
+    """
+    Answers the download requests with zeros as streamed responses, and rejects the sessions in "rejected".
+    """
+
+    def __init__(self) -> None:
+        self.rejected = set()
+
+    async def send(self, request : httpx.Request, stream : bool = False) -> httpx.Response:
+        await asyncio.sleep(0.01)
+        if any(x.session_id in request.headers.get("Cookie", "") for x in self.rejected):
+            return httpx.Response(401, request = request)
+        start, end = request.headers["Range"].removeprefix("bytes=").split("-")
+        start, end = int(start), int(end)
+        return httpx.Response(
+            206, stream = httpx.ByteStream(bytes(end - start + 1)), request = request,
+            headers = {"Content-Range": f"bytes {start}-{end}/{SIZE}"}
+        )
+
+
+def new_stream(client, session, authorize, release):
+    response = httpx.Response(206, headers = {"Content-Range": f"bytes 0-{SIZE - 1}/{SIZE}"})
+    return UpstreamStream(client, session, "/file.enc4", response, authorize = authorize, release = release)
+
+
+def test_rejected_session_is_renewed_once():
+    async def run():
+        client, released, authorized = StubClient(), [], []
+        rejected = Session(new_nonce(), "rejected")
+        client.rejected.add(rejected)
+
+        async def authorize():
+            authorized.append(Session(new_nonce(), f"new{len(authorized)}"))
+            return authorized[-1]
+
+        stream = new_stream(client, rejected, authorize, lambda session, response = None: released.append(session))
+        # Segments request with the same session at once.
+        responses = await asyncio.gather(*[stream.request(x * 16, x * 16 + 15) for x in range(4)])
+        assert [x.status_code for x in responses] == [206] * 4
+        assert len(authorized) == 1
+        assert released == [rejected]
+        assert stream.session is authorized[0]
+        # Session of the stream is given back once when it is closed.
+        await stream.aclose()
+        await stream.aclose()
+        assert released == [rejected, authorized[0]]
+
+    asyncio.run(run())
+
+
+def test_read_rejects_ignored_range():
+    async def run():
+        class IgnoringClient(StubClient):
+            async def send(self, request, stream = False):
+                return httpx.Response(200, stream = httpx.ByteStream(bytes(SIZE)), request = request)
+
+        stream = new_stream(IgnoringClient(), Session(new_nonce(), "s"), None, None)
+        try:
+            await stream.read(SIZE - 16, 16)
+        except httpx.RemoteProtocolError:
+            return
+        raise AssertionError("Ignored range has been read.")
+
+    asyncio.run(run())
+
+
+def test_read_returns_requested_bytes():
+    async def run():
+        stream = new_stream(StubClient(), Session(new_nonce(), "s"), None, None)
+        assert await stream.read(SIZE - 16, 16) == bytes(16)
+
+    asyncio.run(run())
+
+
+KEY = bytes(range(16))
+PLAIN = random.Random(1).randbytes(1000)
+BLOB = AES.new(KEY, AES.MODE_ECB).encrypt(Crypto.pad(PLAIN))
+SEGMENT = 128
+
+
+class BlobClient:
+    """
+    Answers the ranges of BLOB, with the second segment arriving last, and the ranges in "short" cut once.
+    """
+
+    def __init__(self, short = ()) -> None:
+        self.short = set(short)
+        self.requests = []
+        self.finished = []
+
+    @asynccontextmanager
+    async def host_slot(self, url):
+        yield
+
+    async def send(self, request : httpx.Request, stream : bool = False) -> httpx.Response:
+        start, end = [int(x) for x in request.headers["Range"].removeprefix("bytes=").split("-")]
+        self.requests.append(start)
+        await asyncio.sleep(0.05 if start == SEGMENT else 0)
+        self.finished.append(start)
+        data = BLOB[start:end + 1]
+        if start in self.short:
+            self.short.discard(start)
+            data = data[:-1]
+        response = httpx.Response(
+            206, stream = httpx.ByteStream(data), request = request,
+            headers = {"Content-Range": f"bytes {start}-{end}/{len(BLOB)}", "Content-Length": str(end - start + 1)}
+        )
+        # Like httpx, the body is read at once unless it is streamed.
+        if not stream:
+            await response.aread()
+        return response
+
+
+async def new_segmented(client, reservation = None) -> SegmentedStream:
+    session = Session(new_nonce(), "s")
+    response = await client.send(httpx.Request("GET", "http://kies", headers = {"Range": f"bytes=0-{SEGMENT - 1}"}), stream = True)
+    first = UpstreamStream(client, session, "/file.enc4", response, retries = 1, backoff = 0)
+    return SegmentedStream(first, len(BLOB) - 1, SEGMENT, 3, key = KEY, reservation = reservation)
+
+
+def test_segments_are_yielded_in_order():
+    async def run():
+        client, released = BlobClient(), []
+        stream = await new_segmented(client, SimpleNamespace(release = lambda: released.append(True)))
+        data = b"".join([x async for x in stream.iterate(100)])
+        # Segments have finished out of order, but are decrypted and joined in order, without the padding.
+        assert client.finished != sorted(client.finished)
+        assert data == PLAIN
+        assert (stream.length, stream.total, stream.decrypted) == (len(BLOB), len(BLOB), True)
+        await stream.aclose()
+        assert released == [True]
+
+    asyncio.run(run())
+
+
+def test_short_segment_is_downloaded_again():
+    async def run():
+        client = BlobClient(short = [SEGMENT * 2, len(BLOB) - len(BLOB) % SEGMENT])
+        stream = await new_segmented(client)
+        assert b"".join([x async for x in stream.iterate(SEGMENT)]) == PLAIN
+        assert client.requests.count(SEGMENT * 2) == 2
+        assert client.requests.count(SEGMENT * 3) == 1
+
+    asyncio.run(run())
+
+
+def test_segment_fails_after_retries():
+    async def run():
+        client = BlobClient()
+        stream = await new_segmented(client)
+        stream.first.retries = 0
+        client.short.add(SEGMENT * 2)
+        try:
+            async for _ in stream.iterate(SEGMENT):
+                pass
+        except httpx.RemoteProtocolError:
+            return
+        raise AssertionError("Segment that ended early has been yielded.")
+
+    asyncio.run(run())
@@ -0,0 +1,33 @@
+"""
+Checks that the warm-up becomes ready after the entries that have failed are loaded again.
+"""
+
+import asyncio
+from web.warmup import Warmup
+
+
+class FlakyWarmup(Warmup):
+    """
+    Fails to load every entry "failures" times, as if Kies servers couldn't be reached on start.
+    """
+
+    RETRY_DELAY = 0.01
+
+    def __init__(self, entries, failures : int, **kwargs) -> None:
+        super().__init__(None, entries, **kwargs)
+        self.tries = {x : failures for x in entries}
+
+    async def load(self, entry):
+        self.tries[entry] -= 1
+        return self.tries[entry] < 0
+
+
+def test_failed_entries_are_loaded_again():
+    async def run():
+        warmup = FlakyWarmup([("TUR", "SM-N920C"), ("XAR", "SM-G960F")], 3, share = 1, timeout = 0.01)
+        warmup.start()
+        await asyncio.wait_for(warmup.wait(), 5)
+        await warmup.stop()
+        assert warmup.status()["timed_out"] and (warmup.warm == 2) and (warmup.failed == 0)
+
+    asyncio.run(run())
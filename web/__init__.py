@@ -1,8 +1,26 @@
 __all__ = [
     "bp",
+    "admin_bp",
+    "batch_bp",
+    "metrics_bp",
+    "watch_bp",
+    "warmup_bp",
     "SamfetchError",
-    "make_error"
+    "make_error",
+    "CODECS",
+    "Watcher",
+    "load_watchlist",
+    "Warmup",
+    "load_entries",
+    "save_entries",
+    "top_entries"
 ]
 
 from web.exceptions import SamfetchError, make_error
 from web.routes import bp
+from web.admin import bp as admin_bp
+from web.batch import bp as batch_bp
+from web.metrics import bp as metrics_bp
+from web.watch import bp as watch_bp, Watcher, load_watchlist
+from web.warmup import bp as warmup_bp, Warmup, load_entries, save_entries, top_entries
+from web.lookups import CODECS
@@ -0,0 +1,151 @@
+__all__ = ["bp"]
+
+import hmac
+from sanic import Blueprint
+from sanic.request import Request
+from sanic.response import json
+from sanic.exceptions import NotFound, Unauthorized
+from samfetch.kies import KiesFirmwareList
+from samfetch.crypto import BufferPool
+from samfetch.tuning import calibrate_chunk_size
+from web.exceptions import SamfetchError
+
+bp = Blueprint(name = "Admin", url_prefix = "/admin")
+
+# Caches that can be inspected and purged, as named in app.ctx.
+CACHES = ["firmware_lists", "binary_details", "decrypted_sizes"]
+
+# Converts the keys given to the purge endpoint to the keys of each cache. Firmware versions 
+# (at the end of binary_details keys) and file paths (at the start of decrypted_sizes keys) contain slashes too.
+KEYS = {
+    "firmware_lists": lambda key: tuple(key.split("/", 1)),
+    "binary_details": lambda key: tuple(key.split("/", 2)),
+    "decrypted_sizes": lambda key: tuple(key.rsplit("/", 1))
+}
+
+
+@bp.middleware("request")
+async def check_token(request : Request):
+    # Admin endpoints are only available when a token has been configured.
+    token = request.app.config.SAMFETCH_ADMIN_TOKEN
+    if not token:
+        raise NotFound(f"Requested URL {request.path} not found")
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + token):
+        raise Unauthorized("Invalid admin token.", scheme = "Bearer")
+
+
+def get_cache(request : Request, name : str):
+    if name not in CACHES:
+        raise NotFound(f"Cache {name} not found")
+    return getattr(request.app.ctx, name)
+
+
+def describe(value):
+    # Converts cached values to something that can be sent as JSON.
+    if isinstance(value, SamfetchError):
+        return value.value
+    if isinstance(value, KiesFirmwareList):
+        return ([value.latest] + value.alternate) if value.exists else []
+    return value
+
+
+@bp.get("/cache")
+async def list_caches(request : Request):
+    """
+    Lists the caches with their statistics.
+    """
+    return json({
+        name: {
+            "size": len(getattr(request.app.ctx, name)),
+            "maxsize": getattr(request.app.ctx, name).maxsize,
+            "hits": getattr(request.app.ctx, name).hits,
+            "misses": getattr(request.app.ctx, name).misses,
+            "store_hits": getattr(request.app.ctx, name).store_hits,
+            # Entries in the metadata store, including the ones saved by other workers.
+            "stored": None if request.app.ctx.store is None else request.app.ctx.store.count(name)
+        } for name in CACHES
+    })
+
+
+@bp.get("/cache/<name:str>")
+async def list_cache_entries(request : Request, name : str):
+    """
+    Lists the entries in a cache, including the expired ones.
+    """
+    return json([
+        {
+            "key": "/".join(key),
+            "ttl": None if entry.ttl == float("inf") else round(entry.ttl, 2),
+            "negative": entry.negative,
+            "value": describe(entry.value)
+        } for key, entry in get_cache(request, name).items()
+    ])
+
+
+@bp.delete("/cache/<name:str>")
+async def purge_cache(request : Request, name : str):
+    """
+    Removes the entry given in "key" query parameter from a cache, or all entries if no key has given.
+    Entries are removed from the metadata store too, so other workers load them again once
+    the entries in their memory expire.
+    """
+    cache = get_cache(request, name)
+    key = request.args.get("key", None)
+    if key is None:
+        purged = await cache.clear()
+    else:
+        purged = int(await cache.delete(KEYS[name](key)))
+    return json({"purged": purged})
+
+
+@bp.get("/budget")
+async def get_budget(request : Request):
+    """
+    Shows the memory used by downloads and their buffers from the memory budget, and the chunk sizes of current downloads.
+    """
+    budget = request.app.ctx.budget
+    if budget is None:
+        raise NotFound("Memory budget is not enabled")
+    return json({
+        "limit": budget.limit,
+        "used": budget.used,
+        "free": budget.free,
+        "streams": budget.streams,
+        "waiting": budget.waiting,
+        "refused": budget.refused,
+        "buffered": budget.buffered,
+        "chunk_sizes": sorted(x.chunk_size for x in budget.reservations if x.chunk_size)
+    })
+
+
+@bp.get("/upstream")
+async def get_upstream(request : Request):
+    """
+    Shows the concurrency limit, queue and circuit state of each Kies endpoint.
+    """
+    limiters = request.app.ctx.limiters
+    if limiters is None:
+        raise NotFound("Upstream limiter is not enabled")
+    return json(limiters.state())
+
+
+@bp.post("/calibrate")
+async def calibrate(request : Request):
+    """
+    Finds the chunk size that decrypts fastest on this host and uses it for next downloads.
+    """
+    app = request.app
+    chunk_size, results = await calibrate_chunk_size(
+        budget = app.config.SAMFETCH_STREAM_MEMORY,
+        executor = app.ctx.decryptor,
+        queue_size = app.config.SAMFETCH_PIPELINE_DEPTH,
+        streams = max(app.config.SAMFETCH_DECRYPT_THREADS, 1)
+    )
+    app.config.SAMFETCH_CHUNK_SIZE = chunk_size
+    # Pooled buffers have the size of the previous chunk size.
+    if app.ctx.buffers is not None:
+        app.ctx.buffers = BufferPool(size = chunk_size, count = app.config.SAMFETCH_BUFFER_POOL)
+    return json({
+        "chunk_size": chunk_size,
+        "results": {str(size): round(speed / 1048576, 2) for size, speed in results.items()}
+    })
@@ -0,0 +1,70 @@
+__all__ = ["bp"]
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List
+from sanic import Blueprint
+from sanic.request import Request
+from sanic.response import json
+from sanic.exceptions import InvalidUsage
+from web.exceptions import describe_error
+from web.lookups import fetch_firmware_list, fetch_binary_details
+from web.routes import describe_firmware_list, describe_binary_details, check_firmware
+
+bp = Blueprint(name = "Batch", url_prefix = "/batch")
+
+
+def get_lookups(request : Request, fields : List[str]) -> List[Dict[str, str]]:
+    """
+    Gets the lookups from the request body, which must be a list of objects with given fields.
+    """
+    lookups = request.json
+    if not isinstance(lookups, list):
+        raise InvalidUsage("Request body must be a list of lookups.")
+    if len(lookups) > request.app.config.SAMFETCH_BATCH_MAX_ITEMS:
+        raise InvalidUsage(f"A batch can't have more than {request.app.config.SAMFETCH_BATCH_MAX_ITEMS} lookups.")
+    for lookup in lookups:
+        if (not isinstance(lookup, dict)) or any(not isinstance(lookup.get(x, None), str) for x in fields):
+            raise InvalidUsage("Each lookup must have " + ", ".join(f'"{x}"' for x in fields) + " as strings.")
+    return [{x: lookup[x] for x in fields} for lookup in lookups]
+
+
+async def run_batch(request : Request, lookups : List[Dict[str, str]], run : Callable[..., Awaitable[Any]]) -> List[Dict[str, Any]]:
+    """
+    Runs the lookups at the same time, limited with the configured concurrency, and returns
+    the results in the same order. Failed lookups have the error instead of the result.
+    """
+    limit = asyncio.Semaphore(max(request.app.config.SAMFETCH_BATCH_CONCURRENCY, 1))
+
+    async def run_one(lookup : Dict[str, str]) -> Dict[str, Any]:
+        async with limit:
+            try:
+                return {**lookup, "result": await run(**lookup)}
+            except Exception as e:
+                return {**lookup, "error": describe_error(e)}
+
+    return await asyncio.gather(*[run_one(x) for x in lookups])
+
+
+@bp.post("/list")
+async def get_firmware_lists(request : Request):
+    """
+    Lists the available firmware versions of many devices at once.
+    Body must be a list of objects with "region" and "model".
+    """
+    async def run(region : str, model : str):
+        return describe_firmware_list(await fetch_firmware_list(request.app, region, model))
+
+    return json(await run_batch(request, get_lookups(request, ["region", "model"]), run))
+
+
+@bp.post("/details")
+async def get_binary_details(request : Request):
+    """
+    Gets the firmware details of many devices at once.
+    Body must be a list of objects with "region", "model" and "firmware".
+    """
+    async def run(region : str, model : str, firmware : str):
+        check_firmware(firmware)
+        return describe_binary_details(request, await fetch_binary_details(request.app, region, model, firmware), firmware)
+
+    return json(await run_batch(request, get_lookups(request, ["region", "model", "firmware"]), run))
@@ -1,10 +1,17 @@
 __all__ = [
     "SamfetchError",
-    "make_error"
+    "make_error",
+    "describe_error"
 ]
 
 from enum import Enum
+from typing import Any, Dict
+import httpx
+from samfetch.limiter import UpstreamUnavailable
+from sanic.errorpages import FALLBACK_TEXT
 from sanic.exceptions import SanicException
+from sanic.helpers import STATUS_CODES
+from samfetch.metrics import ERRORS
 
 
 class SamfetchError(Enum):
@@ -41,6 +48,12 @@ class SamfetchError(Enum):
     # Range header is invalid.
     RANGE_HEADER_INVALID = "range_header_invalid"
 
+    # Memory budget for downloads is full, and the download couldn't wait for it.
+    SERVER_BUSY = "server_busy"
+
+    # Decrypted firmware doesn't end with a valid padding, so the decryption key is wrong.
+    DECRYPT_KEY_INVALID = "decrypt_key_invalid"
+
 
 ERROR_MESSAGES = {
     SamfetchError.DEVICE_NOT_FOUND: \
@@ -67,14 +80,44 @@ ERROR_MESSAGES = {
         "SamFetch couldn't connect to Kies servers. Trying again may fix the issue. " + \
         "If you still get this message, you can create a new Issue, so it can be helpful for fixing the problem.",
     SamfetchError.RANGE_HEADER_INVALID: \
-        "Range header has an invalid range."
+        "Range header has an invalid range.",
+    SamfetchError.SERVER_BUSY: \
+        "SamFetch is serving too many downloads at the moment. Try again later.",
+    SamfetchError.DECRYPT_KEY_INVALID: \
+        "Decryption key is not correct for this firmware. Get the key again from the firmware details."
 }
 
 def make_error(enum : SamfetchError, status_code : int) -> SanicException:
+    ERRORS.labels(enum.value).inc()
     return SanicException(
         message = ERROR_MESSAGES.get(enum, "(No error message.)"),
         status_code = status_code,
         context = {
             "id": enum.value
         }
-    )
\ No newline at end of file
+    )
+
+
+def describe_error(exception : Exception) -> Dict[str, Any]:
+    """
+    Creates the same JSON body that is sent for the exception when it is raised in a route,
+    so it can be returned for an item of a batch request. Errors of HTTP requests made to 
+    Kies servers are converted like in the exception handler of the app.
+    """
+    if isinstance(exception, UpstreamUnavailable):
+        exception = make_error(SamfetchError.KIES_SERVER_OUTER_ERROR, 503)
+    elif isinstance(exception, httpx.HTTPError):
+        exception = make_error(
+            SamfetchError.NETWORK_ERROR if isinstance(exception, httpx.NetworkError) else SamfetchError.GENERIC_HTTP_ERROR,
+            500
+        )
+    if not isinstance(exception, SanicException):
+        exception = SanicException(FALLBACK_TEXT, status_code = 500)
+    output = {
+        "description": STATUS_CODES.get(exception.status_code, b"Error Occurred").decode(),
+        "status": exception.status_code,
+        "message": str(exception)
+    }
+    if exception.context:
+        output["context"] = exception.context
+    return output
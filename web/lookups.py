@@ -0,0 +1,265 @@
+__all__ = [
+    "fetch_firmware_list",
+    "fetch_binary_details",
+    "fetch_decrypted_size",
+    "authorize_download",
+    "open_download",
+    "open_segmented",
+    "segment_size",
+    "CODECS"
+]
+
+from typing import Any, Dict, Optional
+import httpx
+from sanic import Sanic
+from samfetch.budget import Reservation
+from samfetch.cache import CacheEntry
+from samfetch.kies import KiesData, KiesFirmwareList, KiesRequest
+from samfetch.crypto import Crypto
+from samfetch.session import Session
+from samfetch.stream import FirmwareStream, SegmentedStream, UpstreamStream
+from Crypto.Cipher import AES
+from web.exceptions import make_error, SamfetchError
+
+
+def encode_firmware_list(value : Any, negative : bool) -> Any:
+    # Negative entries are the status codes of Kies servers.
+    if negative:
+        return value
+    return None if value._versions is None else [value._versions[0], list(value._versions[1])]
+
+
+def decode_firmware_list(data : Any, negative : bool) -> Any:
+    if negative:
+        return int(data)
+    return KiesFirmwareList(None, [], found = False) if data is None else KiesFirmwareList(data[0], data[1])
+
+
+def encode_binary_details(value : Any, negative : bool) -> Any:
+    # Negative entries are the errors of the firmware.
+    return value.value if negative else value
+
+
+def decode_binary_details(data : Any, negative : bool) -> Any:
+    return SamfetchError(data) if negative else dict(data)
+
+
+# Codecs of the caches that need converting their values for storing them, as named in app.ctx.
+CODECS = {
+    "firmware_lists": (encode_firmware_list, decode_firmware_list),
+    "binary_details": (encode_binary_details, decode_binary_details)
+}
+
+
+async def fetch_firmware_list(app : Sanic, region : str, model : str) -> KiesFirmwareList:
+    """
+    Gets the firmware list of a device from the cache, or from Kies servers if it is not cached.
+    """
+    cache = app.ctx.firmware_lists
+    key = (region, model)
+
+    async def load(stale : Optional[CacheEntry]) -> CacheEntry:
+        # Revalidate the expired entry instead of downloading the list again.
+        validators = {} if ((stale is None) or stale.negative) else \
+            {"etag": stale.etag, "last_modified": stale.last_modified}
+        response = await app.ctx.client.send(
+            KiesRequest.list_firmware(region = region, model = model, **validators)
+        )
+        if (response.status_code == 304) and validators:
+            return cache.set(key, stale.value, **validators)
+        # Remember the devices that don't exist for a shorter time.
+        if response.status_code in [403, 404]:
+            return cache.set(key, response.status_code, negative = True)
+        if response.status_code != 200:
+            raise make_error(SamfetchError.DEVICE_NOT_FOUND, response.status_code)
+        return cache.set(
+            key, KiesFirmwareList.from_xml(response.text),
+            etag = response.headers.get("ETag", None),
+            last_modified = response.headers.get("Last-Modified", None)
+        )
+
+    entry = await cache.fetch(key, load)
+    # Raise exception when firmware list couldn't be fetched.
+    if entry.negative:
+        raise make_error(SamfetchError.DEVICE_NOT_FOUND, entry.value)
+    return entry.value
+
+
+async def fetch_binary_details(app : Sanic, region : str, model : str, firmware : str) -> Dict[str, Any]:
+    """
+    Gets the binary details of a firmware from the cache, or from Kies servers if it is not cached.
+    """
+    cache = app.ctx.binary_details
+    key = (region, model, firmware)
+
+    async def load(stale : Optional[CacheEntry]) -> CacheEntry:
+        # Make the request with a session from the pool.
+        sessions = app.ctx.sessions
+        session, binary_info = await sessions.send(
+            lambda session: KiesRequest.get_binary(region = region, model = model, firmware = firmware, session = session)
+        )
+        sessions.release(session, binary_info)
+        # Raise exception when status is not 200.
+        if binary_info.status_code != 200:
+            raise make_error(SamfetchError.KIES_SERVER_OUTER_ERROR, binary_info.status_code)
+        kies = KiesData.from_xml(binary_info.text)
+        # Return error when binary couldn't be found.
+        if kies.status_code != 200:
+            return cache.set(key, SamfetchError.FIRMWARE_NOT_FOUND, negative = True)
+        # Return error if binary is not downloadable.
+        # https://github.com/nlscc/samloader/issues/54
+        if kies.body.get("BINARY_NAME") == None:
+            return cache.set(key, SamfetchError.FIRMWARE_LOST, negative = True)
+        # If file extension ends with .enc4 that means it is using version 4 encryption, otherwise 2 (.enc2).
+        ENCRYPT_VERSION = 4 if str(kies.body["BINARY_NAME"]).endswith("4") else 2
+        # Generate decrypted key for decrypting the file after downloading.
+        # Decrypt key gives a list of bytes, but as it is not possible to send as query parameter, 
+        # we are converting it to a single HEX value.
+        decryption_key = \
+            session.getv2key(firmware, model, region).hex() if ENCRYPT_VERSION == 2 else \
+            session.getv4key(kies.body.get_first("LATEST_FW_VERSION", "ADD_LATEST_FW_VERSION"), kies.body["LOGIC_VALUE_FACTORY"]).hex()
+        return cache.set(key, {
+            "display_name": kies.body["DEVICE_MODEL_DISPLAYNAME"],
+            "size": int(kies.body["BINARY_BYTE_SIZE"]),
+            "filename": kies.body["BINARY_NAME"],
+            "path": kies.body["MODEL_PATH"],
+            "version": kies.body["CURRENT_OS_VERSION"].replace("(", " ("),
+            "encrypt_version": ENCRYPT_VERSION,
+            "last_modified": int(kies.body["LAST_MODIFIED"]),
+            "decrypt_key": decryption_key,
+            # A URL of samsungmobile that includes release changelogs.
+            # Not available for every device.
+            "firmware_changelog_url": kies.body.get_first("DESCRIPTION", "ADD_DESCRIPTION"),
+            "platform": kies.body["DEVICE_PLATFORM"],
+            "crc": kies.body["BINARY_CRC"]
+        })
+
+    entry = await cache.fetch(key, load)
+    if entry.negative:
+        raise make_error(entry.value, 404)
+    return entry.value
+
+
+async def fetch_decrypted_size(app : Sanic, path : str, stream : FirmwareStream, key : bytes) -> int:
+    """
+    Gets the size of a firmware after decrypting, by reading and decrypting its last block 
+    to find out the padding length. Sizes are cached for each file and key.
+    Raises an error if the padding is not valid, as the key is wrong then.
+    """
+    cache = app.ctx.decrypted_sizes
+    cache_key = (path, key.hex())
+
+    async def load(stale : Optional[CacheEntry]) -> CacheEntry:
+        try:
+            block = AES.new(key, AES.MODE_ECB).decrypt(await stream.read(stream.total - 16, 16))
+        except httpx.HTTPStatusError as e:
+            raise make_error(SamfetchError.KIES_SERVER_ERROR, e.response.status_code)
+        if not Crypto.padded(block):
+            raise make_error(SamfetchError.DECRYPT_KEY_INVALID, 400)
+        return cache.set(cache_key, stream.total - (len(block) - len(Crypto.unpad(block))))
+
+    return (await cache.fetch(cache_key, load)).value
+
+
+async def authorize_download(app : Sanic, path : str) -> Session:
+    """
+    Gets a session from the pool that is allowed to download the firmware file.
+    """
+    sessions = app.ctx.sessions
+    # Make the request with a session from the pool.
+    session, download_info = await sessions.send(
+        lambda session: KiesRequest.get_download(path = path, session = session)
+    )
+    try:
+        # Raise exception when status is not 200.
+        if download_info.status_code != 200:
+            raise make_error(SamfetchError.KIES_SERVER_OUTER_ERROR, download_info.status_code)
+        kies = KiesData.from_xml(download_info.text)
+        # Return error when binary couldn't be found.
+        if kies.status_code != 200:
+            raise make_error(SamfetchError.KIES_SERVER_ERROR, kies.status_code)
+    except BaseException:
+        # Give the session back to the pool, so failed downloads don't drain it.
+        sessions.release(session, download_info)
+        raise
+    # Refresh session.
+    session.refresh_session(download_info)
+    return session
+
+
+async def open_download(app : Sanic, path : str, custom_range : Optional[str] = None) -> UpstreamStream:
+    """
+    Authorizes the download of a firmware file and starts streaming it from Kies servers.
+    Session of the stream is given back to the pool when the stream is closed.
+    """
+    client = app.ctx.client
+    sessions = app.ctx.sessions
+    session = await authorize_download(app, path)
+    try:
+        download_file = await client.send(
+            KiesRequest.start_download(path = path, session = session, custom_range = custom_range),
+            stream = True
+        )
+    except BaseException:
+        # Give the session back to the pool, so failed downloads don't drain it.
+        sessions.release(session, None)
+        raise
+    session.refresh_session(download_file)
+    # Check if status code is not 200 or 206.
+    if download_file.status_code not in [200, 206]:
+        sessions.release(session, download_file)
+        await download_file.aclose()
+        raise make_error(SamfetchError.KIES_SERVER_ERROR, download_file.status_code)
+    # If the connection drops, the stream continues with a new request.
+    return UpstreamStream(
+        client, session, path, download_file,
+        retries = app.config.SAMFETCH_RESUME_RETRIES,
+        backoff = app.config.SAMFETCH_RESUME_BACKOFF / 1000,
+        authorize = lambda: authorize_download(app, path),
+        release = sessions.release
+    )
+
+
+def segment_size(app : Sanic) -> int:
+    # Segments must contain whole blocks, so they can be decrypted on their own.
+    return max(app.config.SAMFETCH_SEGMENT_SIZE // 16 * 16, 16)
+
+
+async def open_segmented(
+    app : Sanic, path : str, start : int, end : Optional[int], key : Optional[bytes] = None,
+    reservation : Optional[Reservation] = None
+) -> FirmwareStream:
+    """
+    Starts downloading a firmware file from Kies servers in parallel segments if it is enabled, 
+    and decrypts the segments if a key has given. Session of the stream is given back 
+    to the pool when the stream is closed.
+    Reservation is the memory for the segments that are held at once, which is owned by 
+    the stream, or released if the file is not downloaded in segments.
+    """
+    if app.config.SAMFETCH_SEGMENTS <= 1:
+        if reservation is not None:
+            reservation.release()
+        return await open_download(app, path, None if (start, end) == (0, None) else \
+            f"bytes={start}-{'' if end is None else end}")
+    size = segment_size(app)
+    first_end = start + size - 1 if end is None else min(start + size - 1, end)
+    try:
+        first = await open_download(app, path, f"bytes={start}-{first_end}")
+    except BaseException:
+        if reservation is not None:
+            reservation.release()
+        raise
+    # Server has ignored the range, so stream the file with a single connection.
+    if not first.partial:
+        if reservation is not None:
+            reservation.release()
+        return first
+    return SegmentedStream(
+        first = first,
+        end = first.total - 1 if end is None else min(end, first.total - 1),
+        segment_size = size,
+        segments = app.config.SAMFETCH_SEGMENTS,
+        key = key,
+        executor = app.ctx.decryptor,
+        reservation = reservation
+    )
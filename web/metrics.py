@@ -0,0 +1,70 @@
+__all__ = ["bp"]
+
+import hmac
+from sanic import Blueprint
+from sanic.request import Request
+from sanic.response import text
+from sanic.exceptions import NotFound, Unauthorized
+from samfetch.metrics import REGISTRY, Counter, Gauge, render
+
+bp = Blueprint(name = "Metrics")
+
+# Caches that have hit and miss counts, as named in app.ctx.
+CACHES = ["firmware_lists", "binary_details", "decrypted_sizes", "blobs"]
+
+
+@bp.get("/metrics")
+async def get_metrics(request : Request):
+    """
+    Exposes the metrics in Prometheus text format. If an admin token has been configured,
+    it is required here too, as metrics show the traffic and the state of the server.
+    """
+    if not request.app.config.SAMFETCH_METRICS:
+        raise NotFound(f"Requested URL {request.path} not found")
+    token = request.app.config.SAMFETCH_ADMIN_TOKEN
+    if token and not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + token):
+        raise Unauthorized("Invalid admin token.", scheme = "Bearer")
+    # Cache counters are kept by the caches themselves, so read them when they are requested.
+    hits = Counter("samfetch_cache_hits_total", "Number of lookups that have been found in the cache.", ["cache"])
+    misses = Counter("samfetch_cache_misses_total", "Number of lookups that haven't been found in the cache.", ["cache"])
+    sizes = Gauge("samfetch_cache_entries", "Number of entries in the cache.", ["cache"])
+    store_hits = Counter("samfetch_cache_store_hits_total", "Number of lookups that have been found in the metadata store, but not in the memory.", ["cache"])
+    for name in CACHES:
+        cache = getattr(request.app.ctx, name, None)
+        if cache is None:
+            continue
+        hits.labels(name).inc(cache.hits)
+        misses.labels(name).inc(cache.misses)
+        sizes.labels(name).set(len(cache))
+        if getattr(cache, "store", None) is not None:
+            store_hits.labels(name).inc(cache.store_hits)
+    extra = [hits, misses, sizes, store_hits]
+    budget = request.app.ctx.budget
+    if budget is not None:
+        limit = Gauge("samfetch_memory_budget_bytes", "Bytes that downloads can hold in the memory in total.")
+        used = Gauge("samfetch_memory_budget_used_bytes", "Bytes of the memory budget reserved by downloads.")
+        waiting = Gauge("samfetch_memory_budget_waiting", "Number of downloads waiting for the memory budget.")
+        refused = Counter("samfetch_memory_budget_refused_total", "Number of downloads refused as the memory budget was full.")
+        limit.set(budget.limit)
+        used.set(budget.used)
+        waiting.set(budget.waiting)
+        refused.inc(budget.refused)
+        extra.extend([limit, used, waiting, refused])
+    limiters = request.app.ctx.limiters
+    if limiters is not None:
+        limit = Gauge("samfetch_upstream_limit", "Number of concurrent requests allowed to the Kies endpoint, by call.", ["call"])
+        in_flight = Gauge("samfetch_upstream_in_flight", "Number of requests being made to the Kies endpoint, by call.", ["call"])
+        queued = Gauge("samfetch_upstream_queued", "Number of requests waiting for the limit of the Kies endpoint, by call.", ["call"])
+        circuit = Gauge("samfetch_upstream_circuit_open", "1 if requests to the Kies endpoint fail at once as it is unhealthy, by call.", ["call"])
+        rejected = Counter("samfetch_upstream_rejected_total", "Number of requests that haven't been sent by the limiter, by call.", ["call"])
+        for name, limiter in limiters.limiters.items():
+            limit.labels(name).set(int(limiter.limit))
+            in_flight.labels(name).set(limiter.in_flight)
+            queued.labels(name).set(limiter.queued)
+            circuit.labels(name).set(int(limiter.circuit != limiter.CLOSED))
+            rejected.labels(name).inc(limiter.rejected)
+        extra.extend([limit, in_flight, queued, circuit, rejected])
+    return text(
+        render(REGISTRY + extra),
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -1,35 +1,44 @@
-__all__ = ["bp"]
+__all__ = [
+    "bp",
+    "describe_firmware_list",
+    "describe_binary_details",
+    "check_firmware"
+]
 
-from typing import Optional
+from typing import Any, Dict, List, Optional
 from sanic import Blueprint
 from sanic.request import Request
-from sanic.response import json, redirect
-from sanic.exceptions import NotFound
-from samfetch.kies import KiesData, KiesFirmwareList, KiesRequest, KiesUtils
-from samfetch.session import Session
+from sanic.response import json, json_dumps, redirect
+from sanic.exceptions import InvalidUsage
+from samfetch.kies import KiesFirmwareList, KiesUtils
 from samfetch.crypto import start_decryptor
-from web.exceptions import make_error, SamfetchError
-import httpx
+from samfetch.stream import FirmwareStream, FileStream, UpstreamStream
+from samfetch.fanout import Subscription
+from samfetch.budget import BudgetExceeded, Reservation
+from samfetch.regions import REGIONS
+from web.exceptions import describe_error, make_error, SamfetchError
+from web.lookups import fetch_firmware_list, fetch_binary_details, fetch_decrypted_size, open_download, open_segmented, segment_size
+import asyncio
 import re
 
 bp = Blueprint(name = "Routes")
 
+REGION_PATTERN = re.compile(r"[A-Z0-9]{3}")
+FIRMWARE_PATTERN = re.compile(r"[A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*")
 
-@bp.get("/<region:str>/<model:str>/list")
-async def get_firmware_list(request : Request, region : str, model : str):
+
+def check_firmware(firmware : str) -> None:
     """
-    List the available firmware versions of a specified model and region.
+    Raises the error of a firmware that doesn't exist if the firmware version is not in the known format.
+    """
+    if not FIRMWARE_PATTERN.fullmatch(firmware):
+        raise make_error(SamfetchError.FIRMWARE_NOT_FOUND, 404)
+
+
+def describe_firmware_list(firmwares : KiesFirmwareList) -> List[Dict[str, Any]]:
+    """
+    Creates the response of a firmware list, or raises the error if it doesn't contain any firmware.
     """
-    client = httpx.AsyncClient()
-    response = await client.send(
-        KiesRequest.list_firmware(region = region, model = model)
-    )
-    await client.aclose()
-    # Raise exception when firmware list couldn't be fetched.
-    if response.status_code != 200:
-        raise make_error(SamfetchError.DEVICE_NOT_FOUND, response.status_code)
-    # Parse XML
-    firmwares = KiesFirmwareList.from_xml(response.text)
     # Check if model is correct by checking the "versioninfo" key.
     if firmwares.exists:
         # Return the firmware data.
@@ -41,29 +50,97 @@ async def get_firmware_list(request : Request, region : str, model : str):
                 fff["is_latest"] = True
             fff["pda"] = info
             ff.append(fff)
-        return json(ff)
+        return ff
     # Raise exception when device couldn't be found.
     if firmwares._versions == None:
         raise make_error(SamfetchError.FIRMWARE_LIST_EMPTY, 404)
     raise make_error(SamfetchError.FIRMWARE_CANT_PARSE, 404)
 
 
+def describe_binary_details(request : Request, details : Dict[str, Any], firmware : str) -> Dict[str, Any]:
+    """
+    Creates the response of binary details, with download links for this server.
+    """
+    download_path = f'/file{details["path"]}{details["filename"]}'
+    server_path = f"{request.scheme}://{request.server_name}{'' if request.server_port in [80, 443] else ':' + str(request.server_port)}"
+    return {
+        "display_name": details["display_name"],
+        "size": details["size"],
+        # Convert bytes to GB, so it will be more readable for an end-user.
+        "size_readable": "{:.2f} GB".format(float(details["size"]) / 1024 / 1024 / 1024),
+        "filename": details["filename"],
+        "path": details["path"],
+        "version": details["version"],
+        "encrypt_version": details["encrypt_version"],
+        "last_modified": details["last_modified"],
+        "decrypt_key": details["decrypt_key"],
+        "firmware_changelog_url": details["firmware_changelog_url"],
+        "platform": details["platform"],
+        "crc": details["crc"],
+        "download_path": server_path + download_path,
+        "download_path_decrypt": server_path + download_path + "?decrypt=" + details["decrypt_key"],
+        "pda": KiesUtils.read_firmware_dict(firmware)
+    }
+
+
+@bp.get("/<region:str>/<model:str>/list")
+async def get_firmware_list(request : Request, region : str, model : str):
+    """
+    List the available firmware versions of a specified model and region.
+    """
+    firmwares = await fetch_firmware_list(request.app, region, model)
+    return json(describe_firmware_list(firmwares))
+
+
+@bp.get("/scan/<model:str>")
+async def scan_regions(request : Request, model : str):
+    """
+    Lists the available firmware versions of a model in all regions at the same time, 
+    and streams each result as soon as it completes. Regions can be given with "regions" query 
+    parameter separated with comma, otherwise all known regions are scanned. Results are sent as 
+    JSON lines, or as Server-Sent Events if "format" is "sse" or the client accepts "text/event-stream".
+    """
+    regions = [x.strip().upper() for x in request.args.get("regions", "").split(",") if x.strip()] or REGIONS
+    # Remove duplicates while keeping the order.
+    regions = list(dict.fromkeys(regions))
+    if len(regions) > request.app.config.SAMFETCH_SCAN_MAX_REGIONS:
+        raise InvalidUsage(f"A scan can't have more than {request.app.config.SAMFETCH_SCAN_MAX_REGIONS} regions.")
+    invalid = [x for x in regions if not REGION_PATTERN.fullmatch(x)]
+    if invalid:
+        raise InvalidUsage(f"Regions must be 3 letters or digits, but got: {', '.join(invalid[:10])}")
+    SSE = (request.args.get("format", None) == "sse") or ("text/event-stream" in request.headers.get("Accept", ""))
+
+    async def scan(region : str) -> Dict[str, Any]:
+        async with request.app.ctx.scan_limit:
+            try:
+                return {"region": region, "result": describe_firmware_list(await fetch_firmware_list(request.app, region, model))}
+            except Exception as e:
+                return {"region": region, "error": describe_error(e)}
+
+    tasks = [asyncio.create_task(scan(x)) for x in regions]
+    try:
+        response = await request.respond(
+            content_type = "text/event-stream" if SSE else "application/x-ndjson",
+            headers = {"Cache-Control": "no-cache"}
+        )
+        for task in asyncio.as_completed(tasks):
+            result = json_dumps(await task)
+            await response.send(f"event: region\ndata: {result}\n\n" if SSE else result + "\n")
+        if SSE:
+            await response.send("event: done\ndata: {}\n\n")
+        await response.eof()
+    finally:
+        # Stop scanning if the client has gone.
+        for task in tasks:
+            task.cancel()
+
+
 @bp.get("/<region:str>/<model:str>/<mode:(latest|latest/download)>")
 async def get_firmware_latest(request : Request, region : str, model : str, mode : str):
     """
     Gets the latest firmware version for the device and redirects to its information.
     """
-    # Create new session.
-    client = httpx.AsyncClient()
-    response = await client.send(
-        KiesRequest.list_firmware(region = region, model = model)
-    )
-    await client.aclose()
-    # Raise exception when firmware list couldn't be fetched.
-    if response.status_code != 200:
-        raise make_error(SamfetchError.DEVICE_NOT_FOUND, response.status_code)
-    # Parse XML
-    firmwares = KiesFirmwareList.from_xml(response.text)
+    firmwares = await fetch_firmware_list(request.app, region, model)
     # Check if model is correct by checking the "versioninfo" key.
     if firmwares.exists:
         return redirect(f"/{region}/{model}/{firmwares.latest}" + ("/download" if "/download" in mode else ""))
@@ -74,7 +151,8 @@ async def get_firmware_latest(request : Request, region : str, model : str, mode
 
 
 # Gets the binary details such as filename and decrypt key.
-@bp.get("/<region:str>/<model:str>/<firmware_path:([A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*[/download]*)>")
+# Firmware is checked in the route instead of the path pattern, so it gives the same error as batch lookups.
+@bp.get("/<region:str>/<model:str>/<firmware_path:(?P<firmware_path>[^/]+/[^/]+/[^/]+/[^/]+(?:/download)?/?)>")
 async def get_binary_details(request : Request, region: str, model: str, firmware_path: str):
     """
     Gets the firmware details such as path, filename and decrypt key. 
@@ -83,63 +161,14 @@ async def get_binary_details(request : Request, region: str, model: str, firmwar
     # Check if "/download" path has appended to firmware value.
     is_download = firmware_path.removesuffix("/").endswith("/download")
     firmware = firmware_path.removesuffix("/").removesuffix("/download")
-    if not re.match(r"^[A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*/[A-Z0-9]*$", firmware):
-        raise NotFound(f"Requested URL {request.path} not found")
-    # Create new session.
-    client = httpx.AsyncClient()
-    nonce = await client.send(KiesRequest.get_nonce())
-    session = Session.from_response(nonce)
-    # Make the request.
-    binary_info = await client.send(
-        KiesRequest.get_binary(region = region, model = model, firmware = firmware, session = session)
-    )
-    await client.aclose()
-    # Read the request.
-    if binary_info.status_code == 200:
-        kies = KiesData.from_xml(binary_info.text)
-        # Return error when binary couldn't be found.
-        if kies.status_code != 200:
-            raise make_error(SamfetchError.FIRMWARE_NOT_FOUND, 404)
-        # Return error if binary is not downloadable.
-        # https://github.com/nlscc/samloader/issues/54
-        if kies.body.get("BINARY_NAME") == None:
-            raise make_error(SamfetchError.FIRMWARE_LOST, 404)
-        # If file extension ends with .enc4 that means it is using version 4 encryption, otherwise 2 (.enc2).
-        ENCRYPT_VERSION = 4 if str(kies.body["BINARY_NAME"]).endswith("4") else 2
-        # Generate decrypted key for decrypting the file after downloading.
-        # Decrypt key gives a list of bytes, but as it is not possible to send as query parameter, 
-        # we are converting it to a single HEX value.
-        decryption_key = \
-            session.getv2key(firmware, model, region).hex() if ENCRYPT_VERSION == 2 else \
-            session.getv4key(kies.body.get_first("LATEST_FW_VERSION", "ADD_LATEST_FW_VERSION"), kies.body["LOGIC_VALUE_FACTORY"]).hex()
-        # If auto downloading has enabled, redirect to downloading the firmware.
-        download_path = f'/file{kies.body["MODEL_PATH"]}{kies.body["BINARY_NAME"]}'
-        if is_download:
-            return redirect(download_path + "?decrypt=" + decryption_key)
-        server_path = f"{request.scheme}://{request.server_name}{'' if request.server_port in [80, 443] else ':' + str(request.server_port)}"
-        # Get binary details.
-        return json({
-            "display_name": kies.body["DEVICE_MODEL_DISPLAYNAME"],
-            "size": int(kies.body["BINARY_BYTE_SIZE"]),
-            # Convert bytes to GB, so it will be more readable for an end-user.
-            "size_readable": "{:.2f} GB".format(float(kies.body["BINARY_BYTE_SIZE"]) / 1024 / 1024 / 1024),
-            "filename": kies.body["BINARY_NAME"],
-            "path": kies.body["MODEL_PATH"],
-            "version": kies.body["CURRENT_OS_VERSION"].replace("(", " ("),
-            "encrypt_version": ENCRYPT_VERSION,
-            "last_modified": int(kies.body["LAST_MODIFIED"]),
-            "decrypt_key": decryption_key,
-            # A URL of samsungmobile that includes release changelogs.
-            # Not available for every device.
-            "firmware_changelog_url": kies.body.get_first("DESCRIPTION", "ADD_DESCRIPTION"),
-            "platform": kies.body["DEVICE_PLATFORM"],
-            "crc": kies.body["BINARY_CRC"],
-            "download_path": server_path + download_path,
-            "download_path_decrypt": server_path + download_path + "?decrypt=" + decryption_key,
-            "pda": KiesUtils.read_firmware_dict(firmware)
-        })
-    # Raise exception when status is not 200.
-    raise make_error(SamfetchError.KIES_SERVER_OUTER_ERROR, binary_info.status_code)
+    check_firmware(firmware)
+    details = await fetch_binary_details(request.app, region, model, firmware)
+    # If auto downloading has enabled, redirect to downloading the firmware.
+    download_path = f'/file{details["path"]}{details["filename"]}'
+    if is_download:
+        return redirect(download_path + "?decrypt=" + details["decrypt_key"])
+    # Get binary details.
+    return json(describe_binary_details(request, details, firmware))
 
 
 @bp.get("/file/<path:path>/<filename:str>")
@@ -153,73 +182,166 @@ async def download_binary(request : Request, path: str, filename: str):
     decrypt_key = args.get("decrypt", None)
     DECRYPT_ENABLED : bool = decrypt_key != None
     CUSTOM_FILENAME : Optional[str] = None if "filename" not in args else str(args.get("filename")).removesuffix(".zip") + ".zip"
-    # Create new session.
-    client = httpx.AsyncClient()
-    nonce = await client.send(KiesRequest.get_nonce())
-    session = Session.from_response(nonce)
-    # Make the request.
-    download_info = await client.send(
-        KiesRequest.get_download(path = KiesUtils.join_path(path, filename), session = session)
-    )
-    # Refresh session.
-    session.refresh_session(download_info)
-    # Read the request.
-    if download_info.status_code == 200:
-        kies = KiesData.from_xml(download_info.text)
-        # Return error when binary couldn't be found.
-        if kies.status_code != 200:
-            await client.aclose()
-            raise make_error(SamfetchError.KIES_SERVER_ERROR, kies.status_code)
-        # Else, make another request to get the binary.
+    FILE_PATH = KiesUtils.join_path(path, filename)
+    # Check and parse the range header.
+    RANGE : Optional[str] = request.headers.get("Range", None)
+    START_RANGE, END_RANGE = KiesUtils.parse_range_header(RANGE or "bytes=0-")
+    # Check if range is invalid.
+    if (START_RANGE == -1) or (END_RANGE == -1):
+        raise make_error(SamfetchError.RANGE_HEADER_INVALID, 416)
+    # Firmwares are encrypted with AES-ECB, so each 16 byte block can be decrypted on its own.
+    # When decrypting, request the blocks that contain the range, and trim the extra bytes after decrypting.
+    UPSTREAM_START, UPSTREAM_END = KiesUtils.align_range(START_RANGE, END_RANGE) if DECRYPT_ENABLED else (START_RANGE, END_RANGE)
+    # Serve the file from the disk if it has been downloaded before, 
+    # otherwise make another request for streaming the firmware.
+    blobs = request.app.ctx.blobs
+    fanout = request.app.ctx.fanout
+    LOCAL_FILE = None if blobs is None else blobs.get(FILE_PATH)
+    # Segments are decrypted as they arrive, unless the encrypted file is being saved to the disk.
+    SEGMENT_KEY = bytes.fromhex(decrypt_key) if DECRYPT_ENABLED and (blobs is None) else None
+
+    SHARED = (fanout is not None) and (not RANGE)
+    SEGMENTS = request.app.config.SAMFETCH_SEGMENTS
+    SEGMENT_MEMORY = 0 if LOCAL_FILE or (SEGMENTS <= 1) else SEGMENTS * segment_size(request.app)
+    BUFFER_MEMORY = fanout.capacity if SHARED else 0
+    # Memory for the segments and the shared buffer, which are owned by their streams once they are opened.
+    segments : Optional[Reservation] = None
+    buffer : Optional[Reservation] = None
+
+    async def open_stream(start : int, end : Optional[int]) -> FirmwareStream:
+        if LOCAL_FILE:
+            return FileStream(LOCAL_FILE, start, end)
+        return await open_segmented(request.app, FILE_PATH, start, end, SEGMENT_KEY, segments)
+
+    async def open_fallback(offset : int) -> FirmwareStream:
+        # Downloads that can't keep up with the shared stream continue from where they left.
+        # There is no memory reserved for them, so they stream with a single connection.
+        if LOCAL_FILE:
+            fallback = FileStream(LOCAL_FILE, offset, None)
         else:
-            # Check and parse the range header.
-            START_RANGE, END_RANGE = KiesUtils.parse_range_header(request.headers.get("Range", "bytes=0-"))
-            # Check if range is invalid.
-            if (START_RANGE == -1) or (END_RANGE == -1) or (DECRYPT_ENABLED and (END_RANGE != 0)):
-                await client.aclose()
-                raise make_error(SamfetchError.RANGE_HEADER_INVALID, 416)
-            # Another request for streaming the firmware.
-            download_file = await client.send(
-                KiesRequest.start_download(
-                    path = KiesUtils.join_path(path, filename), 
-                    session = session,
-                    custom_range = request.headers.get("Range", None)
-                ),
-                stream = True
-            )
-            # Check if status code is not 200 or 206.
-            if download_file.status_code not in [200, 206]:
-                # Raise HTTPException when status is not success.
-                await client.aclose()
-                raise make_error(SamfetchError.KIES_SERVER_ERROR, download_file.status_code)
-            # Create headers.
-            headers = { 
-                "Content-Disposition": 'attachment; filename="' + \
-                    (CUSTOM_FILENAME or (filename if not DECRYPT_ENABLED else filename.replace(".enc4", "").replace(".enc2", ""))) + '"',
-                # Get the total size of binary.
-                "Content-Length": download_file.headers["Content-Length"],
-                "Accept-Ranges": "bytes",
-                "Connection": "keep-alive"
-            }
-            if "Content-Range" in download_file.headers:
-                headers["Content-Range"] = download_file.headers["Content-Range"]
-            # If decryption is enabled, remove Content-Length.
-            # Because when we decrypt the firmware, it becomes slightly bigger or smaller
-            # so this causes exceptions as Content-Length is not same as sent file size.
-            if DECRYPT_ENABLED:
-                del headers["Content-Length"]
-            # Decrypt bytes while downloading the file.
-            # So this way, we can directly serve the bytes to the client without downloading to the disk.
-            response = await request.respond(
-                headers = headers,
-                content_type = "application/zip" if DECRYPT_ENABLED else "application/octet-stream",
-                status = download_file.status_code
-            )
-            await start_decryptor(
-                response = response,
-                iterator = download_file.aiter_raw(chunk_size = request.app.config.SAMFETCH_CHUNK_SIZE),
+            fallback = await open_download(request.app, FILE_PATH, f"bytes={offset}-")
+        if fallback.start != offset:
+            await fallback.aclose()
+            raise make_error(SamfetchError.KIES_SERVER_ERROR, fallback.status)
+        return fallback
+
+    async def open_shared():
+        source = await open_stream(0, None)
+        iterator = source.iterate(chunk_size = request.app.config.SAMFETCH_CHUNK_SIZE)
+        if (blobs is not None) and (not LOCAL_FILE):
+            iterator = blobs.tee(FILE_PATH, source.total, iterator)
+        return source, iterator
+
+    # Reserve memory for the download before opening the stream, so downloads that wait
+    # for the budget don't hold upstream connections. Segments and the shared buffer are 
+    # reserved together with it, so a download never waits for memory while holding some.
+    budget = request.app.ctx.budget
+    reservation = None
+    if budget is not None:
+        try:
+            reservation = await budget.acquire(request.app.config.SAMFETCH_CHUNK_SIZE, extra = SEGMENT_MEMORY + BUFFER_MEMORY)
+        except BudgetExceeded:
+            raise make_error(SamfetchError.SERVER_BUSY, 503)
+        segments = reservation.detach(SEGMENT_MEMORY) if SEGMENT_MEMORY else None
+        buffer = reservation.detach(BUFFER_MEMORY) if BUFFER_MEMORY else None
+    try:
+        # Full downloads of the same file share a single stream, so join it if there is one already.
+        if SHARED:
+            stream = await fanout.subscribe(
+                (FILE_PATH, decrypt_key), open_shared,
                 key = None if not DECRYPT_ENABLED else bytes.fromhex(decrypt_key),
-                client = client
+                executor = request.app.ctx.decryptor,
+                fallback = open_fallback,
+                reservation = buffer
             )
-    # Raise exception when status is not 200.
-    raise make_error(SamfetchError.KIES_SERVER_OUTER_ERROR, download_info.status_code)
\ No newline at end of file
+            # Download has joined a shared stream that is already open, so its buffers are not needed.
+            if stream.shared.reservation is not buffer:
+                for unused in (segments, buffer):
+                    if unused is not None:
+                        unused.release()
+        else:
+            stream = await open_stream(UPSTREAM_START, UPSTREAM_END)
+    except BaseException:
+        for unused in (reservation, segments, buffer):
+            if unused is not None:
+                unused.release()
+        raise
+    try:
+        if stream.length <= 0:
+            raise make_error(SamfetchError.RANGE_HEADER_INVALID, 416)
+        # Create headers.
+        headers = { 
+            "Content-Disposition": 'attachment; filename="' + \
+                (CUSTOM_FILENAME or (filename if not DECRYPT_ENABLED else filename.replace(".enc4", "").replace(".enc2", ""))) + '"',
+            # Get the total size of binary.
+            "Content-Length": str(stream.length),
+            "Accept-Ranges": "bytes",
+            "Connection": "keep-alive"
+        }
+        if stream.partial:
+            headers["Content-Range"] = stream.content_range
+        # Bytes to trim from the decrypted stream, and whether it ends with the padded last block.
+        SKIP, LENGTH, UNPAD = 0, None, True
+        if DECRYPT_ENABLED:
+            UNPAD = stream.end + 1 == stream.total
+            # When we decrypt the firmware, it becomes slightly smaller because of the padding,
+            # so read the padding length from the last block to report the exact size.
+            # It is needed for ranges that don't reach the end too, so clients can resume downloads.
+            try:
+                DECRYPTED_TOTAL = await fetch_decrypted_size(request.app, FILE_PATH, stream, bytes.fromhex(decrypt_key))
+            except Exception as e:
+                # Size of the ranges that end with the last block can't be known without it,
+                # and a wrong key (400) fails every range.
+                if UNPAD or (getattr(e, "status_code", None) == 400):
+                    raise
+                DECRYPTED_TOTAL = None
+            SKIP = START_RANGE - stream.start
+            LAST = stream.end if END_RANGE is None else END_RANGE
+            if DECRYPTED_TOTAL is not None:
+                LAST = min(LAST, DECRYPTED_TOTAL - 1)
+            LENGTH = LAST - START_RANGE + 1
+            if LENGTH <= 0:
+                raise make_error(SamfetchError.RANGE_HEADER_INVALID, 416)
+            headers["Content-Length"] = str(LENGTH)
+            if RANGE:
+                headers["Content-Range"] = f"bytes {START_RANGE}-{LAST}/{'*' if DECRYPTED_TOTAL is None else DECRYPTED_TOTAL}"
+    except BaseException:
+        await stream.aclose()
+        if reservation is not None:
+            reservation.release()
+        raise
+    # With a memory budget, chunks are resized while streaming, so read the upstream in the pieces
+    # that arrive from the network, which are joined to the current chunk size instead of holding a big chunk.
+    iterator = stream.iterate(
+        chunk_size = None if (reservation is not None) and isinstance(stream, UpstreamStream) else \
+            request.app.config.SAMFETCH_CHUNK_SIZE
+    )
+    # Save the whole file to the disk while sending it, so next downloads can be served from the disk.
+    if (blobs is not None) and (not LOCAL_FILE) and (not stream.partial) and (not isinstance(stream, Subscription)):
+        iterator = blobs.tee(FILE_PATH, stream.total, iterator)
+    # Decrypt bytes while downloading the file.
+    # So this way, we can directly serve the bytes to the client without downloading to the disk.
+    # Release the upstream connection and its session back to the pools whatever happens to the stream.
+    try:
+        response = await request.respond(
+            headers = headers,
+            content_type = "application/zip" if DECRYPT_ENABLED else "application/octet-stream",
+            status = 206 if (DECRYPT_ENABLED and RANGE) else stream.status
+        )
+        await start_decryptor(
+            response = response,
+            iterator = iterator,
+            key = None if (not DECRYPT_ENABLED) or stream.decrypted else bytes.fromhex(decrypt_key),
+            executor = request.app.ctx.decryptor,
+            queue_size = request.app.config.SAMFETCH_PIPELINE_DEPTH,
+            skip = SKIP,
+            length = LENGTH,
+            unpad = UNPAD,
+            pool = request.app.ctx.buffers,
+            plain = stream.decrypted,
+            reservation = reservation
+        )
+    finally:
+        await stream.aclose()
+        if reservation is not None:
+            reservation.release()
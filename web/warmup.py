@@ -0,0 +1,214 @@
+__all__ = [
+    "bp",
+    "Warmup",
+    "load_entries",
+    "save_entries",
+    "top_entries"
+]
+
+import asyncio
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from sanic import Blueprint, Sanic
+from sanic.log import logger
+from sanic.request import Request
+from sanic.response import json
+from web.lookups import fetch_firmware_list, fetch_binary_details
+
+bp = Blueprint(name = "Warmup")
+
+# A device as (region, model), or a firmware as (region, model, firmware).
+Entry = Tuple[str, ...]
+
+
+def load_entries(path : str) -> List[Entry]:
+    """
+    Reads the entries to warm up from a file, which has a "REGION/MODEL" or "REGION/MODEL/FIRMWARE" in each line.
+    Empty lines and lines starting with "#" are skipped.
+    """
+    entries = []
+    with open(path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if (not line) or line.startswith("#"):
+                continue
+            # Firmware versions have slashes too, so only split the region and model.
+            entry = tuple(x.strip().upper() for x in line.split("/", 2))
+            if (len(entry) < 2) or (not all(entry)):
+                raise ValueError(f"Invalid entry in the warm-up list: {line}")
+            entries.append(entry)
+    # Keep the order, but remove the duplicates.
+    return list(dict.fromkeys(entries))
+
+
+def save_entries(path : str, entries : List[Entry]) -> None:
+    """
+    Writes the entries in the same format that load_entries reads. File is replaced at once,
+    so a worker that is starting meanwhile doesn't read a half written file.
+    """
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w") as file:
+        file.write("# Most recently used entries of the previous run.\n")
+        file.writelines("/".join(x) + "\n" for x in entries)
+    os.replace(temp, path)
+
+
+def top_entries(app : Sanic, count : int) -> List[Entry]:
+    """
+    Gets the most recently used firmware lists and binary details from the caches, most recent first.
+    Entries of devices and firmwares that haven't been found are skipped.
+    """
+    entries = []
+    for cache in [app.ctx.binary_details, app.ctx.firmware_lists]:
+        # Caches keep the entries from the least recently used to the most recently used.
+        keys = [key for key, entry in cache.items() if not entry.negative]
+        entries.extend(reversed(keys[-count:]))
+    return entries[:count]
+
+
+class Warmup:
+    """
+    Fills the caches with the firmware lists of the given devices and binary details of the given firmwares
+    (or the latest firmware when there is no firmware), so the first requests after a start don't wait for Kies servers.
+    At most "concurrency" entries are loaded at the same time.
+
+    It becomes ready when "share" of the entries (0.9 is 90%) have been loaded. If that hasn't happened
+    in "timeout" seconds, it is marked as timed out and stays not ready, unless "fail_open" is set,
+    which makes it ready anyway, so a start is not held back forever when Kies servers can't be reached.
+    Entries that have failed are loaded again with a growing delay until it becomes ready, so it still
+    becomes ready once Kies servers can be reached again.
+    """
+
+    # Seconds to wait before loading the failed entries again, doubled after each try.
+    RETRY_DELAY = 1
+    RETRY_MAX_DELAY = 60
+
+    def __init__(
+        self,
+        app : Sanic,
+        entries : List[Entry],
+        concurrency : int = 8,
+        share : float = 0.9,
+        timeout : float = 60,
+        fail_open : bool = False
+    ) -> None:
+        self.app = app
+        self.entries = entries
+        self.concurrency = max(concurrency, 1)
+        self.share = share
+        self.timeout = timeout
+        self.fail_open = fail_open
+        self.warm = 0
+        self.failed = 0
+        self.timed_out = False
+        self.started : Optional[float] = None
+        self.finished : Optional[float] = None
+        self._ready = asyncio.Event()
+        self._task : Optional[asyncio.Task] = None
+        self._timer : Optional[asyncio.TimerHandle] = None
+        if self.target <= 0:
+            self._ready.set()
+
+    @property
+    def target(self) -> int:
+        return math.ceil(len(self.entries) * self.share)
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def status(self) -> Dict[str, object]:
+        return {
+            "ready": self.ready,
+            "timed_out": self.timed_out,
+            "entries": len(self.entries),
+            "target": self.target,
+            "warm": self.warm,
+            "failed": self.failed,
+            "seconds": None if self.started is None else (self.finished or time.monotonic()) - self.started
+        }
+
+    def start(self) -> None:
+        self.started = time.monotonic()
+        self._task = asyncio.create_task(self.run())
+        self._timer = asyncio.get_running_loop().call_later(self.timeout, self._expire)
+
+    async def stop(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions = True)
+
+    async def wait(self) -> None:
+        await self._ready.wait()
+
+    def _expire(self) -> None:
+        if self.ready:
+            return
+        self.timed_out = True
+        if self.fail_open:
+            logger.warning(f"Warm-up has timed out with {self.warm} of {len(self.entries)} entries, serving anyway.")
+            self._ready.set()
+        else:
+            logger.warning(f"Warm-up has timed out with {self.warm} of {len(self.entries)} entries, still not ready.")
+
+    async def load(self, entry : Entry) -> bool:
+        """
+        Loads the entry to the caches, and returns True if it has been cached (even if it is a device that doesn't exist).
+        """
+        region, model = entry[0], entry[1]
+        try:
+            if len(entry) > 2:
+                await fetch_binary_details(self.app, region, model, entry[2])
+            else:
+                firmwares = await fetch_firmware_list(self.app, region, model)
+                if firmwares.exists:
+                    await fetch_binary_details(self.app, region, model, firmwares.latest)
+            return True
+        except Exception:
+            # Errors of devices and firmwares that don't exist are cached too, so they count as warm.
+            cache = self.app.ctx.binary_details if len(entry) > 2 else self.app.ctx.firmware_lists
+            return entry in cache
+
+    async def run(self) -> None:
+        limit = asyncio.Semaphore(self.concurrency)
+        pending = list(self.entries)
+        delay = self.RETRY_DELAY
+
+        async def run_one(entry : Entry) -> bool:
+            async with limit:
+                loaded = await self.load(entry)
+            if loaded:
+                self.warm += 1
+            if (self.warm >= self.target) and (not self.ready):
+                logger.info(f"Warm-up is ready with {self.warm} of {len(self.entries)} entries.")
+                self._ready.set()
+            return loaded
+
+        while True:
+            results = await asyncio.gather(*[run_one(x) for x in pending])
+            pending = [x for x, loaded in zip(pending, results) if not loaded]
+            self.failed = len(pending)
+            # Failed entries are tried again (for example, when Kies servers couldn't be reached on start)
+            # until enough entries have been loaded, so it doesn't stay not ready forever.
+            if (not pending) or (self.warm >= self.target):
+                break
+            logger.warning(f"Warm-up has {len(pending)} failed entries, trying again in {delay:.0f} seconds.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.RETRY_MAX_DELAY)
+        self.finished = time.monotonic()
+        logger.info(f"Warm-up has finished in {self.finished - self.started:.1f} seconds, {self.failed} entries have failed.")
+
+@bp.get("/ready")
+async def get_ready(request : Request):
+    """
+    Tells if the caches have been warmed up, so load balancers can wait before sending traffic.
+    Responds with 503 until then, "timed_out" tells if the warm-up couldn't be ready in time.
+    """
+    state = request.app.ctx.warmup
+    if state is None:
+        return json({"ready": True})
+    return json(state.status(), status = 200 if state.ready else 503)
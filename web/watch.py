@@ -0,0 +1,223 @@
+__all__ = [
+    "bp",
+    "Watcher",
+    "load_watchlist",
+    "poll_device"
+]
+
+import asyncio
+import heapq
+import random
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from sanic import Blueprint, Sanic
+from sanic.log import logger
+from sanic.request import Request
+from sanic.response import json
+from sanic.exceptions import InvalidUsage, NotFound
+from samfetch.kies import KiesFirmwareList, KiesRequest
+from samfetch.metrics import WATCH_POLLS
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+bp = Blueprint(name = "Watch", url_prefix = "/watch")
+
+
+def load_watchlist(path : str) -> List[Tuple[str, str]]:
+    """
+    Reads the devices to watch from a file, which has a "REGION/MODEL" pair in each line.
+    Empty lines and lines starting with "#" are skipped.
+    """
+    devices = []
+    with open(path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if (not line) or line.startswith("#"):
+                continue
+            region, _, model = line.partition("/")
+            if (not region) or (not model):
+                raise ValueError(f"Invalid device in the watchlist: {line}")
+            devices.append((region.strip().upper(), model.strip().upper()))
+    # Keep the order, but remove the duplicates.
+    return list(dict.fromkeys(devices))
+
+
+async def poll_device(app : Sanic, region : str, model : str) -> str:
+    """
+    Requests the firmware list of the device with the validators of the last one, and saves
+    the changes to the history. The list is also put in the cache, so requests don't need to get it again.
+    Returns the result of the poll, which is "not_modified", "unchanged", "changed" or "missing".
+    """
+    history = app.ctx.history
+    loop = asyncio.get_running_loop()
+    etag, last_modified = await loop.run_in_executor(None, history.validators, region, model)
+    response = await app.ctx.client.send(
+        KiesRequest.list_firmware(region = region, model = model, etag = etag, last_modified = last_modified)
+    )
+    if (response.status_code == 304) and (etag or last_modified):
+        await loop.run_in_executor(None, history.checked, region, model)
+        return "not_modified"
+    if response.status_code != 200:
+        return "missing"
+    firmwares = KiesFirmwareList.from_xml(response.text)
+    etag, last_modified = response.headers.get("ETag", None), response.headers.get("Last-Modified", None)
+    app.ctx.firmware_lists.set((region, model), firmwares, etag = etag, last_modified = last_modified)
+    changes = await loop.run_in_executor(None, history.update, region, model, firmwares, etag, last_modified)
+    for change in changes:
+        logger.info(f"{region}/{model}: {change['firmware']} ({change['kind']})")
+    return "changed" if changes else "unchanged"
+
+
+class Watcher:
+    """
+    Polls the firmware lists of the watched devices in the background, each once in "interval" seconds.
+    Polls are spread over the interval and each interval is changed randomly up to "jitter"
+    (0.1 is 10%), so requests are not sent at once. At most "concurrency" devices are polled at the same time.
+
+    When the history is saved to a file, only one of the worker processes polls the devices,
+    and others serve the history from the same file.
+    """
+
+    def __init__(
+        self,
+        app : Sanic,
+        devices : List[Tuple[str, str]],
+        interval : float,
+        jitter : float = 0.1,
+        concurrency : int = 4,
+        lock_file : Optional[str] = None
+    ) -> None:
+        self.app = app
+        self.devices = devices
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = max(concurrency, 1)
+        self.lock_file = lock_file
+        self.results : Dict[str, int] = {}
+        self._task : Optional[asyncio.Task] = None
+        self._polls : Set[asyncio.Task] = set()
+        self._lock = None
+
+    @property
+    def running(self) -> bool:
+        return (self._task is not None) and (not self._task.done())
+
+    def next_delay(self) -> float:
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def start(self) -> bool:
+        """
+        Starts polling, unless another worker process is polling already.
+        """
+        if self.lock_file and fcntl:
+            self._lock = open(self.lock_file, "a")
+            try:
+                fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock.close()
+                self._lock = None
+                return False
+        self._task = asyncio.create_task(self.run())
+        return True
+
+    async def stop(self) -> None:
+        for task in [self._task, *self._polls]:
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*[x for x in [self._task, *self._polls] if x is not None], return_exceptions = True)
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    async def run(self) -> None:
+        limit = asyncio.Semaphore(self.concurrency)
+        now = time.monotonic()
+        count = max(len(self.devices), 1)
+        # First polls are spread over the interval too, each one at a random time in its own slot.
+        queue = [
+            (now + self.interval * (i + random.random()) / count, region, model)
+            for i, (region, model) in enumerate(self.devices)
+        ]
+        heapq.heapify(queue)
+
+        async def poll(region : str, model : str):
+            try:
+                result = await poll_device(self.app, region, model)
+            except Exception as e:
+                result = "error"
+                logger.warning(f"Couldn't poll the firmware list of {region}/{model}: {e!r}")
+            finally:
+                limit.release()
+                heapq.heappush(queue, (time.monotonic() + self.next_delay(), region, model))
+            self.results[result] = self.results.get(result, 0) + 1
+            WATCH_POLLS.labels(result).inc()
+
+        while queue:
+            due, region, model = queue[0]
+            # Polls that finish meanwhile may add earlier ones, so check the queue again at least once in a second.
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(min(delay, 1))
+                continue
+            heapq.heappop(queue)
+            await limit.acquire()
+            task = asyncio.create_task(poll(region, model))
+            self._polls.add(task)
+            task.add_done_callback(self._polls.discard)
+
+
+def get_history(request : Request):
+    history = getattr(request.app.ctx, "history", None)
+    if history is None:
+        raise NotFound(f"Requested URL {request.path} not found")
+    return history
+
+
+@bp.get("/")
+async def get_watch_status(request : Request):
+    """
+    Lists the watched devices with their latest firmware and the last time they have been checked.
+    """
+    history = get_history(request)
+    watcher = request.app.ctx.watcher
+    # Queries may wait for the database lock, so don't block the event loop.
+    devices = await asyncio.get_running_loop().run_in_executor(None, history.devices)
+    return json({
+        "polling": (watcher is not None) and watcher.running,
+        "interval": request.app.config.SAMFETCH_WATCH_INTERVAL,
+        "results": {} if watcher is None else watcher.results,
+        "devices": devices
+    })
+
+
+@bp.get("/history/<region:str>/<model:str>")
+async def get_device_history(request : Request, region : str, model : str):
+    """
+    Gets the firmwares that have been seen for a watched device, newest first.
+    """
+    output = await asyncio.get_running_loop().run_in_executor(
+        None, get_history(request).history, region.upper(), model.upper()
+    )
+    if output is None:
+        raise NotFound(f"{region}/{model} is not watched")
+    return json(output)
+
+
+@bp.get("/changes")
+async def get_changes(request : Request):
+    """
+    Gets the changes of the watched devices after the change with the id given in "after" query parameter, 
+    and after the time given in "since" query parameter (as an Unix timestamp) if any, oldest first. 
+    At most "limit" changes (1000 by default) are returned, so next ones can be get with the id of the last one.
+    """
+    history = get_history(request)
+    try:
+        after = int(request.args.get("after", 0))
+        since = float(request.args.get("since", 0))
+        limit = min(max(int(request.args.get("limit", 1000)), 1), 1000)
+    except ValueError:
+        raise InvalidUsage('"after" and "limit" must be numbers and "since" must be an Unix timestamp.')
+    return json(await asyncio.get_running_loop().run_in_executor(None, history.changes, after, limit, since))